@@ -0,0 +1,133 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Measures concurrent SQLite writer and reader throughput under the database
+profiles in yeti/settings.py (see YETI_DB_PROFILE).
+
+Writer processes commit one ~2 KB row per transaction, like Inbox requests.
+Reader processes read 50 rows at a time in id order, like Poll requests.
+Each profile gets a fresh database file. Its connection setup follows the
+profile: a new connection per request, or one persistent connection per
+process when the profile sets CONN_MAX_AGE.
+
+Usage:
+    python benchmarks/db_concurrency.py [--writers 4] [--readers 4] [--seconds 5]
+"""
+
+from multiprocessing import Process, Queue
+import argparse
+import imp
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'yeti', 'settings.py')
+PROFILES = ('default', 'sqlite-wal')
+ROW = 'x' * 2048
+PRELOAD_ROWS = 10000
+READ_SIZE = 50
+
+
+def load_profile(name):
+    """
+    Returns (pragmas, timeout, persistent) for the named profile, read from yeti/settings.py
+    """
+    os.environ['YETI_DB_PROFILE'] = name
+    settings = imp.load_source('yeti_benchmark_settings', SETTINGS_PATH)
+    db = settings.DATABASES['default']
+    timeout = db.get('OPTIONS', {}).get('timeout', 5)
+    return settings.YETI_SQLITE_PRAGMAS, timeout, 'CONN_MAX_AGE' in db
+
+
+def connect(path, pragmas, timeout):
+    conn = sqlite3.connect(path, timeout=timeout)
+    for pragma in pragmas:
+        conn.execute('PRAGMA %s' % pragma)
+    return conn
+
+
+def worker(kind, path, profile, deadline, results):
+    pragmas, timeout, persistent = profile
+    conn = connect(path, pragmas, timeout) if persistent else None
+    ops = errors = 0
+    latency = 0.0
+    offset = 0
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            c = conn or connect(path, pragmas, timeout)
+            if kind == 'writer':
+                c.execute('INSERT INTO content (timestamp_label, content) VALUES (?, ?)', (time.time(), ROW))
+                c.commit()
+            else:
+                c.execute('SELECT id, content FROM content WHERE id > ? ORDER BY id LIMIT ?',
+                          (offset, READ_SIZE)).fetchall()
+                offset = (offset + READ_SIZE) % PRELOAD_ROWS
+            if conn is None:
+                c.close()
+            ops += 1
+            latency += time.time() - start
+        except sqlite3.OperationalError:  # database is locked
+            errors += 1
+    results.put((kind, ops, errors, latency))
+
+
+def run(profile_name, writers, readers, seconds):
+    profile = load_profile(profile_name)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'benchmark.db')
+    try:
+        conn = connect(path, profile[0], profile[1])
+        conn.execute('CREATE TABLE content (id INTEGER PRIMARY KEY, timestamp_label REAL, content TEXT)')
+        conn.executemany('INSERT INTO content (timestamp_label, content) VALUES (?, ?)',
+                         ((i, ROW) for i in range(PRELOAD_ROWS)))
+        conn.commit()
+        conn.close()
+
+        results = Queue()
+        deadline = time.time() + seconds
+        processes = ([Process(target=worker, args=('writer', path, profile, deadline, results))
+                      for i in range(writers)] +
+                     [Process(target=worker, args=('reader', path, profile, deadline, results))
+                      for i in range(readers)])
+        for p in processes:
+            p.start()
+        totals = {'writer': [0, 0, 0.0], 'reader': [0, 0, 0.0]}
+        for p in processes:
+            kind, ops, errors, latency = results.get()
+            totals[kind][0] += ops
+            totals[kind][1] += errors
+            totals[kind][2] += latency
+        for p in processes:
+            p.join()
+        return totals
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print "%d writers, %d readers, %.1f seconds per profile" % (args.writers, args.readers, args.seconds)
+    print "%-12s %12s %12s %12s %12s %12s" % ('profile', 'writes/s', 'write ms', 'reads/s', 'read ms', 'locked')
+    for name in PROFILES:
+        totals = run(name, args.writers, args.readers, args.seconds)
+        w_ops, w_errors, w_latency = totals['writer']
+        r_ops, r_errors, r_latency = totals['reader']
+        print "%-12s %12.1f %12.2f %12.1f %12.2f %12d" % (name,
+                                                          w_ops / args.seconds,
+                                                          1000 * w_latency / max(w_ops, 1),
+                                                          r_ops / args.seconds,
+                                                          1000 * r_latency / max(r_ops, 1),
+                                                          w_errors + r_errors)
+
+
+if __name__ == '__main__':
+    main()
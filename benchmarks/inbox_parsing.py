@@ -0,0 +1,95 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Measures the time and peak memory of parsing one large TAXII 1.1 Inbox
+Message the way taxii_services.views.service_router does (schema
+validation with libtaxii, then libtaxii.messages_11.get_message_from_xml)
+and with yeti.parsing.parse_message.
+
+Each parse runs in its own process, so that its peak resident set size
+can be measured. The XML string itself is counted in both.
+
+Usage:
+    python benchmarks/inbox_parsing.py [--content-blocks 2000] [--content-size 10000]
+"""
+
+from multiprocessing import Process, Queue
+from StringIO import StringIO
+import argparse
+import os
+import resource
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+CONTENT = ('<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1" id="example:package-%d">'
+           '<stix:Indicators>%s</stix:Indicators></stix:STIX_Package>')
+INDICATOR = '<stix:Indicator id="example:indicator-%d"><stix:Title>Example indicator</stix:Title></stix:Indicator>'
+
+
+def get_message_xml(content_blocks, content_size):
+    import libtaxii.messages_11 as tm11
+    from libtaxii.constants import CB_STIX_XML_111
+
+    indicators = ''.join(INDICATOR % i for i in range(content_size / len(INDICATOR)))
+    xml = tm11.InboxMessage(message_id='1',
+                            content_blocks=[tm11.ContentBlock(CB_STIX_XML_111, CONTENT % (0, indicators))]).to_xml()
+    # Repeat the Content Block as text, since building the whole message with libtaxii
+    # would use more memory than either parser
+    start = xml.index('<taxii_11:Content_Block>')
+    end = xml.index('</taxii_11:Content_Block>') + len('</taxii_11:Content_Block>')
+    return xml[:start] + xml[start:end] * content_blocks + xml[end:]
+
+
+def libtaxii_parse(xml):
+    import libtaxii.messages_11 as tm11
+    from libtaxii.validation import TAXII11Validator
+
+    if not TAXII11Validator().validate_string(xml).valid:
+        raise ValueError("Not schema valid")
+    return tm11.get_message_from_xml(xml)
+
+
+def yeti_parse(xml):
+    from libtaxii.constants import VID_TAXII_XML_11
+    from yeti.parsing import parse_message
+
+    return parse_message(xml, VID_TAXII_XML_11)
+
+
+def worker(parse, args, results):
+    sys.path.insert(0, ROOT)
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'yeti.settings'
+    xml = get_message_xml(args.content_blocks, args.content_size)
+    stdout, sys.stdout = sys.stdout, StringIO()  # taxii_services prints errors on import without a database
+    try:
+        parse(get_message_xml(1, 100))  # Import everything and load the schema
+    finally:
+        sys.stdout = stdout
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    message = parse(xml)
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((len(xml), len(message.content_blocks), seconds, (after - before) / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--content-blocks', type=int, default=2000)
+    parser.add_argument('--content-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    print "%-10s %12s %16s %12s %20s" % ('parser', 'message MB', 'content blocks', 'seconds', 'peak RSS growth MB')
+    for name, parse in (('libtaxii', libtaxii_parse), ('yeti', yeti_parse)):
+        results = Queue()
+        p = Process(target=worker, args=(parse, args, results))
+        p.start()
+        size, count, seconds, peak = results.get()
+        p.join()
+        print "%-10s %12.1f %16d %12.2f %20.1f" % (name, size / 1048576.0, count, seconds, peak)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Load-tests the TAXII Services of a local YETI server: Inbox, Poll, Poll
+Fulfillment, Discovery and Collection Information requests are sent
+concurrently, and the latency percentiles and throughput of each are
+reported, with the server's peak RSS and database queries per request.
+
+The server runs in its own process (a threaded wsgiref server around
+yeti.wsgi.application) with a fresh database in a temporary directory. Its
+default Data Collection is first seeded with synthetic STIX 1.1.1 watchlists
+through the Inbox Service. --handlers selects the built-in taxii_services
+message handlers or YETI's (bulk inbox, indexed poll, cached discovery and
+collection information). Polls are answered in parts of --result-size
+content blocks, so Poll Fulfillment Requests have parts to fetch.
+
+Results can be written as JSON with --output, and compared with an
+earlier run's JSON with --compare.
+
+Usage:
+    python benchmarks/load_test.py [--handlers yeti] [--content-blocks 2000] [--concurrency 8]
+        [--seconds 10] [--output results.json] [--compare previous.json]
+"""
+
+from multiprocessing import Event, Process, Queue
+from StringIO import StringIO
+import argparse
+import datetime
+import httplib
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+INBOX_PATH = '/services/inbox/'
+POLL_PATH = '/services/poll/'
+COLLECTION_MANAGEMENT_PATH = '/services/collection-management/'
+DISCOVERY_PATH = '/services/discovery/'
+COLLECTION_NAME = 'default'
+
+HANDLERS = {
+    'builtin': {
+        'inbox': 'taxii_services.message_handlers.InboxMessageHandler',
+        'poll': 'taxii_services.message_handlers.PollRequestHandler',
+        'poll_fulfillment': 'taxii_services.message_handlers.PollFulfillmentRequest11Handler',
+        'discovery': 'taxii_services.message_handlers.DiscoveryRequestHandler',
+        'collection_information': 'taxii_services.message_handlers.CollectionInformationRequestHandler',
+    },
+    'yeti': {
+        'inbox': 'yeti.inbox_handlers.BulkInboxMessageHandler',
+        'poll': 'yeti.poll_handlers.IndexedPollRequestHandler',
+        'poll_fulfillment': 'yeti.poll_handlers.IndexedPollFulfillmentRequest11Handler',
+        'discovery': 'yeti.cached_handlers.CachedDiscoveryRequestHandler',
+        'collection_information': 'yeti.cached_handlers.CachedCollectionInformationRequestHandler',
+    },
+}
+
+#: The operations sent during the load test, and how often each is picked
+OPERATIONS = ('inbox', 'poll', 'poll_fulfillment', 'discovery', 'collection_information')
+DEFAULT_MIX = 'inbox=1,poll=4,poll_fulfillment=2,discovery=2,collection_information=1'
+
+# Modeled on stix_watchlist_111 in yeti/tests.py. %(id)s makes each content block unique.
+CONTENT = '''<stix:STIX_Package
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xmlns:stix="http://stix.mitre.org/stix-1"
+    xmlns:indicator="http://stix.mitre.org/Indicator-2"
+    xmlns:cybox="http://cybox.mitre.org/cybox-2"
+    xmlns:DomainNameObj="http://cybox.mitre.org/objects#DomainNameObject-1"
+    xmlns:stixVocabs="http://stix.mitre.org/default_vocabularies-1"
+    xmlns:example="http://example.com/"
+    id="example:STIXPackage-%(id)s" timestamp="2014-05-08T09:00:00.000000Z" version="1.1.1">
+    <stix:STIX_Header>
+        <stix:Title>Example watchlist %(id)s</stix:Title>
+        <stix:Package_Intent xsi:type="stixVocabs:PackageIntentVocab-1.0">Indicators - Watchlist</stix:Package_Intent>
+    </stix:STIX_Header>
+    <stix:Indicators>
+        <stix:Indicator xsi:type="indicator:IndicatorType" id="example:Indicator-%(id)s">
+            <indicator:Type xsi:type="stixVocabs:IndicatorTypeVocab-1.1">Domain Watchlist</indicator:Type>
+            <indicator:Observable id="example:Observable-%(id)s">
+                <cybox:Object id="example:Object-%(id)s">
+                    <cybox:Properties xsi:type="DomainNameObj:DomainNameObjectType" type="FQDN">
+                        <DomainNameObj:Value condition="Equals">malicious-%(id)s.example.com</DomainNameObj:Value>
+                    </cybox:Properties>
+                </cybox:Object>
+            </indicator:Observable>
+        </stix:Indicator>
+    </stix:Indicators>
+</stix:STIX_Package>'''
+
+# Replaced in the XML of an Inbox Message template, so each message has new content
+CONTENT_ID_MARKER = 'yeti-benchmark-content-id'
+
+
+def setup_server(directory, handlers, result_size):
+    """
+    Creates the database and points the default TAXII Services at the message handlers
+    """
+    sys.path.insert(0, ROOT)
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'yeti.settings'
+    os.environ['YETI_DB_PATH'] = os.path.join(directory, 'benchmark.db')
+
+    stdout, sys.stdout = sys.stdout, StringIO()  # taxii_services prints while registering its handlers
+    try:
+        import django
+        django.setup()  # Before migrate, registering YETI's handlers fails; they are registered below
+        from django.core.management import call_command
+        from taxii_services import models
+        from taxii_services.management import register_message_handler
+
+        call_command('migrate', interactive=False, verbosity=0)
+        for handler in handlers.values():
+            register_message_handler(handler, retry=False)
+    finally:
+        sys.stdout = stdout
+
+    def get_handler(name):
+        return models.MessageHandler.objects.get(handler=handlers[name])
+
+    inbox_service = models.InboxService.objects.get(path=INBOX_PATH)
+    inbox_service.inbox_message_handler = get_handler('inbox')
+    inbox_service.save()
+    poll_service = models.PollService.objects.get(path=POLL_PATH)
+    poll_service.poll_request_handler = get_handler('poll')
+    poll_service.poll_fulfillment_handler = get_handler('poll_fulfillment')
+    poll_service.max_result_size = result_size
+    poll_service.save()
+    discovery_service = models.DiscoveryService.objects.get(path=DISCOVERY_PATH)
+    discovery_service.discovery_handler = get_handler('discovery')
+    discovery_service.save()
+    collection_management_service = models.CollectionManagementService.objects.get(path=COLLECTION_MANAGEMENT_PATH)
+    collection_management_service.collection_information_handler = get_handler('collection_information')
+    collection_management_service.save()
+
+
+class QueryCountingApplication(object):
+    """
+    WSGI middleware that counts the database queries of each request,
+    by the operation named in its X-Benchmark-Operation header
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.queries = {}  # Operation: [requests, queries]
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        from django.db import connection
+
+        connection.use_debug_cursor = True  # Records queries even if DEBUG is False
+        operation = environ.get('HTTP_X_BENCHMARK_OPERATION', 'other')
+        response = self.application(environ, start_response)
+        try:
+            for chunk in response:  # A streamed response runs queries while it is iterated
+                yield chunk
+        finally:
+            queries = len(connection.queries)
+            if hasattr(response, 'close'):
+                response.close()
+            with self.lock:
+                counts = self.queries.setdefault(operation, [0, 0])
+                counts[0] += 1
+                counts[1] += queries
+
+
+def serve(directory, handlers, result_size, ready, stop, results):
+    """
+    Runs the server process. Puts its port on `ready` once it is listening, and
+    its peak RSS and query counts on `results` once `stop` is set.
+    """
+    setup_server(directory, handlers, result_size)
+    from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+    from yeti.wsgi import application
+    import resource
+    import SocketServer
+
+    class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    counting_application = QueryCountingApplication(application)
+    server = make_server('127.0.0.1', 0, counting_application,
+                         server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    ready.put(server.server_port)
+
+    stop.wait()
+    server.shutdown()
+    results.put({'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                 'queries': counting_application.queries})
+
+
+class Client(object):
+    """
+    Builds and sends the TAXII 1.1 requests of each operation
+    """
+
+    def __init__(self, port, content_blocks_per_inbox):
+        import libtaxii.messages_11 as tm11
+        from libtaxii.common import generate_message_id
+        from libtaxii.constants import (CB_STIX_XML_111, VID_TAXII_HTTP_10, VID_TAXII_SERVICES_11,
+                                        VID_TAXII_XML_11)
+
+        self.port = port
+        self.content_ids = itertools.count()
+        self.headers = {'Content-Type': 'application/xml',
+                        'Accept': 'application/xml',
+                        'X-TAXII-Content-Type': VID_TAXII_XML_11,
+                        'X-TAXII-Accept': VID_TAXII_XML_11,
+                        'X-TAXII-Services': VID_TAXII_SERVICES_11,
+                        'X-TAXII-Protocol': VID_TAXII_HTTP_10}
+
+        content_blocks = [tm11.ContentBlock(CB_STIX_XML_111, CONTENT % {'id': '%s-%d' % (CONTENT_ID_MARKER, i)})
+                          for i in range(content_blocks_per_inbox)]
+        self.inbox_template = tm11.InboxMessage(message_id=generate_message_id(),
+                                                destination_collection_names=[COLLECTION_NAME],
+                                                content_blocks=content_blocks).to_xml()
+        self.poll_request = tm11.PollRequest(message_id=generate_message_id(),
+                                             collection_name=COLLECTION_NAME,
+                                             poll_parameters=tm11.PollParameters()).to_xml()
+        self.discovery_request = tm11.DiscoveryRequest(message_id=generate_message_id()).to_xml()
+        self.collection_information_request = tm11.CollectionInformationRequest(
+            message_id=generate_message_id()).to_xml()
+        self.poll_fulfillment_request = None  # Set by find_result_set()
+
+    def post(self, operation, path, body):
+        """
+        Sends one request. Returns the response body, or raises
+        ValueError if the response is not a successful TAXII response.
+        """
+        connection = httplib.HTTPConnection('127.0.0.1', self.port, timeout=300)
+        try:
+            connection.request('POST', path, body, dict(self.headers, **{'X-Benchmark-Operation': operation}))
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise ValueError("HTTP %s" % response.status)
+        if 'Status_Message' in data[:200] and 'status_type="SUCCESS"' not in data:
+            raise ValueError("Status Message: %s" % data[:500])
+        return data
+
+    def inbox(self):
+        body = self.inbox_template.replace(CONTENT_ID_MARKER, str(next(self.content_ids)))
+        return self.post('inbox', INBOX_PATH, body)
+
+    def poll(self):
+        return self.post('poll', POLL_PATH, self.poll_request)
+
+    def poll_fulfillment(self):
+        return self.post('poll_fulfillment', POLL_PATH, self.poll_fulfillment_request)
+
+    def discovery(self):
+        return self.post('discovery', DISCOVERY_PATH, self.discovery_request)
+
+    def collection_information(self):
+        return self.post('collection_information', COLLECTION_MANAGEMENT_PATH, self.collection_information_request)
+
+    def find_result_set(self):
+        """
+        Polls once, and builds a Poll Fulfillment Request for the last
+        part of the multi-part result set the Poll Response starts
+        """
+        import libtaxii.messages_11 as tm11
+        from libtaxii.common import generate_message_id
+
+        response = tm11.get_message_from_xml(self.post('seed', POLL_PATH, self.poll_request))
+        if not response.more:
+            raise ValueError("The Poll Response is not multi-part; use more --content-blocks than --result-size")
+        parts = response.record_count.record_count / len(response.content_blocks)
+        parts += 1 if response.record_count.record_count % len(response.content_blocks) else 0
+        self.poll_fulfillment_request = tm11.PollFulfillmentRequest(message_id=generate_message_id(),
+                                                                    collection_name=COLLECTION_NAME,
+                                                                    result_id=response.result_id,
+                                                                    result_part_number=parts).to_xml()
+
+
+def percentile(values, p):
+    """
+    Returns the nearest-rank percentile p (0-100) of a sorted list
+    """
+    if not values:
+        return 0.0
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_load(client, mix, concurrency, seconds):
+    """
+    Sends requests from `concurrency` threads for `seconds`, each request
+    picked at random by the weights in mix. Returns a dict of operation:
+    (sorted latencies in seconds, error count).
+    """
+    choices = []
+    for operation, weight in mix.items():
+        choices.extend([operation] * weight)
+    latencies = dict((operation, []) for operation in mix)
+    errors = dict((operation, 0) for operation in mix)
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def worker(seed):
+        rng = random.Random(seed)
+        while time.time() < deadline:
+            operation = rng.choice(choices)
+            start = time.time()
+            try:
+                getattr(client, operation)()
+                ok = True
+            except (ValueError, EnvironmentError, httplib.HTTPException):
+                ok = False
+            elapsed = time.time() - start
+            with lock:
+                if ok:
+                    latencies[operation].append(elapsed)
+                else:
+                    errors[operation] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return dict((operation, (sorted(latencies[operation]), errors[operation])) for operation in mix)
+
+
+def summarize(load, seconds, queries):
+    """
+    Returns the per-operation results of run_load() as a JSON-ready dict
+    """
+    operations = {}
+    for operation, (latencies, errors) in load.items():
+        requests, query_count = queries.get(operation, [0, 0])
+        operations[operation] = {'requests': len(latencies),
+                                 'errors': errors,
+                                 'requests_per_second': len(latencies) / seconds,
+                                 'p50_ms': 1000 * percentile(latencies, 50),
+                                 'p95_ms': 1000 * percentile(latencies, 95),
+                                 'p99_ms': 1000 * percentile(latencies, 99),
+                                 'queries_per_request': float(query_count) / requests if requests else 0.0}
+    return operations
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        operation, weight = item.split('=')
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError("Unknown operation: %s" % operation)
+        if int(weight) > 0:
+            mix[operation] = int(weight)
+    return mix
+
+
+def print_results(results, previous=None):
+    print "%s handlers, %d content blocks, %d threads, %.1f seconds; server peak RSS %.1f MB" % (
+        results['config']['handlers'], results['config']['content_blocks'], results['config']['concurrency'],
+        results['config']['seconds'], results['server']['peak_rss_mb'])
+    columns = ('requests_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+    print "%-24s %8s %8s %10s %10s %10s %10s" % ('operation', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                 'queries')
+    for operation in OPERATIONS:
+        result = results['operations'].get(operation)
+        if result is None:
+            continue
+        print "%-24s %8d %8.1f %10.1f %10.1f %10.1f %10.1f" % ((operation, result['errors']) +
+                                                               tuple(result[column] for column in columns))
+        before = previous['operations'].get(operation) if previous else None
+        if before:
+            changes = []
+            for column in columns:
+                if before[column]:
+                    changes.append('%+.0f%%' % (100.0 * (result[column] - before[column]) / before[column]))
+                else:
+                    changes.append('-')
+            print "%-24s %8s %8s %10s %10s %10s %10s" % (('  vs. previous', '') + tuple(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--handlers', choices=sorted(HANDLERS), default='yeti')
+    parser.add_argument('--content-blocks', type=int, default=2000,
+                        help='Number of content blocks the Data Collection is seeded with')
+    parser.add_argument('--inbox-size', type=int, default=10,
+                        help='Number of content blocks per Inbox Message during the load test')
+    parser.add_argument('--result-size', type=int, default=100,
+                        help="The Poll Service's max_result_size")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='Relative weights of the operations (default: %s)' % DEFAULT_MIX)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare the results with this JSON file from an earlier run')
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    directory = tempfile.mkdtemp()
+    ready, stop, server_results = Queue(), Event(), Queue()
+    server = Process(target=serve, args=(directory, HANDLERS[args.handlers], args.result_size,
+                                         ready, stop, server_results))
+    server.start()
+    try:
+        port = ready.get(timeout=300)
+
+        seed_client = Client(port, 100)
+        for i in range(0, args.content_blocks, 100):
+            seed_client.inbox()
+        seed_client.find_result_set()
+
+        client = Client(port, args.inbox_size)
+        client.content_ids = itertools.count(args.content_blocks)  # After the seeded content
+        client.poll_fulfillment_request = seed_client.poll_fulfillment_request
+        load = run_load(client, args.mix, args.concurrency, args.seconds)
+
+        stop.set()
+        server_stats = server_results.get(timeout=300)
+        server.join()
+    finally:
+        stop.set()
+        if server.is_alive():
+            server.terminate()
+        shutil.rmtree(directory)
+
+    results = {'date': datetime.datetime.utcnow().isoformat() + 'Z',
+               'config': {'handlers': args.handlers,
+                          'content_blocks': args.content_blocks,
+                          'inbox_size': args.inbox_size,
+                          'result_size': args.result_size,
+                          'concurrency': args.concurrency,
+                          'seconds': args.seconds,
+                          'mix': args.mix},
+               'server': {'peak_rss_mb': server_stats['peak_rss_mb']},
+               'operations': summarize(load, args.seconds, server_stats['queries'])}
+    print_results(results, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
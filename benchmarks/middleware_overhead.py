@@ -0,0 +1,136 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Measures the per-request time of a TAXII Discovery Request sent through
+Django's WSGIHandler (MIDDLEWARE_CLASSES) and through YETI's
+yeti.dispatch.ServiceWSGIHandler (YETI_SERVICE_MIDDLEWARE_CLASSES).
+
+The Discovery Service uses yeti.cached_handlers.CachedDiscoveryRequestHandler,
+so that the time left over is mostly request handling and middleware.
+Requests are sent straight to the WSGI applications (no network or server)
+using a fresh database in a temporary directory.
+
+Usage:
+    python benchmarks/middleware_overhead.py [--requests 2000]
+"""
+
+from StringIO import StringIO
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+PATH = '/services/benchmark-discovery/'
+HANDLER = 'yeti.cached_handlers.CachedDiscoveryRequestHandler'
+
+
+def setup(directory):
+    """
+    Creates the database and the Discovery Service
+    """
+    sys.path.insert(0, ROOT)
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'yeti.settings'
+    os.environ['YETI_DB_PATH'] = os.path.join(directory, 'benchmark.db')
+
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from taxii_services import models
+    from taxii_services.management import register_message_handler
+
+    stdout, sys.stdout = sys.stdout, StringIO()  # taxii_services prints while registering its handlers
+    try:
+        call_command('migrate', interactive=False, verbosity=0)
+    finally:
+        sys.stdout = stdout
+    register_message_handler(HANDLER, retry=False)
+    models.DiscoveryService(name=PATH, path=PATH,
+                            discovery_handler=models.MessageHandler.objects.get(handler=HANDLER)).save()
+
+
+def get_environ():
+    """
+    Returns the WSGI environ of a TAXII 1.1 Discovery Request. Its body is in '_body'.
+    """
+    import libtaxii.messages_11 as tm11
+    from libtaxii.common import generate_message_id
+    from libtaxii.constants import VID_TAXII_XML_11, VID_TAXII_SERVICES_11, VID_TAXII_HTTP_10
+
+    body = tm11.DiscoveryRequest(message_id=generate_message_id()).to_xml()
+    return {'REQUEST_METHOD': 'POST',
+            'PATH_INFO': PATH,
+            'SCRIPT_NAME': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_TYPE': 'application/xml',
+            'CONTENT_LENGTH': str(len(body)),
+            'HTTP_ACCEPT': 'application/xml',
+            'HTTP_X_TAXII_CONTENT_TYPE': VID_TAXII_XML_11,
+            'HTTP_X_TAXII_ACCEPT': VID_TAXII_XML_11,
+            'HTTP_X_TAXII_SERVICES': VID_TAXII_SERVICES_11,
+            'HTTP_X_TAXII_PROTOCOL': VID_TAXII_HTTP_10,
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            '_body': body}
+
+
+def send(application, environ):
+    """
+    Sends one request and returns the number of queries it ran
+    """
+    from django.db import connection
+
+    environ = dict(environ, **{'wsgi.input': StringIO(environ['_body'])})
+    statuses = []
+    response = application(environ, lambda status, headers: statuses.append(status))
+    queries = len(connection.queries)
+    ''.join(response)
+    response.close()  # Sends request_finished
+    if not statuses[0].startswith('200'):
+        raise ValueError("Unexpected response: %s" % statuses[0])
+    return queries
+
+
+def measure(application, environ, requests):
+    """
+    Returns (seconds per request, queries per request)
+    """
+    for i in range(min(requests, 100)):  # Load middleware, the service registry and the response cache
+        send(application, environ)
+    queries = 0
+    start = time.time()
+    for i in range(requests):
+        queries += send(application, environ)
+    return (time.time() - start) / requests, float(queries) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        setup(directory)
+        from django.core.handlers.wsgi import WSGIHandler
+        from yeti.dispatch import ServiceWSGIHandler
+
+        environ = get_environ()
+        applications = (('MIDDLEWARE_CLASSES', WSGIHandler()),
+                        ('YETI_SERVICE_MIDDLEWARE_CLASSES', ServiceWSGIHandler()))
+        print "%d Discovery Requests per middleware stack" % args.requests
+        print "%-32s %12s %12s" % ('middleware', 'us/request', 'queries')
+        for name, application in applications:
+            seconds, queries = measure(application, environ, args.requests)
+            print "%-32s %12.1f %12.1f" % (name, 1000000 * seconds, queries)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
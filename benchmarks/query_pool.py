@@ -0,0 +1,79 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Measures the time to evaluate a Default Query with XPath over many content
+blocks in the request's process and in yeti.query_handlers' process pool.
+
+The query's target is not indexed, so every content block is parsed and
+evaluated, which is what the pool spreads over its workers. Content blocks
+are not saved, so no database is needed.
+
+Usage:
+    python benchmarks/query_pool.py [--content-blocks 5000] [--workers 4]
+"""
+
+from StringIO import StringIO
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+TARGET = 'STIX_Package/STIX_Header/Information_Source/Identity/Name'
+
+CONTENT = '''<stix:STIX_Package xmlns:stix="http://stix.mitre.org/stix-1"
+    xmlns:stixCommon="http://stix.mitre.org/common-1" id="example:Package-%d" version="1.1.1">
+    <stix:STIX_Header>
+        <stix:Title>Package %d</stix:Title>
+        <stix:Information_Source>
+            <stixCommon:Identity><stixCommon:Name>Source %d</stixCommon:Name></stixCommon:Identity>
+        </stix:Information_Source>
+    </stix:STIX_Header>
+%s
+</stix:STIX_Package>'''
+
+# Makes each content block a few KB, like a small STIX package
+PADDING = '    <!-- %s -->' % ('x' * 4000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--content-blocks', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'yeti.settings'
+    import django
+    stdout, sys.stdout = sys.stdout, StringIO()  # taxii_services prints when it cannot register its handlers
+    try:
+        django.setup()
+    finally:
+        sys.stdout = stdout
+    from django.conf import settings
+    from taxii_services.models import ContentBlock
+    from yeti.query_handlers import IndexedStixXml111QueryHandler, close_query_pool
+    import libtaxii.taxii_default_query as tdq
+    from libtaxii.constants import OP_AND, P_MATCH_TYPE, P_VALUE, R_EQUALS
+
+    test = tdq.Test(capability_id=tdq.CM_CORE, relationship=R_EQUALS,
+                    parameters={P_VALUE: 'Source 7', P_MATCH_TYPE: 'case_sensitive_string'})
+    criteria = tdq.Criteria(OP_AND, criterion=[tdq.Criterion(target=TARGET, test=test)])
+    content_blocks = [ContentBlock(pk=i, content=CONTENT % (i, i, i % 10, PADDING))
+                      for i in range(args.content_blocks)]
+
+    print "%d content blocks, %d workers" % (args.content_blocks, args.workers)
+    print "%-16s %12s %12s" % ('mode', 'seconds', 'matches')
+    for mode, pool_size in (('in-process', 0), ('pool', args.workers)):
+        settings.YETI_QUERY_POOL_SIZE = pool_size
+        settings.YETI_QUERY_POOL_MIN_CONTENT_BLOCKS = 1
+        list(IndexedStixXml111QueryHandler.evaluate_content(criteria, content_blocks[:10]))  # Start the pool
+        start = time.time()
+        matches = list(IndexedStixXml111QueryHandler.evaluate_content(criteria, content_blocks))
+        print "%-16s %12.2f %12d" % (mode, time.time() - start, len(matches))
+    close_query_pool()
+
+
+if __name__ == '__main__':
+    main()
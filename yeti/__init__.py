@@ -6,6 +6,32 @@ __version__ = "2.0a5"
 import django
 import taxii_services
 
+#: Message handlers provided by YETI, registered alongside the built-in ones
+YETI_MESSAGE_HANDLERS = [
+    'yeti.cached_handlers.CachedDiscoveryRequest10Handler',
+    'yeti.cached_handlers.CachedDiscoveryRequest11Handler',
+    'yeti.cached_handlers.CachedDiscoveryRequestHandler',
+    'yeti.cached_handlers.CachedFeedInformationRequest10Handler',
+    'yeti.cached_handlers.CachedCollectionInformationRequest11Handler',
+    'yeti.cached_handlers.CachedCollectionInformationRequestHandler',
+    'yeti.inbox_handlers.BulkInboxMessage10Handler',
+    'yeti.inbox_handlers.BulkInboxMessage11Handler',
+    'yeti.inbox_handlers.BulkInboxMessageHandler',
+    'yeti.inbox_handlers.SpooledInboxMessageHandler',
+    'yeti.poll_handlers.StreamingPollRequest10Handler',
+    'yeti.poll_handlers.StreamingPollRequest11Handler',
+    'yeti.poll_handlers.StreamingPollRequestHandler',
+    'yeti.poll_handlers.IndexedPollRequest10Handler',
+    'yeti.poll_handlers.IndexedPollRequest11Handler',
+    'yeti.poll_handlers.IndexedPollRequestHandler',
+    'yeti.poll_handlers.WaitingPollRequest11Handler',
+    'yeti.poll_handlers.WaitingPollRequestHandler',
+    'yeti.poll_handlers.IndexedPollFulfillmentRequest11Handler',
+    'yeti.subscription_handlers.PushSubscriptionRequest11Handler',
+    'yeti.subscription_handlers.PushSubscriptionRequestHandler',
+]
+
 django.setup()
 taxii_services.register_admins()
 taxii_services.register_message_handlers()
+taxii_services.register_message_handlers(YETI_MESSAGE_HANDLERS)
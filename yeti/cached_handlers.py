@@ -0,0 +1,222 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services import models
+from taxii_services.exceptions import StatusMessageException
+from taxii_services.message_handlers.base_handlers import BaseMessageHandler
+
+from yeti.messages import CachedMessage, IN_RESPONSE_TO_MARKER, MESSAGE_ID_MARKER
+from yeti.store import SharedGeneration
+
+import libtaxii.messages_11 as tm11
+import libtaxii.messages_10 as tm10
+from libtaxii.constants import *
+
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save
+import threading
+import time
+
+#: taxii_services models that hold content rather than configuration.
+#: Changes to them never change a cached response.
+CONTENT_MODELS = (models.ContentBlock, models.InboxMessage, models.ResultSet,
+                  models.ResultSetPart, models.Subscription, models.DataCollection.content_blocks.through)
+
+
+class ResponseCache(object):
+    """
+    Per-process cache of CachedMessages. It is cleared whenever TAXII configuration
+    (any taxii_services model other than CONTENT_MODELS) is saved or deleted in this process,
+    within YETI_STORE_CHECK_INTERVAL seconds of it being changed by another process that
+    shares the store (see yeti.store), and at least every YETI_RESPONSE_CACHE_TTL seconds.
+    """
+
+    def __init__(self):
+        self._messages = {}
+        self._cleared_at = time.time()
+        self._lock = threading.Lock()
+        self._generation = SharedGeneration('response-cache')
+
+    def get(self, key, get_message):
+        """
+        Returns the CachedMessage for key, creating it from
+        the libtaxii message returned by get_message() if needed.
+
+        get_message() must use MESSAGE_ID_MARKER and IN_RESPONSE_TO_MARKER
+        as the message_id and in_response_to of the message.
+        """
+        if self._generation.changed() or time.time() - self._cleared_at >= settings.YETI_RESPONSE_CACHE_TTL:
+            self.invalidate()
+
+        message = self._messages.get(key)
+        if message is None:
+            with self._lock:
+                message = self._messages.get(key)
+                if message is None:
+                    message = CachedMessage.from_message(get_message())
+                    self._messages[key] = message
+        return message
+
+    def invalidate(self, **kwargs):
+        """
+        Drops every cached message
+        """
+        self._messages = {}
+        self._cleared_at = time.time()
+
+    def invalidate_on_change(self, sender, **kwargs):
+        """
+        post_save, post_delete and m2m_changed handler
+        """
+        if sender._meta.app_label != 'taxii_services' or issubclass(sender, CONTENT_MODELS):
+            return
+        if kwargs.get('action', 'post_').startswith('post_'):
+            self.invalidate()
+            self._generation.bump()
+
+
+#: The cache used by the handlers in this module
+response_cache = ResponseCache()
+
+post_save.connect(response_cache.invalidate_on_change, dispatch_uid='yeti.cached_handlers.save')
+post_delete.connect(response_cache.invalidate_on_change, dispatch_uid='yeti.cached_handlers.delete')
+m2m_changed.connect(response_cache.invalidate_on_change, dispatch_uid='yeti.cached_handlers.m2m')
+
+
+def get_cached_response(service, request, to_response):
+    """
+    Returns the CachedMessage made by to_response(service, in_response_to),
+    bound to request.
+
+    Arguments:
+        service - A TAXII Service model object
+        request - The libtaxii request message
+        to_response - An unbound TAXII Service model method (e.g.,
+            models.DiscoveryService.to_discovery_response_11)
+    """
+    def get_message():
+        message = to_response(service, IN_RESPONSE_TO_MARKER)
+        message.message_id = MESSAGE_ID_MARKER
+        return message
+
+    key = (service.__class__.__name__, service.pk, to_response.__name__)
+    return response_cache.get(key, get_message).bind(request.message_id)
+
+
+class CachedDiscoveryRequest11Handler(BaseMessageHandler):
+    """
+    TAXII 1.1 Discovery Request Handler that serves a cached Discovery Response.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+    supported_request_messages = [tm11.DiscoveryRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(discovery_service, discovery_request, django_request):
+        """
+        Returns the cached result of `DiscoveryService.to_discovery_response_11()`
+        """
+        return get_cached_response(discovery_service, discovery_request,
+                                   models.DiscoveryService.to_discovery_response_11)
+
+
+class CachedDiscoveryRequest10Handler(BaseMessageHandler):
+    """
+    TAXII 1.0 Discovery Request Handler that serves a cached Discovery Response.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+    supported_request_messages = [tm10.DiscoveryRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(discovery_service, discovery_request, django_request):
+        """
+        Returns the cached result of `DiscoveryService.to_discovery_response_10()`
+        """
+        return get_cached_response(discovery_service, discovery_request,
+                                   models.DiscoveryService.to_discovery_response_10)
+
+
+class CachedDiscoveryRequestHandler(BaseMessageHandler):
+    """
+    TAXII 1.1 and TAXII 1.0 Discovery Request Handler that serves cached Discovery Responses.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+    supported_request_messages = [tm10.DiscoveryRequest, tm11.DiscoveryRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(discovery_service, discovery_request, django_request):
+        """
+        Passes the message off to either CachedDiscoveryRequest10Handler or CachedDiscoveryRequest11Handler
+        """
+        if isinstance(discovery_request, tm10.DiscoveryRequest):
+            return CachedDiscoveryRequest10Handler.handle_message(discovery_service, discovery_request, django_request)
+        elif isinstance(discovery_request, tm11.DiscoveryRequest):
+            return CachedDiscoveryRequest11Handler.handle_message(discovery_service, discovery_request, django_request)
+        else:
+            raise StatusMessageException(discovery_request.message_id,
+                                         ST_FAILURE,
+                                         "TAXII Message not supported by Message Handler.")
+
+
+class CachedCollectionInformationRequest11Handler(BaseMessageHandler):
+    """
+    TAXII 1.1 Collection Information Request Handler that serves a cached Collection Information Response.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+    supported_request_messages = [tm11.CollectionInformationRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(collection_management_service, collection_information_request, django_request):
+        """
+        Returns the cached result of `CollectionManagementService.to_collection_information_response_11()`
+        """
+        return get_cached_response(collection_management_service, collection_information_request,
+                                   models.CollectionManagementService.to_collection_information_response_11)
+
+
+class CachedFeedInformationRequest10Handler(BaseMessageHandler):
+    """
+    TAXII 1.0 Feed Information Request Handler that serves a cached Feed Information Response.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+    supported_request_messages = [tm10.FeedInformationRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(collection_management_service, feed_information_request, django_request):
+        """
+        Returns the cached result of `CollectionManagementService.to_feed_information_response_10()`
+        """
+        return get_cached_response(collection_management_service, feed_information_request,
+                                   models.CollectionManagementService.to_feed_information_response_10)
+
+
+class CachedCollectionInformationRequestHandler(BaseMessageHandler):
+    """
+    TAXII 1.1 and 1.0 Collection/Feed Information Request Handler that serves cached responses.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+    supported_request_messages = [tm10.FeedInformationRequest, tm11.CollectionInformationRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(collection_management_service, collection_information_request, django_request):
+        """
+        Passes the request to either CachedFeedInformationRequest10Handler
+        or CachedCollectionInformationRequest11Handler.
+        """
+        cms = collection_management_service
+        cir = collection_information_request
+        dr = django_request
+
+        if isinstance(collection_information_request, tm10.FeedInformationRequest):
+            return CachedFeedInformationRequest10Handler.handle_message(cms, cir, dr)
+        elif isinstance(collection_information_request, tm11.CollectionInformationRequest):
+            return CachedCollectionInformationRequest11Handler.handle_message(cms, cir, dr)
+        else:
+            raise StatusMessageException(collection_information_request.message_id,
+                                         ST_FAILURE,
+                                         "TAXII Message not supported by Message Handler.")
@@ -0,0 +1,122 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# An in-process cache of parsed content, so that the content blocks many
+# subscribers poll with a Default Query are parsed once instead of on every
+# poll. It is filled when content is saved (see yeti.models.extract_content_fields)
+# and when a query evaluates content that is not in it.
+
+from taxii_services.models import ContentBlock
+
+from libtaxii.common import get_xml_parser
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from collections import OrderedDict
+from lxml import etree
+import thread
+import threading
+
+
+class ContentTreeCache(object):
+    """
+    Per-process LRU cache of the parsed content of ContentBlocks, keyed by
+    content block id. It holds the trees of at most YETI_CONTENT_TREE_CACHE_SIZE
+    bytes of content. A tree is only returned for the content it was parsed
+    from, so content changed by another process is parsed again.
+
+    lxml trees must not be used by two threads at once, so each tree is only
+    returned to the thread that parsed it; other threads parse their own copy.
+    """
+
+    def __init__(self):
+        self._trees = OrderedDict()  # (thread id, content block id): (content, tree)
+        self._threads = {}  # Content block id: set of the ids of the threads that cached it
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, content_block_id, content):
+        """
+        Returns the root element of content (a string) parsed the way
+        libtaxii.common.parse() parses it, from the cache if the content
+        of content_block_id has been parsed before by the calling thread.
+
+        Raises:
+            etree.XMLSyntaxError or ValueError if content cannot be parsed
+        """
+        key = (thread.get_ident(), content_block_id)
+        with self._lock:
+            entry = self._trees.get(key)
+            if entry is not None and entry[0] == content:
+                del self._trees[key]
+                self._trees[key] = entry  # Now the most recently used
+                return entry[1]
+
+        tree = etree.XML(content, get_xml_parser())
+        self.put(content_block_id, content, tree)
+        return tree
+
+    def put(self, content_block_id, content, tree):
+        """
+        Caches the parsed content of a content block, for the calling thread
+        """
+        max_size = settings.YETI_CONTENT_TREE_CACHE_SIZE
+        if content_block_id is None or len(content) > max_size:
+            return
+
+        key = (thread.get_ident(), content_block_id)
+        with self._lock:
+            self._remove(key)
+            self._trees[key] = (content, tree)
+            self._threads.setdefault(content_block_id, set()).add(key[0])
+            self._size += len(content)
+            while self._size > max_size:
+                self._remove(next(iter(self._trees)))
+
+    def _remove(self, key):
+        entry = self._trees.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+            thread_ids = self._threads[key[1]]
+            thread_ids.discard(key[0])
+            if not thread_ids:
+                del self._threads[key[1]]
+
+    def invalidate(self, content_block_id):
+        """
+        Drops the parsed content of a content block, in every thread
+        """
+        with self._lock:
+            for thread_id in list(self._threads.get(content_block_id, ())):
+                self._remove((thread_id, content_block_id))
+
+    def invalidate_on_change(self, sender, **kwargs):
+        """
+        post_save and post_delete handler
+        """
+        if not kwargs.get('created'):
+            self.invalidate(kwargs['instance'].pk)
+
+    def clear(self):
+        """
+        Drops every cached tree
+        """
+        with self._lock:
+            self._trees = OrderedDict()
+            self._threads = {}
+            self._size = 0
+
+    def __contains__(self, content_block_id):
+        return (thread.get_ident(), content_block_id) in self._trees
+
+    def __len__(self):
+        return len(self._trees)
+
+
+#: The cache used by yeti.models and yeti.query_handlers
+content_tree_cache = ContentTreeCache()
+
+post_save.connect(content_tree_cache.invalidate_on_change, sender=ContentBlock,
+                  dispatch_uid='yeti.content_cache.save')
+post_delete.connect(content_tree_cache.invalidate_on_change, sender=ContentBlock,
+                    dispatch_uid='yeti.content_cache.delete')
@@ -0,0 +1,225 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# Content-addressed storage of content block payloads. The same STIX package
+# often arrives through several Inbox Services and into several Data
+# Collections; with YETI_CONTENT_STORE set, each distinct payload is stored
+# once, compressed, as a yeti.models.ContentBlob keyed by the SHA-256 digest of
+# its bytes, either in the database or in a sharded directory of files. This
+# module has the digest, the codecs and the file store; yeti.models moves
+# content in and out of the store.
+#
+# The file store can also keep each payload already serialized as the XML
+# of a TAXII Content element. Poll Responses splice those files in from
+# memory maps instead of parsing each payload and serializing it again.
+
+from libtaxii.common import parse
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from lxml import etree
+from StringIO import StringIO
+import errno
+import hashlib
+import mmap
+import os
+import tempfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+#: Values of YETI_CONTENT_STORE
+STORE_DATABASE = 'database'
+STORE_FILE = 'file'
+
+#: Values of YETI_CONTENT_COMPRESSION, and of ContentBlob.compression
+COMPRESSION_NONE = ''
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_ZSTD = 'zstd'
+
+#: Bytes of a serialized payload read from its memory map at a time
+SPLICE_CHUNK_SIZE = 64 * 1024
+
+
+def get_digest(data):
+    """
+    Returns the hex SHA-256 digest of a payload (a byte string)
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def compress(data, compression=None):
+    """
+    Returns a tuple of (compression, compressed data) for a payload, compressed
+    with YETI_CONTENT_COMPRESSION unless compression is given. Payloads that
+    would not get smaller are returned uncompressed, with COMPRESSION_NONE.
+    """
+    if compression is None:
+        compression = settings.YETI_CONTENT_COMPRESSION or COMPRESSION_NONE
+
+    if compression == COMPRESSION_NONE:
+        return COMPRESSION_NONE, data
+    elif compression == COMPRESSION_ZLIB:
+        compressed = zlib.compress(data)
+    elif compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ImproperlyConfigured("YETI_CONTENT_COMPRESSION is 'zstd', but the zstandard package is not installed")
+        compressed = zstandard.ZstdCompressor().compress(data)
+    else:
+        raise ImproperlyConfigured("Unsupported YETI_CONTENT_COMPRESSION: %s" % compression)
+
+    if len(compressed) >= len(data):
+        return COMPRESSION_NONE, data
+    return compression, compressed
+
+
+def decompress(compression, data):
+    """
+    Returns the payload of data compressed with compression
+    """
+    if compression == COMPRESSION_NONE:
+        return data
+    elif compression == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    elif compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ImproperlyConfigured("Content is compressed with zstd, but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown content compression: %s" % compression)
+
+
+def serialize_content(content):
+    """
+    Returns the XML that libtaxii writes inside a Content element for content:
+    the content itself if it is well-formed XML, otherwise the content as escaped text
+    """
+    element = etree.Element('Content')
+    try:
+        element.append(parse(StringIO(content)))
+    except etree.XMLSyntaxError:  # Not XML, like libtaxii's ContentBlock._stringify_content()
+        element.text = content.decode('utf-8') if isinstance(content, str) else content
+    xml = etree.tostring(element)
+    if xml.endswith('/>'):
+        return ''
+    return xml[len('<Content>'):-len('</Content>')]
+
+
+class SerializedContent(object):
+    """
+    The serialized XML of a payload in the file store. Iterating over it yields
+    the XML in chunks, read from a memory map of its file.
+    """
+
+    def __init__(self, file_store, digest, compression):
+        self.file_store = file_store
+        self.digest = digest
+        self.compression = compression
+
+    def __iter__(self):
+        return self.file_store.iter_serialized(self.digest)
+
+    def open(self):
+        """
+        Returns an iterator over the XML, with its file already open and
+        mapped, or None if the file store no longer has the file
+        """
+        try:
+            return iter(self)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def get_content(self):
+        """
+        Returns the payload (unicode), read from the file store
+        """
+        return decompress(self.compression, self.file_store.get(self.digest)).decode('utf-8')
+
+
+class BlobFileStore(object):
+    """
+    Stores compressed payloads as files named by their digest, two directory
+    levels deep (ab/cd/abcd...) so no directory holds too many files. Files
+    are written to a temporary name and renamed into place, so a reader never
+    sees a partial file, and a payload that is already stored is not written again.
+    The serialized XML of a payload, if kept, is next to it with an .xml suffix.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:4], digest)
+
+    def get_serialized_path(self, digest):
+        return self.get_path(digest) + '.xml'
+
+    def put(self, digest, data):
+        self._write(self.get_path(digest), data)
+
+    def put_serialized(self, digest, xml):
+        self._write(self.get_serialized_path(digest), xml)
+
+    def _write(self, path, data):
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path)[:8])
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get(self, digest):
+        with open(self.get_path(digest), 'rb') as f:
+            return f.read()
+
+    def iter_serialized(self, digest, chunk_size=SPLICE_CHUNK_SIZE):
+        """
+        Returns an iterator over the serialized XML of a payload in chunks, sliced
+        from a read-only memory map of its file, so it goes from the page cache
+        to the response without passing through a read buffer. The file is opened
+        and mapped before this returns, so a missing file raises IOError here
+        rather than part way through a response.
+        """
+        with open(self.get_serialized_path(digest), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:  # Empty files cannot be mapped
+                return iter(())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._iter_mapped(mapped, size, chunk_size)
+
+    def _iter_mapped(self, mapped, size, chunk_size):
+        try:
+            for offset in xrange(0, size, chunk_size):
+                yield mapped[offset:offset + chunk_size]
+        finally:
+            mapped.close()
+
+    def delete(self, digest):
+        for path in (self.get_path(digest), self.get_serialized_path(digest)):
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def get_file_store():
+    """
+    Returns the BlobFileStore at YETI_CONTENT_STORE_PATH
+    """
+    return BlobFileStore(settings.YETI_CONTENT_STORE_PATH)
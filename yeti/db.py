@@ -0,0 +1,28 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# Database connection setup for the profiles in yeti/settings.py
+
+from django.conf import settings
+from django.db import connection
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    connection_created handler that runs settings.YETI_SQLITE_PRAGMAS
+    on every new SQLite connection
+    """
+    if connection.vendor != 'sqlite' or not settings.YETI_SQLITE_PRAGMAS:
+        return
+
+    cursor = connection.cursor()
+    for pragma in settings.YETI_SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA %s' % pragma)
+    cursor.close()
+
+
+def close_db_connection():
+    """
+    Initializer of multiprocessing pools. A forked worker must not share the parent's database connection.
+    """
+    connection.close()
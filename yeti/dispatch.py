@@ -0,0 +1,81 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# YETI's WSGI application. TAXII clients never use sessions, CSRF tokens,
+# messages or logins, so requests for TAXII Services skip the browser
+# middleware in MIDDLEWARE_CLASSES and only run YETI_SERVICE_MIDDLEWARE_CLASSES.
+# Everything else (the index page and /admin/) runs the full middleware stack.
+
+import django
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.wsgi import WSGIHandler
+from django.utils.module_loading import import_string
+
+
+class ServiceWSGIHandler(WSGIHandler):
+    """
+    A Django WSGIHandler that runs YETI_SERVICE_MIDDLEWARE_CLASSES
+    instead of MIDDLEWARE_CLASSES
+    """
+
+    def load_middleware(self):
+        """
+        Same as django.core.handlers.base.BaseHandler.load_middleware(),
+        but reads settings.YETI_SERVICE_MIDDLEWARE_CLASSES
+        """
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._response_middleware = []
+        self._exception_middleware = []
+
+        request_middleware = []
+        for middleware_path in settings.YETI_SERVICE_MIDDLEWARE_CLASSES:
+            mw_class = import_string(middleware_path)
+            try:
+                mw_instance = mw_class()
+            except MiddlewareNotUsed:
+                continue
+
+            if hasattr(mw_instance, 'process_request'):
+                request_middleware.append(mw_instance.process_request)
+            if hasattr(mw_instance, 'process_view'):
+                self._view_middleware.append(mw_instance.process_view)
+            if hasattr(mw_instance, 'process_template_response'):
+                self._template_response_middleware.insert(0, mw_instance.process_template_response)
+            if hasattr(mw_instance, 'process_response'):
+                self._response_middleware.insert(0, mw_instance.process_response)
+            if hasattr(mw_instance, 'process_exception'):
+                self._exception_middleware.insert(0, mw_instance.process_exception)
+
+        # Assigned last, since Django uses it as the "middleware is loaded" flag
+        self._request_middleware = request_middleware
+
+
+class ServiceDispatcher(object):
+    """
+    A WSGI application that passes requests whose path starts with
+    YETI_SERVICE_PATH_PREFIX to a ServiceWSGIHandler, and all
+    other requests to Django's WSGIHandler.
+    """
+
+    def __init__(self):
+        self.service_handler = ServiceWSGIHandler()
+        self.handler = WSGIHandler()
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '').startswith(settings.YETI_SERVICE_PATH_PREFIX):
+            return self.service_handler(environ, start_response)
+        return self.handler(environ, start_response)
+
+
+def get_wsgi_application():
+    """
+    Like django.core.wsgi.get_wsgi_application(), but returns a ServiceDispatcher.
+    Also starts the query pool (see yeti.query_handlers.start_query_pool),
+    before the server starts any threads.
+    """
+    django.setup()
+    from yeti.query_handlers import start_query_pool  # It imports yeti.models, which needs the app registry
+    start_query_pool()
+    return ServiceDispatcher()
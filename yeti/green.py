@@ -0,0 +1,189 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# A gevent front end for YETI's WSGI application (see the run_green_server
+# management command). Each connection is served by a greenlet, which reads the
+# request body and writes the response, so a slow client only holds a greenlet.
+# Django (routing, the message handlers and the database) runs in a pool of
+# YETI_GREEN_THREADS threads, which only hold a request while it is handled, or
+# while the next chunk of a streaming response is produced. Long polls (see
+# yeti.poll_handlers.WaitingPollRequest11Handler) wait for new content in their
+# greenlet too. Nothing is monkey patched, so Django and the database drivers
+# run as they do under any other threaded WSGI server.
+
+from yeti.notify import WaitForContent, content_notifier
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from StringIO import StringIO
+import logging
+import time
+
+try:
+    import gevent
+    from gevent.event import Event
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    gevent = None
+
+log = logging.getLogger(__name__)
+
+
+def read_body(environ):
+    """
+    Reads the request body in the calling greenlet, and replaces wsgi.input
+    with it. Bodies larger than YETI_MAX_MESSAGE_SIZE are not read, so that
+    yeti.parsing can refuse them by their Content-Length.
+
+    Returns the body
+    """
+    max_size = settings.YETI_MAX_MESSAGE_SIZE
+    body = ''
+    if environ.get('CONTENT_LENGTH'):
+        try:
+            content_length = int(environ['CONTENT_LENGTH'])
+        except ValueError:
+            content_length = 0
+        if 0 < content_length <= max_size:
+            body = environ['wsgi.input'].read(content_length)
+    elif 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+        body = environ['wsgi.input'].read(max_size + 1)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        if len(body) > max_size:
+            body = ''
+    environ['wsgi.input'] = StringIO(body)
+    return body
+
+
+def read_chunks(iterator, size):
+    """
+    Returns the next chunks of iterator, up to the first that brings
+    their total length to size. Returns an empty list at the end.
+    """
+    chunks = []
+    total = 0
+    for chunk in iterator:
+        chunks.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            break
+    return chunks
+
+
+class GreenApplication(object):
+    """
+    A WSGI application for gevent's WSGIServer that runs a (blocking) WSGI
+    application in a pool of threads
+    """
+
+    def __init__(self, application, threads=None):
+        if gevent is None:
+            raise ImproperlyConfigured("YETI's gevent front end requires the gevent package")
+        self.application = application
+        self.pool = ThreadPool(threads or settings.YETI_GREEN_THREADS)
+        self.content_changed = None  # Set (and replaced) each time a Data Collection gets new content
+
+    def __call__(self, environ, start_response):
+        body = read_body(environ)
+        environ['yeti.green'] = True
+        while True:
+            result = self.pool.apply(self.call_application, (dict(environ, **{'wsgi.input': StringIO(body)}),))
+            if not isinstance(result, WaitForContent):
+                break
+            self.wait_for_content(result)
+            environ['yeti.poll_deadline'] = result.deadline
+
+        status, headers, body = result
+        start_response(status, headers)
+        return body
+
+    def call_application(self, environ):
+        """
+        Calls the application in a pool thread. A response that is not
+        streamed is read, and closed, in the same thread.
+        """
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        response = self.application(environ, start_response)
+        wait = getattr(response, 'wait_for_content', None)  # A yeti.views.WaitingHttpResponse
+        if wait is not None:
+            response.close()
+            return wait
+
+        if getattr(response, 'streaming', False):
+            return started[0], started[1], self.iter_response(response)
+
+        try:
+            body = list(response)
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        return started[0], started[1], body
+
+    def wait_for_content(self, wait):
+        """
+        Waits, in the calling greenlet, until the counter of new content in
+        a Data Collection changes (see yeti.notify), or until the deadline of
+        a yeti.notify.WaitForContent
+        """
+        if self.content_changed is None:
+            loop = gevent.get_hub().loop
+            watcher = getattr(loop, 'async_', None) or getattr(loop, 'async')  # Renamed in gevent 1.3
+            self.content_watcher = watcher()
+            self.content_watcher.start(self.set_content_changed)
+            self.content_changed = Event()
+            content_notifier.add_listener(self.content_watcher.send)  # Wakes the hub from any thread
+
+        while True:
+            content_changed = self.content_changed
+            if content_notifier.peek(wait.collection_name) != wait.generation:
+                return
+            remaining = wait.deadline - time.time()
+            if remaining <= 0:
+                return
+            content_changed.wait(remaining)
+
+    def set_content_changed(self):
+        content_changed, self.content_changed = self.content_changed, Event()
+        content_changed.set()
+
+    def iter_response(self, response):
+        """
+        Yields a streaming response in pieces of about YETI_GREEN_CHUNK_SIZE
+        bytes, each produced in a pool thread. The next piece is not produced
+        until the previous one has been written to the client.
+        """
+        iterator = iter(response)
+        try:
+            while True:
+                chunks = self.pool.apply(read_chunks, (iterator, settings.YETI_GREEN_CHUNK_SIZE))
+                if not chunks:
+                    break
+                yield ''.join(chunks)
+        finally:  # Also run if the client goes away
+            if hasattr(response, 'close'):
+                self.pool.apply(response.close)
+
+
+def get_server(listener, application=None, threads=None, connections=None):
+    """
+    Returns a gevent WSGIServer that serves application (by default, YETI's
+    WSGI application) on listener, an (address, port) tuple or socket, with
+    a GreenApplication of threads threads, to at most connections clients
+    at a time
+    """
+    if gevent is None:
+        raise ImproperlyConfigured("YETI's gevent front end requires the gevent package")
+
+    if application is None:
+        from yeti.dispatch import get_wsgi_application
+        application = get_wsgi_application()
+
+    return WSGIServer(listener, GreenApplication(application, threads),
+                      spawn=Pool(connections or settings.YETI_GREEN_MAX_CONNECTIONS),
+                      log=log, error_log=log)
@@ -0,0 +1,366 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.exceptions import StatusMessageException
+from taxii_services.message_handlers.base_handlers import BaseMessageHandler
+from taxii_services.message_handlers.inbox_message_handlers import InboxMessage10Handler, InboxMessage11Handler
+from taxii_services.models import ContentBindingAndSubtype, ContentBlock, DataCollection, InboxMessage
+
+from yeti.matching import queue_matching_content
+from yeti.models import (CollectionMembership, ContentDigest, add_collection_counts, chunks, index_content_fields,
+                         store_content)
+from yeti.notify import content_notifier
+from yeti.spool import inbox_spool
+
+import libtaxii.messages_11 as tm11
+import libtaxii.messages_10 as tm10
+from libtaxii.constants import *
+from libtaxii.common import generate_message_id
+
+from collections import OrderedDict
+from django.db import IntegrityError, transaction
+import copy
+
+#: Number of times an Inbox Message is saved before giving up on IntegrityErrors
+SAVE_ATTEMPTS = 3
+
+
+class ContentBindingLookup(object):
+    """
+    Finds the ContentBindingAndSubtype of each content block in an Inbox Message,
+    and which of the Inbox Service's and destination Data Collections support it,
+    with one set of queries per distinct content binding instead of per content block.
+    """
+
+    def __init__(self, inbox_service, collections):
+        self.inbox_service = inbox_service
+        self.collections = collections
+        self._cbas = {}
+        self._support = {}
+
+    def get_cbas(self, binding_id, subtype_id=None):
+        """
+        Returns the ContentBindingAndSubtype for binding_id and subtype_id,
+        or None if it is not in the database
+        """
+        key = (binding_id, subtype_id)
+        if key not in self._cbas:
+            try:
+                self._cbas[key] = ContentBindingAndSubtype.objects.get(content_binding__binding_id=binding_id,
+                                                                       subtype__subtype_id=subtype_id)
+            except ContentBindingAndSubtype.DoesNotExist:
+                self._cbas[key] = None
+        return self._cbas[key]
+
+    def get_support(self, cbas):
+        """
+        Returns a tuple of (whether the Inbox Service supports cbas,
+        list of the destination Data Collections that support cbas)
+        """
+        if cbas.pk not in self._support:
+            inbox_supported = self.inbox_service.is_content_supported(cbas).is_supported
+            supporting_collections = [collection for collection in self.collections
+                                      if collection.is_content_supported(cbas).is_supported]
+            self._support[cbas.pk] = (inbox_supported, supporting_collections)
+        return self._support[cbas.pk]
+
+
+def create_inbox_message_db(from_inbox_message, inbox_message, django_request, inbox_service):
+    """
+    Returns an unsaved models.InboxMessage made by from_inbox_message
+    (models.InboxMessage.from_inbox_message_11 or from_inbox_message_10).
+    Its original_message is the request body, instead of the whole Inbox
+    Message serialized again by libtaxii.
+    """
+    header = copy.copy(inbox_message)
+    header.content_blocks = []
+    inbox_message_db = from_inbox_message(header, django_request, received_via=inbox_service)
+    inbox_message_db.original_message = django_request.body
+    inbox_message_db.content_block_count = len(inbox_message.content_blocks)
+    return inbox_message_db
+
+
+def bulk_save_content_blocks(inbox_message_db, content_blocks):
+    """
+    Saves the content blocks of one Inbox Message and adds them to their
+    Data Collections, with one bulk insert per table. Should be called inside
+    a transaction.
+
+    Content blocks whose yeti.models.ContentDigest matches content that is
+    already in all of their Data Collections (or earlier in the same message)
+    are not saved again. Content that is new to any of its Data Collections is
+    saved as a new content block, with a new timestamp label, so that clients
+    polling those Data Collections since their last poll get it; its digest is
+    moved to the new content block. If another transaction saves the same content
+    first, an IntegrityError is raised (see save_inbox_message()).
+
+    Arguments:
+        inbox_message_db (models.InboxMessage) - The saved InboxMessage the content blocks arrived in
+        content_blocks - A list of (unsaved models.ContentBlock, list of models.DataCollection) tuples
+
+    Returns:
+        The number of content blocks saved
+    """
+    digests = [ContentDigest.get_digest(cb.content_binding_and_subtype_id, cb.content)
+               for cb, collections in content_blocks]
+
+    # Map each known digest to the id of the content block that has it
+    known = {}
+    for chunk in chunks(set(digests)):
+        known.update(ContentDigest.objects.filter(digest__in=chunk).values_list('digest', 'content_block'))
+    through = DataCollection.content_blocks.through
+    contained = set()  # (DataCollection pk, ContentBlock pk) of the known content blocks
+    for chunk in chunks(set(known.values())):
+        contained.update(through.objects.filter(contentblock__in=chunk).values_list('datacollection', 'contentblock'))
+
+    new_blocks = OrderedDict()  # Digest: unsaved content block, in the order they arrived
+    new_collections = {}  # Digest: pks of the Data Collections its new content block is added to
+    for (cb, collections), digest in zip(content_blocks, digests):
+        missing = set(collection.pk for collection in collections
+                      if (collection.pk, known.get(digest)) not in contained)
+        if digest in new_blocks:
+            new_collections[digest].update(missing)
+            continue
+        if digest in known and not missing:
+            continue
+        cb.pk = None  # Set by an earlier attempt to save the message (see save_inbox_message())
+        cb.inbox_message = inbox_message_db
+        new_blocks[digest] = cb
+        new_collections[digest] = missing
+
+    ContentBlock.objects.bulk_create(new_blocks.values())
+    # Django 1.7's bulk_create() does not set primary keys, so the new content blocks are matched by their digest
+    saved = (ContentBlock.objects.filter(inbox_message=inbox_message_db)
+                                 .values_list('pk', 'content_binding_and_subtype', 'content'))
+    for pk, cbas_id, content in saved.iterator():
+        new_blocks[ContentDigest.get_digest(cbas_id, content)].pk = pk
+
+    ContentDigest.objects.bulk_create([ContentDigest(content_block_id=cb.pk, digest=digest)
+                                       for digest, cb in new_blocks.items() if digest not in known])
+    for digest, cb in new_blocks.items():
+        if digest in known:
+            moved = ContentDigest.objects.filter(digest=digest, content_block=known[digest]).update(
+                content_block=cb.pk)
+            if not moved:  # Another transaction saved this content again first
+                raise IntegrityError("Content Digest %s was moved by another Inbox Message" % digest)
+    # bulk_create() does not send post_save, so the query index is written here
+    index_content_fields(new_blocks.values())
+
+    # Bulk inserts into the through table do not send m2m_changed, so the CollectionMembership
+    # index, its CollectionCounts and push subscription queues are written here too
+    links = sorted((collection_id, cb.pk) for digest, cb in new_blocks.items()
+                   for collection_id in new_collections[digest])
+    through.objects.bulk_create([through(datacollection_id=collection_id, contentblock_id=content_block_id)
+                                 for collection_id, content_block_id in links])
+    labels = dict((cb.pk, (cb.timestamp_label, cb.content_binding_and_subtype_id)) for cb in new_blocks.values())
+    memberships = [CollectionMembership(collection_id=collection_id,
+                                        content_block_id=content_block_id,
+                                        timestamp_label=labels[content_block_id][0],
+                                        content_binding_and_subtype_id=labels[content_block_id][1])
+                   for collection_id, content_block_id in links]
+    CollectionMembership.objects.bulk_create(memberships)
+    add_collection_counts(memberships)
+    queue_matching_content(memberships, dict((cb.pk, cb.content) for cb in new_blocks.values()))
+    # Last, since everything above reads the content of the new blocks
+    store_content(new_blocks.values())
+
+    return len(new_blocks)
+
+
+def save_inbox_message(from_inbox_message, inbox_message, django_request, inbox_service, content_blocks):
+    """
+    Saves an InboxMessage (see create_inbox_message_db()) and its content blocks
+    (see bulk_save_content_blocks()) in one transaction. When another Inbox Message
+    commits some of the same content first, the unique ContentDigest fails the
+    transaction; it is then tried again, and finds that content already saved.
+
+    Returns:
+        The saved models.InboxMessage
+    """
+    for attempt in range(SAVE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                inbox_message_db = create_inbox_message_db(from_inbox_message,
+                                                           inbox_message,
+                                                           django_request,
+                                                           inbox_service)
+                inbox_message_db.save()
+                inbox_message_db.content_blocks_saved = bulk_save_content_blocks(inbox_message_db, content_blocks)
+                inbox_message_db.save()
+            return inbox_message_db
+        except IntegrityError:
+            if attempt == SAVE_ATTEMPTS - 1:
+                raise
+
+
+def publish_content(content_blocks):
+    """
+    Wakes the long polls of the Data Collections that content_blocks
+    (as passed to bulk_save_content_blocks) were added to. Should be
+    called once they are committed.
+    """
+    content_notifier.publish(set(collection.name for cb, collections in content_blocks for collection in collections))
+
+
+class BulkInboxMessage11Handler(InboxMessage11Handler):
+    """
+    TAXII 1.1 Inbox Message Handler that saves a whole Inbox Message
+    in one transaction, with one bulk insert per table, and skips
+    content that has already been received.
+    """
+
+    supported_request_messages = [tm11.InboxMessage]
+    version = "1"
+
+    @classmethod
+    def handle_message(cls, inbox_service, inbox_message, django_request):
+        """
+        Attempts to save all Content Blocks in the Inbox Message into the
+        database.
+
+        Workflow:
+            #. Validate the request's Destination Collection Names against the InboxService model
+            #. Build an unsaved models.ContentBlock for each Content Block that the Inbox Service
+               or a destination collection supports
+            #. In one transaction, save an InboxMessage model object for bookkeeping
+               and the content blocks (see `save_inbox_message()`)
+            #. Wake the long polls of the destination collections (see `publish_content()`)
+            #. Return Status Message with a Status Type of Success
+
+        Raises:
+            A StatusMessageException for errors
+        """
+        collections = inbox_service.validate_destination_collection_names(inbox_message.destination_collection_names,
+                                                                          inbox_message.message_id)
+        lookup = ContentBindingLookup(inbox_service, collections)
+
+        content_blocks = []
+        for content_block in inbox_message.content_blocks:
+            subtype_id = None
+            if content_block.content_binding.subtype_ids:
+                subtype_id = content_block.content_binding.subtype_ids[0]
+            cbas = lookup.get_cbas(content_block.content_binding.binding_id, subtype_id)
+            if cbas is None:  # Nothing can support an unknown content binding
+                continue
+
+            inbox_supported, supporting_collections = lookup.get_support(cbas)
+            if len(supporting_collections) == 0 and not inbox_supported:
+                # There's nothing to add this content block to
+                continue
+
+            cb = ContentBlock(content_binding_and_subtype=cbas,
+                              content=content_block.content,
+                              padding=content_block.padding or '',
+                              message=content_block.message or '')
+            content_blocks.append((cb, supporting_collections))
+
+        save_inbox_message(InboxMessage.from_inbox_message_11, inbox_message, django_request, inbox_service,
+                           content_blocks)
+        publish_content(content_blocks)
+
+        status_message = tm11.StatusMessage(message_id=generate_message_id(),
+                                            in_response_to=inbox_message.message_id,
+                                            status_type=ST_SUCCESS)
+        return status_message
+
+
+class BulkInboxMessage10Handler(InboxMessage10Handler):
+    """
+    TAXII 1.0 Inbox Message Handler that saves a whole Inbox Message
+    in one transaction, with one bulk insert per table, and skips
+    content that has already been received.
+    """
+
+    supported_request_messages = [tm10.InboxMessage]
+    version = "1"
+
+    @classmethod
+    def handle_message(cls, inbox_service, inbox_message, django_request):
+        """
+        Saves the Content Blocks that the Inbox Service supports
+        with `save_inbox_message()`.
+        """
+        collections = inbox_service.validate_destination_collection_names(None,  # Inbox 1.0 doesn't have a DCN
+                                                                          inbox_message.message_id)
+        lookup = ContentBindingLookup(inbox_service, collections)
+
+        content_blocks = []
+        for content_block in inbox_message.content_blocks:
+            cbas = lookup.get_cbas(content_block.content_binding)
+            if cbas is None or not lookup.get_support(cbas)[0]:
+                continue
+
+            cb = ContentBlock(content_binding_and_subtype=cbas,
+                              content=content_block.content,
+                              padding=content_block.padding or '')
+            content_blocks.append((cb, []))
+
+        save_inbox_message(InboxMessage.from_inbox_message_10, inbox_message, django_request, inbox_service,
+                           content_blocks)
+
+        status_message = tm10.StatusMessage(message_id=generate_message_id(),
+                                            in_response_to=inbox_message.message_id,
+                                            status_type=ST_SUCCESS)
+        return status_message
+
+
+class BulkInboxMessageHandler(BaseMessageHandler):
+    """
+    TAXII 1.1 and TAXII 1.0 Inbox Message Handler that saves
+    each Inbox Message with bulk inserts and skips duplicate content.
+    """
+
+    supported_request_messages = [tm10.InboxMessage, tm11.InboxMessage]
+    version = "1"
+
+    @staticmethod
+    def handle_message(inbox_service, inbox_message, django_request):
+        """
+        Passes the request to either BulkInboxMessage10Handler or BulkInboxMessage11Handler
+        """
+        if isinstance(inbox_message, tm10.InboxMessage):
+            return BulkInboxMessage10Handler.handle_message(inbox_service, inbox_message, django_request)
+        elif isinstance(inbox_message, tm11.InboxMessage):
+            return BulkInboxMessage11Handler.handle_message(inbox_service, inbox_message, django_request)
+        else:
+            raise StatusMessageException(inbox_message.message_id,
+                                         ST_FAILURE,
+                                         "TAXII Message not supported by Message Handler.")
+
+
+class SpooledInboxMessageHandler(BaseMessageHandler):
+    """
+    TAXII 1.1 and TAXII 1.0 Inbox Message Handler that writes the raw
+    Inbox Message to the yeti.spool.InboxSpool and returns a Status Message
+    of Success right away. The drain_inbox_spool management command saves
+    spooled messages in the background with BulkInboxMessageHandler.
+    """
+
+    supported_request_messages = [tm10.InboxMessage, tm11.InboxMessage]
+    version = "1"
+
+    @staticmethod
+    def handle_message(inbox_service, inbox_message, django_request):
+        """
+        Checks the Destination Collection Names, so that errors are still reported
+        to the sender, then spools the message.
+        """
+        if isinstance(inbox_message, tm11.InboxMessage):
+            inbox_service.validate_destination_collection_names(inbox_message.destination_collection_names,
+                                                                inbox_message.message_id)
+            status_message_class = tm11.StatusMessage
+        elif isinstance(inbox_message, tm10.InboxMessage):
+            status_message_class = tm10.StatusMessage
+        else:
+            raise StatusMessageException(inbox_message.message_id,
+                                         ST_FAILURE,
+                                         "TAXII Message not supported by Message Handler.")
+
+        inbox_spool.put(inbox_service.path,
+                        inbox_message.__module__,
+                        django_request.body,
+                        django_request.META.get('REMOTE_ADDR', None))
+
+        return status_message_class(message_id=generate_message_id(),
+                                    in_response_to=inbox_message.message_id,
+                                    status_type=ST_SUCCESS)
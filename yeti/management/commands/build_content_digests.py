@@ -0,0 +1,54 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.models import ContentBlock
+
+from yeti.models import ContentDigest, chunks, get_stored_content
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+    Backfills yeti.models.ContentDigest for content blocks
+    that were saved before the bulk inbox handlers were used.
+    """
+    help = ("Backfills the Content Digests used by the bulk inbox handlers to skip duplicate content "
+            "from existing Content Blocks.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of content blocks to digest per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        content_blocks = (ContentBlock.objects.filter(contentdigest__isnull=True)
+                                              .order_by('pk')
+                                              .values_list('pk', 'content_binding_and_subtype', 'content'))
+        added = 0
+        last_id = 0
+        while True:
+            batch = list(content_blocks.filter(pk__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            stored = get_stored_content([pk for pk, cbas_id, content in batch if not content])
+            batch = [(pk, cbas_id, stored.get(pk, content)) for pk, cbas_id, content in batch]
+
+            # Digests are unique, so content that is already digested (or earlier
+            # in the batch) keeps the content block it was first saved as
+            digests = {}
+            for pk, cbas_id, content in batch:
+                digests.setdefault(ContentDigest.get_digest(cbas_id, content), pk)
+            with transaction.atomic():
+                for chunk in chunks(digests.keys()):
+                    for digest in ContentDigest.objects.filter(digest__in=chunk).values_list('digest', flat=True):
+                        del digests[digest]
+                ContentDigest.objects.bulk_create([ContentDigest(content_block_id=pk, digest=digest)
+                                                   for digest, pk in digests.items()])
+            added += len(digests)
+
+        self.stdout.write("Digested %s content blocks" % added)
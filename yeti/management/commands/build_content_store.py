@@ -0,0 +1,51 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.models import ContentBlock
+
+from yeti.content_store import STORE_FILE
+from yeti.models import delete_unreferenced_blobs, serialize_stored_content, store_content
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+    Moves content that is still in the ContentBlock table into the
+    content store (see yeti.content_store), serializes stored payloads if
+    YETI_CONTENT_STORE_SERIALIZED is set, and deletes the stored payloads
+    that no content block has any more.
+    """
+    help = ("Moves existing Content Block content into the YETI_CONTENT_STORE and deletes "
+            "stored content that is no longer used.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of content blocks to store per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if settings.YETI_CONTENT_STORE is not None:
+            content_blocks = ContentBlock.objects.exclude(content='').order_by('pk').only('pk', 'content')
+            stored = 0
+            last_id = 0
+            while True:
+                batch = list(content_blocks.filter(pk__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].pk
+
+                with transaction.atomic():
+                    stored += store_content(batch)
+            self.stdout.write("Stored the content of %s content blocks" % stored)
+
+        if settings.YETI_CONTENT_STORE == STORE_FILE and settings.YETI_CONTENT_STORE_SERIALIZED:
+            serialized = serialize_stored_content(batch_size)
+            self.stdout.write("Serialized %s stored payloads" % serialized)
+
+        deleted = delete_unreferenced_blobs()
+        self.stdout.write("Deleted %s unused content blobs" % deleted)
@@ -0,0 +1,64 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.models import DataCollection
+
+from yeti.models import CollectionCount, CollectionMembership, rebuild_collection_counts
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+    Backfills yeti.models.CollectionMembership from the
+    DataCollection.content_blocks relation, and recounts
+    yeti.models.CollectionCount from it.
+    """
+    help = ("Backfills the Collection Membership index used by the indexed poll handlers, "
+            "and its time bucket counts, from existing Data Collection content.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+                    help='Delete the existing index before backfilling it.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of membership rows to insert per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        through = DataCollection.content_blocks.through
+
+        if options['rebuild']:
+            CollectionMembership.objects.all().delete()
+            CollectionCount.objects.all().delete()
+
+        for collection in DataCollection.objects.all():
+            relation = (through.objects.filter(datacollection=collection)
+                                       .order_by('contentblock')
+                                       .values_list('contentblock', 'contentblock__timestamp_label',
+                                                    'contentblock__content_binding_and_subtype'))
+            added = 0
+            last_id = 0
+            while True:
+                batch = list(relation.filter(contentblock__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+
+                existing = set(CollectionMembership.objects.filter(collection=collection,
+                                                                   content_block__in=[row[0] for row in batch])
+                                                           .values_list('content_block_id', flat=True))
+                rows = [CollectionMembership(collection=collection,
+                                             content_block_id=content_block_id,
+                                             timestamp_label=timestamp_label,
+                                             content_binding_and_subtype_id=cbas_id)
+                        for content_block_id, timestamp_label, cbas_id in batch
+                        if content_block_id not in existing]
+                with transaction.atomic():
+                    CollectionMembership.objects.bulk_create(rows)
+                added += len(rows)
+
+            rebuild_collection_counts(collection)
+            self.stdout.write("%s: indexed %s content blocks" % (collection.name, added))
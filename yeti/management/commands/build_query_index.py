@@ -0,0 +1,55 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.models import ContentBlock
+
+from yeti.models import (ContentField, IndexedContentBlock, attach_stored_content, get_indexed_targets_digest,
+                         index_content_fields)
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+    Extracts yeti.models.ContentFields from content blocks that were saved
+    before YETI_INDEXED_TARGETS last changed, or without the post_save signal.
+    """
+    help = ("Builds the Content Field index used by yeti.query_handlers for YETI_INDEXED_TARGETS "
+            "from existing Content Blocks.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of content blocks to index per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        targets_digest = get_indexed_targets_digest()
+        current = IndexedContentBlock.objects.filter(targets_digest=targets_digest)
+
+        # Drop what was extracted for other YETI_INDEXED_TARGETS
+        with transaction.atomic():
+            ContentField.objects.exclude(content_block__in=current.values('content_block')).delete()
+            IndexedContentBlock.objects.exclude(targets_digest=targets_digest).delete()
+
+        if not settings.YETI_INDEXED_TARGETS:
+            self.stdout.write("YETI_INDEXED_TARGETS is empty; removed the Content Field index")
+            return
+
+        content_blocks = ContentBlock.objects.filter(indexedcontentblock__isnull=True).order_by('pk')
+        indexed = 0
+        last_id = 0
+        while True:
+            batch = attach_stored_content(list(content_blocks.filter(pk__gt=last_id)[:batch_size]))
+            if not batch:
+                break
+            last_id = batch[-1].pk
+
+            with transaction.atomic():
+                index_content_fields(batch)
+            indexed += len(batch)
+
+        self.stdout.write("Indexed %s content blocks" % indexed)
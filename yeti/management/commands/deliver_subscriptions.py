@@ -0,0 +1,63 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from yeti.push import PushDeliverer, fan_out, get_stats
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging
+import time
+
+log = logging.getLogger('yeti.push')
+
+
+class Command(BaseCommand):
+    """
+    Pushes new content to the Inbox Services of push Subscriptions
+    (see yeti.subscription_handlers.PushSubscriptionRequestHandler)
+    """
+    help = "Pushes new content in subscribed Data Collections to the subscribers' Inbox Services."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of threads sending Inbox Messages (default: YETI_PUSH_WORKERS).'),
+        make_option('--batch-size', type='int', dest='batch_size', default=None,
+                    help='Number of content blocks per Inbox Message (default: YETI_PUSH_BATCH_SIZE).'),
+        make_option('--claim-size', type='int', dest='claim_size', default=100,
+                    help='Number of Inbox Messages claimed and sent at a time.'),
+        make_option('--interval', type='float', dest='interval', default=0,
+                    help='Keep running, checking for new content and due retries every INTERVAL seconds.'),
+        make_option('--stats', action='store_true', dest='stats', default=False,
+                    help='Print the queue depth, lag and failed delivery count, and exit.'),
+    )
+
+    def write_stats(self):
+        stats = get_stats()
+        self.stdout.write("depth=%(depth)s lag=%(lag).3f failed=%(failed)s" % stats)
+        return stats
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.write_stats()
+            return
+
+        deliverer = PushDeliverer(options['workers'])
+        try:
+            while True:
+                queued = fan_out(options['batch_size'])
+                claimed = 0
+                while True:
+                    count = deliverer.deliver(options['claim_size'])
+                    if not count:
+                        break
+                    claimed += count
+                if queued or claimed:
+                    log.info("Push delivery: queued %s and sent %s Inbox Messages; %s", queued, claimed, get_stats())
+
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+        finally:
+            deliverer.close()
+
+        self.write_stats()
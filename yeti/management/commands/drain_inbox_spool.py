@@ -0,0 +1,62 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from yeti.db import close_db_connection
+from yeti.spool import drain, inbox_spool
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from multiprocessing import Pool
+import logging
+import time
+
+log = logging.getLogger('yeti.spool')
+
+
+class Command(BaseCommand):
+    """
+    Saves the Inbox Messages spooled by yeti.inbox_handlers.SpooledInboxMessageHandler
+    with a pool of worker processes.
+    """
+    help = "Saves spooled Inbox Messages into their Data Collections."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=2,
+                    help='Number of worker processes.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=20,
+                    help='Number of messages a worker claims at a time.'),
+        make_option('--interval', type='float', dest='interval', default=0,
+                    help='Keep running, checking an empty spool every INTERVAL seconds.'),
+        make_option('--stats', action='store_true', dest='stats', default=False,
+                    help='Print the queue depth, lag and failed message count, and exit.'),
+    )
+
+    def write_stats(self, spool):
+        stats = spool.stats()
+        self.stdout.write("depth=%(depth)s lag=%(lag).3f failed=%(failed)s" % stats)
+        return stats
+
+    def handle(self, *args, **options):
+        spool = inbox_spool
+        if options['stats']:
+            self.write_stats(spool)
+            return
+
+        workers = options['workers']
+        batch_size = options['batch_size']
+        pool = Pool(workers, initializer=close_db_connection)
+        try:
+            while True:
+                claimed = sum(pool.map(drain, [batch_size] * workers))
+                if claimed:
+                    log.info("Inbox spool: drained %s messages; %s", claimed, spool.stats())
+                    continue
+
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+        finally:
+            pool.close()
+            pool.join()
+
+        self.write_stats(spool)
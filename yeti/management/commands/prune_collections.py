@@ -0,0 +1,38 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.models import DataCollection
+
+from yeti.models import prune_collection
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import time
+
+
+class Command(BaseCommand):
+    """
+    Removes the months of Data Collection content older than
+    YETI_COLLECTION_RETENTION_MONTHS. Run it from cron,
+    or with --interval to keep it running.
+    """
+    help = "Removes Data Collection content older than YETI_COLLECTION_RETENTION_MONTHS."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='int', dest='interval', default=0,
+                    help='Keep running, pruning every INTERVAL seconds.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='Number of content blocks to remove per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            retention = settings.YETI_COLLECTION_RETENTION_MONTHS
+            for collection in DataCollection.objects.filter(name__in=retention.keys()).order_by('name'):
+                months, removed = prune_collection(collection, retention[collection.name], options['batch_size'])
+                self.stdout.write("%s: dropped %s months, %s content blocks" % (collection.name, months, removed))
+            if not interval:
+                return
+            time.sleep(interval)
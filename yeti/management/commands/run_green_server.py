@@ -0,0 +1,40 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from yeti.green import get_server
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+    Serves YETI with yeti.green's gevent front end
+    """
+    help = "Serves YETI to many concurrent clients with gevent. Requires the gevent package."
+    args = '[optional port number, or ipaddr:port]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', dest='threads', default=None,
+                    help='Number of threads that run Django (default: YETI_GREEN_THREADS).'),
+        make_option('--connections', type='int', dest='connections', default=None,
+                    help='Number of connections served at a time (default: YETI_GREEN_MAX_CONNECTIONS).'),
+    )
+
+    def handle(self, addrport='', *args, **options):
+        address, _, port = addrport.rpartition(':')
+        try:
+            port = int(port or 8000)
+        except ValueError:
+            raise CommandError("%r is not a valid port number." % port)
+        address = address or '127.0.0.1'
+
+        server = get_server((address, port), threads=options['threads'], connections=options['connections'])
+        self.stdout.write("Serving YETI at http://%s:%s/ with %s threads, %s connections at most" %
+                          (address, port, options['threads'] or settings.YETI_GREEN_THREADS,
+                           options['connections'] or settings.YETI_GREEN_MAX_CONNECTIONS))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
@@ -0,0 +1,30 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from yeti.models import delete_expired_result_sets
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import time
+
+
+class Command(BaseCommand):
+    """
+    Deletes expired Result Sets. Run it from cron,
+    or with --interval to keep it running.
+    """
+    help = "Deletes expired Result Sets and their parts."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='int', dest='interval', default=0,
+                    help='Keep running, sweeping every INTERVAL seconds.'),
+    )
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            deleted = delete_expired_result_sets()
+            self.stdout.write("Deleted %s expired result sets" % deleted)
+            if not interval:
+                return
+            time.sleep(interval)
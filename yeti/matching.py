@@ -0,0 +1,162 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# Matches content against push subscriptions when it is added to a Data
+# Collection, instead of polling each subscribed collection for each
+# subscriber. The filters of every push subscription are compiled into one
+# SubscriptionMatcher: an index from (Data Collection, content binding and
+# subtype) to subscriptions, and one shared query plan per distinct Default
+# Query. Each new content block is looked up in the index once, each distinct
+# query that applies to it is evaluated on it once, and it is appended to the
+# QueuedContent of every subscription it matches. yeti.push sends the queues.
+
+from yeti.content_cache import content_tree_cache
+from yeti.models import PushSubscription, QueuedContent, get_contents
+from yeti.query_handlers import IndexedStixXml111QueryHandler, normalize_criteria
+
+from libtaxii.constants import SS_UNSUBSCRIBED
+
+from django.db.models import Count, Max
+from lxml import etree
+import threading
+
+#: Index key for subscriptions that accept all content
+ANY_CONTENT = None
+
+#: Evaluates the Default Queries of push subscriptions
+QUERY_HANDLER = IndexedStixXml111QueryHandler
+
+
+class SubscriptionMatcher(object):
+    """
+    The filters of a set of PushSubscriptions, indexed so that a content
+    block is matched against all of them at once. Immutable once built,
+    so it can be shared by threads.
+    """
+
+    def __init__(self, push_subscriptions):
+        """
+        Arguments:
+            push_subscriptions - PushSubscriptions, with their Subscriptions and
+                the Subscriptions' supported_content prefetched
+        """
+        self._index = {}  # (collection id, content binding and subtype id): [(push subscription id, query key)]
+        self._queries = {}  # Query key: tdq.Criteria
+        for push_subscription in push_subscriptions:
+            subscription = push_subscription.subscription
+            query_key = None
+            query = push_subscription.get_query()
+            if query is not None:
+                query_key = normalize_criteria(query.criteria)
+                self._queries[query_key] = query.criteria
+
+            if subscription.accept_all_content:
+                content_keys = [ANY_CONTENT]
+            else:
+                content_keys = [cbas.pk for cbas in subscription.supported_content.all()]
+            for content_key in content_keys:
+                self._index.setdefault((subscription.data_collection_id, content_key), []).append(
+                    (push_subscription.pk, query_key))
+
+    def __nonzero__(self):
+        return bool(self._index)
+
+    def get_candidates(self, membership):
+        """
+        Returns the (push subscription id, query key) of each subscription whose
+        Data Collection and content bindings a CollectionMembership matches
+        """
+        return (self._index.get((membership.collection_id, ANY_CONTENT), []) +
+                self._index.get((membership.collection_id, membership.content_binding_and_subtype_id), []))
+
+    def evaluate_query(self, query_key, content_block_id, content):
+        """
+        Returns whether content matches the Default Query with query_key
+        """
+        try:
+            content_etree = content_tree_cache.get(content_block_id, content)
+        except (etree.XMLSyntaxError, ValueError):
+            return False
+        return QUERY_HANDLER.get_plan(self._queries[query_key]).evaluate(content_etree)
+
+    def match(self, memberships, contents=None):
+        """
+        Returns an **unsaved** QueuedContent for each PushSubscription
+        that each CollectionMembership matches.
+
+        Arguments:
+            memberships - A list of new CollectionMemberships
+            contents - Optional. A dict of content block id: content, for content
+                blocks that are in memory. Others are read if a query needs them.
+        """
+        candidates = [(membership, self.get_candidates(membership)) for membership in memberships]
+        candidates = [(membership, subscriptions) for membership, subscriptions in candidates if subscriptions]
+
+        contents = dict(contents or {})
+        to_read = set(membership.content_block_id for membership, subscriptions in candidates
+                      if membership.content_block_id not in contents and
+                      any(query_key is not None for push_subscription_id, query_key in subscriptions))
+        contents.update(get_contents(to_read))
+
+        results = {}  # (content block id, query key): whether the content matches
+        queued = []
+        for membership, subscriptions in candidates:
+            content_block_id = membership.content_block_id
+            for push_subscription_id, query_key in subscriptions:
+                if query_key is not None:
+                    result_key = (content_block_id, query_key)
+                    if result_key not in results:
+                        results[result_key] = self.evaluate_query(query_key, content_block_id,
+                                                                  contents[content_block_id])
+                    if not results[result_key]:
+                        continue
+                queued.append(QueuedContent(push_subscription_id=push_subscription_id,
+                                            content_block_id=content_block_id,
+                                            timestamp_label=membership.timestamp_label))
+        return queued
+
+
+_matcher = None
+_matcher_version = None
+_matcher_lock = threading.Lock()
+
+
+def get_subscription_matcher():
+    """
+    Returns a SubscriptionMatcher for every PushSubscription that has not been
+    unsubscribed. It is built again when push subscriptions are added, removed
+    or changed in any process, which costs one query to check.
+    """
+    global _matcher, _matcher_version
+    push_subscriptions = PushSubscription.objects.exclude(subscription__status=SS_UNSUBSCRIBED)
+    version = push_subscriptions.aggregate(count=Count('pk'), updated=Max('subscription__date_updated'))
+    version = (version['count'], version['updated'])
+    with _matcher_lock:
+        if version != _matcher_version:
+            _matcher = SubscriptionMatcher(push_subscriptions.select_related('subscription')
+                                                             .prefetch_related('subscription__supported_content'))
+            _matcher_version = version
+        return _matcher
+
+
+def queue_matching_content(memberships, contents=None):
+    """
+    Appends content newly added to Data Collections to the QueuedContent
+    of every push subscription it matches. Paused subscriptions are
+    included; their queues are sent once they are resumed.
+
+    Arguments:
+        memberships - A list of the new CollectionMemberships
+        contents - Optional. A dict of content block id: content, for content blocks that are in memory
+
+    Returns:
+        The number of QueuedContent rows saved
+    """
+    if not memberships:
+        return 0
+    matcher = get_subscription_matcher()
+    if not matcher:
+        return 0
+    queued = matcher.match(memberships, contents)
+    QueuedContent.objects.bulk_create(queued)
+    return len(queued)
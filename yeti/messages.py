@@ -0,0 +1,168 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+"""
+Response message types that YETI's service router knows how to serve
+in addition to plain libtaxii messages.
+
+Message handlers may return one of these instead of a libtaxii message
+when building the whole response in memory would be too expensive.
+"""
+
+from lxml import etree
+from libtaxii.common import generate_message_id
+from libtaxii.constants import *
+from xml.sax.saxutils import escape
+import hashlib
+
+#: Placeholder that marks where content blocks are spliced into an envelope
+CONTENT_BLOCKS_MARKER = 'yeti-content-blocks'
+
+#: Placeholder that marks where serialized content is spliced into a content block
+SERIALIZED_CONTENT_MARKER = 'yeti-serialized-content'
+
+#: Placeholders for the per-response attributes of a CachedMessage
+MESSAGE_ID_MARKER = 'yeti-message-id'
+IN_RESPONSE_TO_MARKER = 'yeti-in-response-to'
+
+
+class StreamingMessage(object):
+    """
+    A TAXII Message whose XML is produced incrementally.
+
+    The envelope is a libtaxii message with no content blocks. Its XML is
+    split in two around the point where the content blocks belong, and each
+    item in `content_blocks` is serialized on its own as it is consumed.
+    This keeps memory flat no matter how many content blocks there are.
+
+    Items with a serialized_content attribute (see yeti.models.attach_stored_content)
+    are serialized without their content, which is spliced in from the
+    content store as it is, instead of being parsed and serialized again.
+    """
+
+    def __init__(self, envelope, content_blocks, to_content_block):
+        """
+        Arguments:
+            envelope - A libtaxii TAXII Message with no content blocks
+            content_blocks - An iterable of content (nominally, models.ContentBlock objects)
+            to_content_block - A function that turns an item of content_blocks
+                into a libtaxii ContentBlock
+        """
+        self.envelope = envelope
+        self.content_blocks = content_blocks
+        self.to_content_block = to_content_block
+
+    @property
+    def message_type(self):
+        return self.envelope.message_type
+
+    @property
+    def message_id(self):
+        return self.envelope.message_id
+
+    @property
+    def taxii_module(self):
+        """
+        The name of the libtaxii module the envelope came from
+        (e.g., 'libtaxii.messages_11')
+        """
+        return self.envelope.__module__
+
+    def split_envelope(self):
+        """
+        Returns:
+            A (head, tail) tuple of XML strings. The content blocks go between them.
+        """
+        root = self.envelope.to_etree()
+        root.append(etree.Comment(CONTENT_BLOCKS_MARKER))
+        xml = etree.tostring(root)
+        head, tail = xml.split('<!--%s-->' % CONTENT_BLOCKS_MARKER, 1)
+        return head, tail
+
+    def iter_xml(self):
+        """
+        Yields the XML of this message one piece at a time:
+        the envelope head, each content block, then the envelope tail.
+        """
+        head, tail = self.split_envelope()
+        yield head
+        for content_block in self.content_blocks:
+            serialized_content = getattr(content_block, 'serialized_content', None)
+            chunks = None
+            if serialized_content is not None:
+                chunks = serialized_content.open()  # Before any of the content block is written
+                if chunks is None:  # The serialized file is gone; serialize the content instead
+                    content_block.content = serialized_content.get_content()
+            if chunks is None:
+                yield etree.tostring(self.to_content_block(content_block).to_etree())
+                continue
+
+            content_block.content = SERIALIZED_CONTENT_MARKER
+            block_head, block_tail = etree.tostring(self.to_content_block(content_block).to_etree()).split(
+                SERIALIZED_CONTENT_MARKER, 1)
+            yield block_head
+            for chunk in chunks:
+                yield chunk
+            yield block_tail
+        yield tail
+
+    def to_xml(self, pretty_print=False):
+        """
+        Returns the whole message as a string. This defeats the purpose
+        of streaming and is only meant for debugging and tests.
+        """
+        return ''.join(self.iter_xml())
+
+
+class CachedMessage(object):
+    """
+    A TAXII Message that is serialized once and then reused for
+    every response, with only message_id and in_response_to replaced.
+    """
+
+    def __init__(self, template, message_type, taxii_module, message_id=None, in_response_to=None):
+        """
+        Use CachedMessage.from_message() and bind() instead of calling this directly.
+        """
+        self.template = template
+        self.message_type = message_type
+        self.taxii_module = taxii_module
+        self.message_id = message_id
+        self.in_response_to = in_response_to
+        #: Identifies the cached content, which is the same for every response made from it
+        self.etag = hashlib.sha1(template).hexdigest()
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Arguments:
+            message - A libtaxii TAXII Message whose message_id is MESSAGE_ID_MARKER
+                and whose in_response_to is IN_RESPONSE_TO_MARKER
+        """
+        return cls(message.to_xml(pretty_print=True), message.message_type, message.__module__)
+
+    def bind(self, in_response_to):
+        """
+        Returns a copy of this message, with a new message_id, that responds to in_response_to
+        """
+        message = CachedMessage.__new__(CachedMessage)
+        message.__dict__.update(self.__dict__)
+        message.message_id = generate_message_id()
+        message.in_response_to = in_response_to
+        return message
+
+    def to_xml(self, pretty_print=False):
+        """
+        Returns the cached XML with this message's message_id and in_response_to
+        """
+        return (self.template.replace(MESSAGE_ID_MARKER, xml_attribute(self.message_id), 1)
+                             .replace(IN_RESPONSE_TO_MARKER, xml_attribute(self.in_response_to), 1))
+
+
+def xml_attribute(value):
+    """
+    Returns value as a UTF-8 string escaped for a double-quoted XML attribute
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return escape(value, {'"': '&quot;'})
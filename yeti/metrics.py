@@ -0,0 +1,416 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# Per-process metrics of TAXII traffic. yeti.views.service_router records the
+# parse, handler and serialization time, database queries, response size and
+# content block count of each request, by service path and message type, in
+# fixed-bucket histograms. yeti.views.metrics serves them, with the inbox spool
+# and push delivery queues, in the Prometheus text exposition format.
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from bisect import bisect_left
+import threading
+import time
+
+#: Histogram buckets (upper bounds) of durations in seconds
+SECONDS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+#: Histogram buckets of response sizes in bytes
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+#: Histogram buckets of counts (database queries, content blocks)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+#: Label value of a service path or message type not known when a request failed
+UNKNOWN = 'unknown'
+
+#: Outcomes of a request
+SUCCESS = 'success'
+STATUS_MESSAGE = 'status_message'  # Answered with a Status Message
+ERROR = 'error'  # Failed otherwise, or while its response was streamed
+
+
+def format_labels(names, values):
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value)) for name, value in zip(names, values))
+
+
+def escape_label_value(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    """
+    A count for each set of label values
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, format_labels(self.label_names, label_values), value
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+
+class Histogram(object):
+    """
+    Observed values bucketed by fixed upper bounds, for each set of label values.
+    Observing a value is a binary search and three additions.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names, buckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._values = {}  # Label values: [per-bucket counts (the last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def get_count(self, label_values):
+        entry = self._values.get(label_values)
+        return sum(entry[0]) if entry else 0
+
+    def get_sum(self, label_values):
+        entry = self._values.get(label_values)
+        return entry[1] if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, (list(counts), total)) for label_values, (counts, total)
+                            in self._values.items())
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       format_labels(self.label_names + ('le',), label_values + (bound,)),
+                       cumulative)
+            labels = format_labels(self.label_names, label_values)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+
+class Gauge(object):
+    """
+    Values read by a function each time the metrics are collected. The
+    function returns a list of (label values, value) tuples.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, label_names, function):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.function = function
+
+    def samples(self):
+        for label_values, value in self.function():
+            yield self.name, format_labels(self.label_names, label_values), value
+
+    def clear(self):
+        pass
+
+
+class MetricsRegistry(object):
+    """
+    The metrics of this process
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                if labels == '{}':
+                    labels = ''
+                lines.append('%s%s %s' % (name, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+
+def get_spool_stats():
+    """
+    Returns the inbox spool gauges, if the store can be reached
+    """
+    from yeti.spool import inbox_spool
+    from yeti.store import StoreError
+
+    try:
+        stats = inbox_spool.stats()
+    except StoreError:
+        return []
+    return [((name,), stats[name]) for name in ('depth', 'lag', 'failed')]
+
+
+def get_push_stats():
+    """
+    Returns the push delivery gauges
+    """
+    from yeti.push import get_stats  # It imports yeti.models, which needs the app registry
+
+    stats = get_stats()
+    return [((name,), stats[name]) for name in ('depth', 'lag', 'failed')]
+
+
+REQUEST_LABELS = ('path', 'message_type')
+
+#: The metrics served by yeti.views.metrics
+registry = MetricsRegistry()
+requests_total = registry.add(Counter('yeti_taxii_requests_total',
+                                      'TAXII requests handled, by outcome',
+                                      REQUEST_LABELS + ('outcome',)))
+parse_seconds = registry.add(Histogram('yeti_taxii_parse_seconds',
+                                       'Time spent parsing TAXII requests',
+                                       REQUEST_LABELS, SECONDS_BUCKETS))
+handler_seconds = registry.add(Histogram('yeti_taxii_handler_seconds',
+                                         'Time spent in message handlers',
+                                         REQUEST_LABELS, SECONDS_BUCKETS))
+serialize_seconds = registry.add(Histogram('yeti_taxii_serialize_seconds',
+                                           'Time spent serializing (or streaming) TAXII responses',
+                                           REQUEST_LABELS, SECONDS_BUCKETS))
+db_queries = registry.add(Histogram('yeti_taxii_db_queries',
+                                    'Database queries per TAXII request',
+                                    REQUEST_LABELS, COUNT_BUCKETS))
+db_seconds = registry.add(Histogram('yeti_taxii_db_seconds',
+                                    'Time spent in database queries per TAXII request',
+                                    REQUEST_LABELS, SECONDS_BUCKETS))
+response_bytes = registry.add(Histogram('yeti_taxii_response_bytes',
+                                        'Size of TAXII responses',
+                                        REQUEST_LABELS, BYTES_BUCKETS))
+content_blocks = registry.add(Histogram('yeti_taxii_content_blocks',
+                                        'Content blocks per TAXII request and response',
+                                        REQUEST_LABELS, COUNT_BUCKETS))
+registry.add(Gauge('yeti_inbox_spool', 'Inbox spool depth, lag in seconds, and failed messages',
+                   ('stat',), get_spool_stats))
+registry.add(Gauge('yeti_push_deliveries', 'Push delivery queue depth, lag in seconds, and failed deliveries',
+                   ('stat',), get_push_stats))
+
+
+_local = threading.local()  # request_metrics: the RequestMetrics counting this thread's queries
+
+
+class CountingCursor(object):
+    """
+    Wraps a database cursor, adding the number and duration of its queries to
+    the RequestMetrics counting the queries of its thread (see count_queries).
+    No SQL is kept.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, *args):
+        return self._count(self.cursor.execute, args)
+
+    def executemany(self, *args):
+        return self._count(self.cursor.executemany, args)
+
+    def _count(self, method, args):
+        request_metrics = getattr(_local, 'request_metrics', None)
+        if request_metrics is None:
+            return method(*args)
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            request_metrics.db_queries += 1
+            request_metrics.db_seconds += time.time() - start
+
+
+def wrap_cursors(db_connection):
+    """
+    Makes the cursors of db_connection (a DatabaseWrapper, of which Django
+    keeps one per thread) CountingCursors
+    """
+    if getattr(db_connection, 'yeti_counting_cursors', False):
+        return
+    create_cursor = db_connection.create_cursor
+    db_connection.create_cursor = lambda: CountingCursor(create_cursor())
+    db_connection.yeti_counting_cursors = True
+
+
+class RequestMetrics(object):
+    """
+    Records the metrics of one TAXII request. Does nothing if YETI_METRICS is False.
+    """
+
+    def __init__(self):
+        self.enabled = settings.YETI_METRICS
+        self.labels = (UNKNOWN, UNKNOWN)
+        self.content_blocks = 0
+        self.observations = []  # Recorded by finish(), once the labels are known
+        self.db_enabled = self.enabled and settings.YETI_METRICS_DB_QUERIES
+        self.db_queries = 0
+        self.db_seconds = 0.0
+
+    def set_path(self, path):
+        """
+        Labels the request with the path of the service it was sent to
+        """
+        self.labels = (path, self.labels[1])
+
+    def set_message(self, taxii_message):
+        """
+        Labels the request with its message type, and counts its content blocks
+        """
+        self.labels = (self.labels[0], taxii_message.message_type)
+        self.count_content_blocks(taxii_message)
+
+    def count_content_blocks(self, taxii_message):
+        self.content_blocks += len(getattr(taxii_message, 'content_blocks', None) or [])
+
+    def iter_content_blocks(self, content_blocks):
+        """
+        Yields content_blocks, counting them as a streaming response consumes them
+        """
+        for content_block in content_blocks:
+            self.content_blocks += 1
+            yield content_block
+
+    def count_queries(self):
+        """
+        Returns a context manager that counts the queries made in it, by its
+        thread, as queries of this request (if YETI_METRICS_DB_QUERIES is True)
+        """
+        return QueryCounter(self)
+
+    def time(self, histogram):
+        """
+        Returns a context manager that observes the time spent in it
+        """
+        return Timer(self, histogram)
+
+    def observe(self, histogram, value):
+        self.observations.append((histogram, value))
+
+    def finish(self, outcome, size=None):
+        """
+        Records the rest of the request's metrics once its response has been written
+        """
+        if not self.enabled:
+            return
+        requests_total.inc(self.labels + (outcome,))
+        for histogram, value in self.observations:
+            histogram.observe(self.labels, value)
+        if size is not None:
+            response_bytes.observe(self.labels, size)
+            content_blocks.observe(self.labels, self.content_blocks)
+        if self.db_enabled:
+            db_queries.observe(self.labels, self.db_queries)
+            db_seconds.observe(self.labels, self.db_seconds)
+
+
+class Timer(object):
+
+    def __init__(self, request_metrics, histogram):
+        self.request_metrics = request_metrics
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.request_metrics.observe(self.histogram, time.time() - self.start)
+
+
+class QueryCounter(object):
+
+    def __init__(self, request_metrics):
+        self.request_metrics = request_metrics
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'request_metrics', None)
+        if self.request_metrics.db_enabled:
+            wrap_cursors(connections[DEFAULT_DB_ALIAS])
+            _local.request_metrics = self.request_metrics
+
+    def __exit__(self, *exc_info):
+        _local.request_metrics = self.previous
+
+
+def measure_stream(xml_iterator, request_metrics):
+    """
+    Yields the chunks of a streaming response, recording the time spent
+    producing them and their size, and finishing request_metrics once the
+    response has been written
+    """
+    size = 0
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                with request_metrics.count_queries():  # Chunks may be produced in different threads
+                    chunk = next(xml_iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - start
+            size += len(chunk)
+            yield chunk
+    except Exception:
+        request_metrics.observe(serialize_seconds, elapsed)
+        request_metrics.finish(ERROR)
+        raise
+    request_metrics.observe(serialize_seconds, elapsed)
+    request_metrics.finish(SUCCESS, size)
@@ -0,0 +1,1103 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.models import (ContentBindingAndSubtype, ContentBlock, DataCollection, ResultSet, Subscription,
+                                   SUBS_BOTH, SUBS_PUSH)
+from taxii_services.query_handlers.stix_xml_111_handler import StixXml111QueryHandler
+
+from yeti import content_store
+from yeti.content_cache import content_tree_cache
+from yeti.db import configure_sqlite
+
+import libtaxii.messages_11 as tm11
+import libtaxii.taxii_default_query as tdq
+from libtaxii.constants import SS_ACTIVE
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q, Sum
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.utils import timezone
+from collections import Counter
+from datetime import datetime, timedelta
+from lxml import etree
+import hashlib
+import string
+
+#: YETI_INDEXED_TARGETS are Targeting Expressions of this Query Handler
+INDEXED_TARGETS_QUERY_HANDLER = StixXml111QueryHandler
+
+# The characters libxml2's XPath number() function skips around a number, and its digits
+XPATH_BLANKS = u' \t\n\r'
+XPATH_DIGITS = u'0123456789'
+
+# Digits of a fraction that libxml2 reads after its leading zeros
+XPATH_FRACTION_DIGITS = 20
+
+#: Maximum number of values in one IN (...) lookup. SQLite allows 999 query parameters.
+IN_LOOKUP_SIZE = 500
+
+#: Width of the time buckets of CollectionCount, in seconds
+COUNT_BUCKET_SECONDS = 60 * 60
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Lowercases A-Z only, like the translate() calls in the XPath of the built-in query handlers
+ASCII_LOWERCASE = dict((ord(c), ord(c.lower())) for c in string.ascii_uppercase)
+
+
+class CollectionMembership(models.Model):
+    """
+    Denormalized copy of the DataCollection.content_blocks relation.
+
+    Each row carries the timestamp label and content binding of its
+    content block, so a timestamp range poll against one collection
+    is a single seek on the (collection, timestamp_label) index.
+    """
+    collection = models.ForeignKey(DataCollection)
+    content_block = models.ForeignKey(ContentBlock)
+    timestamp_label = models.DateTimeField()
+    content_binding_and_subtype = models.ForeignKey(ContentBindingAndSubtype)
+
+    def __unicode__(self):
+        return u'%s: #%s; %s' % (self.collection, self.content_block_id, self.timestamp_label.isoformat())
+
+    @staticmethod
+    def from_content_block(collection_id, content_block):
+        """
+        Returns an **unsaved** CollectionMembership for content_block
+        in the DataCollection identified by collection_id
+        """
+        return CollectionMembership(collection_id=collection_id,
+                                    content_block_id=content_block.pk,
+                                    timestamp_label=content_block.timestamp_label,
+                                    content_binding_and_subtype_id=content_block.content_binding_and_subtype_id)
+
+    class Meta:
+        verbose_name = "Collection Membership"
+        unique_together = ('collection', 'content_block',)
+        index_together = [('collection', 'timestamp_label')]
+
+
+class CollectionCount(models.Model):
+    """
+    The number of CollectionMembership rows of a Data Collection with one
+    content binding and a timestamp label in one COUNT_BUCKET_SECONDS wide
+    time bucket. Kept up to date with CollectionMembership, so the content
+    in a timestamp range can be counted without reading every row in it.
+    """
+    collection = models.ForeignKey(DataCollection)
+    content_binding_and_subtype = models.ForeignKey(ContentBindingAndSubtype)
+    bucket_start = models.DateTimeField()
+    count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return u'%s: %s; %s' % (self.collection, self.bucket_start.isoformat(), self.count)
+
+    class Meta:
+        verbose_name = "Collection Count"
+        unique_together = ('collection', 'content_binding_and_subtype', 'bucket_start')
+
+
+class ContentDigest(models.Model):
+    """
+    The SHA-256 digest of a ContentBlock's content binding and content,
+    used to recognize content that has already been received. Each digest
+    is unique, so two Inbox Messages cannot both save the same content.
+    It is updated whenever its content block is saved.
+    """
+    content_block = models.OneToOneField(ContentBlock, primary_key=True)
+    digest = models.CharField(max_length=64, unique=True)
+
+    def __unicode__(self):
+        return u'#%s: %s' % (self.content_block_id, self.digest)
+
+    @staticmethod
+    def get_digest(content_binding_and_subtype_id, content):
+        """
+        Returns the hex digest of content with the given
+        ContentBindingAndSubtype pk
+        """
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        return hashlib.sha256('%s\n%s' % (content_binding_and_subtype_id, content)).hexdigest()
+
+    class Meta:
+        verbose_name = "Content Digest"
+
+
+class ContentBlob(models.Model):
+    """
+    A content block payload, stored once by the SHA-256 digest of its UTF-8
+    bytes however many ContentBlocks have it (see yeti.content_store). The
+    compressed payload is in data, or in the file store if in_file_store.
+    If serialized, the file store also has it serialized for splicing
+    into responses (see yeti.content_store.SerializedContent).
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    compression = models.CharField(max_length=8, blank=True)
+    data = models.BinaryField(blank=True)
+    in_file_store = models.BooleanField(default=False)
+    serialized = models.BooleanField(default=False)
+    size = models.IntegerField()  # Bytes before compression
+    stored_size = models.IntegerField()
+    reference_count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return u'%s (%s references)' % (self.digest, self.reference_count)
+
+    class Meta:
+        verbose_name = "Content Blob"
+
+
+class StoredContent(models.Model):
+    """
+    Points a ContentBlock whose content has been moved
+    into the content store at its ContentBlob
+    """
+    content_block = models.OneToOneField(ContentBlock, primary_key=True)
+    blob = models.ForeignKey(ContentBlob)
+
+    def __unicode__(self):
+        return u'#%s: %s' % (self.content_block_id, self.blob_id)
+
+    class Meta:
+        verbose_name = "Stored Content"
+        verbose_name_plural = "Stored Content"
+
+
+class ResultSetSnapshot(models.Model):
+    """
+    The Poll Request filters of a multi-part result set whose
+    parts are stored as ResultSetCursors.
+    """
+    result_set = models.OneToOneField(ResultSet)
+    content_bindings = models.ManyToManyField(ContentBindingAndSubtype, blank=True)
+
+    def __unicode__(self):
+        return u'%s' % self.result_set
+
+    class Meta:
+        verbose_name = "Result Set Snapshot"
+
+
+class ResultSetCursor(models.Model):
+    """
+    One part of a multi-part result set, stored as the (timestamp label,
+    content block id) keys of its first and last content blocks instead of
+    a list of content blocks. Reading any part is one range read on the
+    CollectionMembership (collection, timestamp_label) index, no matter
+    how far into the result set the part is.
+    """
+    snapshot = models.ForeignKey(ResultSetSnapshot)
+    part_number = models.IntegerField()
+    first_timestamp_label = models.DateTimeField()
+    first_content_block_id = models.IntegerField()
+    last_timestamp_label = models.DateTimeField()
+    last_content_block_id = models.IntegerField()
+    content_block_count = models.IntegerField()
+    more = models.BooleanField(default=False)
+    exclusive_begin_timestamp_label = models.DateTimeField(blank=True, null=True)
+    inclusive_end_timestamp_label = models.DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return u'ResultSet ID: %s; Part#: %s.' % (self.snapshot.result_set_id, self.part_number)
+
+    def get_content(self):
+        """
+        Returns the CollectionMembership QuerySet of this part
+        """
+        result_set = self.snapshot.result_set
+        first, last = self.first_timestamp_label, self.last_timestamp_label
+        content = CollectionMembership.objects.filter(
+            Q(timestamp_label__gt=first) | Q(timestamp_label=first, content_block__gte=self.first_content_block_id),
+            Q(timestamp_label__lt=last) | Q(timestamp_label=last, content_block__lte=self.last_content_block_id),
+            collection=result_set.data_collection_id,
+            timestamp_label__gte=first,  # Redundant with the above, but lets the database
+            timestamp_label__lte=last)   # use the (collection, timestamp_label) index
+
+        content_bindings = list(self.snapshot.content_bindings.values_list('pk', flat=True))
+        if content_bindings:
+            content = content.filter(content_binding_and_subtype__in=content_bindings)
+
+        return content.order_by('timestamp_label', 'content_block')
+
+    class Meta:
+        verbose_name = "Result Set Cursor"
+        unique_together = ('snapshot', 'part_number',)
+
+
+def _pow10(exponent):
+    """
+    Returns 10.0 ** exponent, or infinity where that overflows, like C's pow()
+    """
+    try:
+        return 10.0 ** exponent
+    except OverflowError:
+        return float('inf')
+
+
+class ContentField(models.Model):
+    """
+    One value of an indexed Targeting Expression (see YETI_INDEXED_TARGETS)
+    in a ContentBlock: the text of a matching element, or the value of a
+    matching attribute. yeti.query_handlers answers Default Queries with
+    these rows instead of running XPath over every content block.
+
+    Values are looked up by their digests, so the indexes
+    work for values of any length.
+    """
+    content_block = models.ForeignKey(ContentBlock)
+    target = models.CharField(max_length=255)
+    value = models.TextField()
+    value_digest = models.CharField(max_length=40)
+    folded_digest = models.CharField(max_length=40)  # Of the value with A-Z lowercased
+    number = models.FloatField(blank=True, null=True)  # The value as an XPath number, if it is not NaN
+
+    def __unicode__(self):
+        return u'#%s: %s = %s' % (self.content_block_id, self.target, self.value)
+
+    @staticmethod
+    def get_digest(value):
+        """
+        Returns the hex digest of a value
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return hashlib.sha1(value).hexdigest()
+
+    @staticmethod
+    def get_number(value):
+        """
+        Returns value as a float, the way XPath's number() function reads it
+        in libxml2 (xmlXPathStringEvalNumber), or None if number() would return
+        NaN. libxml2 also reads exponents and a lone '-' (as -0), and adds up
+        the digits itself, so long numbers can differ from float(value) in
+        their last bit.
+        """
+        end = len(value)
+        i = 0
+        while i < end and value[i] in XPATH_BLANKS:
+            i += 1
+        if i == end or (value[i] not in XPATH_DIGITS and value[i] not in u'.-'):
+            return None
+        negative = value[i] == u'-'
+        if negative:
+            i += 1
+
+        number = 0.0
+        whole = False
+        while i < end and value[i] in XPATH_DIGITS:
+            number = number * 10 + int(value[i])
+            whole = True
+            i += 1
+        if i < end and value[i] == u'.':
+            i += 1
+            if not whole and (i == end or value[i] not in XPATH_DIGITS):
+                return None
+            digits = 0
+            while i < end and value[i] == u'0':
+                digits += 1
+                i += 1
+            last = digits + XPATH_FRACTION_DIGITS
+            fraction = 0.0
+            while i < end and value[i] in XPATH_DIGITS and digits < last:
+                fraction = fraction * 10 + int(value[i])
+                digits += 1
+                i += 1
+            number += fraction / _pow10(digits)
+            while i < end and value[i] in XPATH_DIGITS:
+                i += 1
+
+        exponent = 0
+        if i < end and value[i] in u'eE':
+            i += 1
+            exponent_negative = i < end and value[i] == u'-'
+            if i < end and value[i] in u'+-':
+                i += 1
+            while i < end and value[i] in XPATH_DIGITS:
+                if exponent < 1000000:
+                    exponent = exponent * 10 + int(value[i])
+                i += 1
+            if exponent_negative:
+                exponent = -exponent
+
+        while i < end and value[i] in XPATH_BLANKS:
+            i += 1
+        if i != end:
+            return None
+        if negative:
+            number = -number
+        number *= _pow10(exponent)
+        if number != number:  # NaN, from 0 * infinity
+            return None
+        return number
+
+    @staticmethod
+    def from_value(content_block_id, target, value):
+        """
+        Returns an **unsaved** ContentField
+        """
+        value = unicode(value)
+        return ContentField(content_block_id=content_block_id,
+                            target=target,
+                            value=value,
+                            value_digest=ContentField.get_digest(value),
+                            folded_digest=ContentField.get_digest(value.translate(ASCII_LOWERCASE)),
+                            number=ContentField.get_number(value))
+
+    class Meta:
+        verbose_name = "Content Field"
+        index_together = [('target', 'value_digest'), ('target', 'folded_digest'), ('target', 'number')]
+
+
+class IndexedContentBlock(models.Model):
+    """
+    Records that the ContentFields of a ContentBlock have been extracted,
+    and for which YETI_INDEXED_TARGETS. Content blocks without a current
+    record are queried with XPath.
+    """
+    content_block = models.OneToOneField(ContentBlock, primary_key=True)
+    targets_digest = models.CharField(max_length=40, db_index=True)
+
+    def __unicode__(self):
+        return u'#%s: %s' % (self.content_block_id, self.targets_digest)
+
+    class Meta:
+        verbose_name = "Indexed Content Block"
+
+
+class PushSubscriptionManager(models.Manager):
+
+    def active(self):
+        """
+        Returns the PushSubscriptions whose Subscriptions
+        are active and delivered by push
+        """
+        return self.filter(subscription__status=SS_ACTIVE,
+                           subscription__delivery__in=(SUBS_PUSH[0], SUBS_BOTH[0]))
+
+
+class PushSubscription(models.Model):
+    """
+    The Push Parameters and Default Query of a Subscription. Content that
+    matches it is appended to its QueuedContent when it is added to the Data
+    Collection (see yeti.matching), and moved into PushDeliveries by
+    yeti.push.fan_out().
+    """
+    subscription = models.OneToOneField(Subscription, primary_key=True)
+    inbox_protocol = models.CharField(max_length=255)
+    inbox_address = models.CharField(max_length=255)
+    delivery_message_binding = models.CharField(max_length=255)
+    query = models.TextField(blank=True)  # The XML of a tdq.DefaultQuery
+    queued_timestamp_label = models.DateTimeField(blank=True, null=True)  # The end of the last PushDelivery
+    queued_deliveries = models.IntegerField(default=0)
+
+    objects = PushSubscriptionManager()
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.subscription_id, self.inbox_address)
+
+    def get_query(self):
+        """
+        Returns the tdq.DefaultQuery of this subscription, or None
+        """
+        if not self.query:
+            return None
+        return tdq.DefaultQuery.from_xml(self.query)
+
+    def to_push_parameters_11(self):
+        """
+        Returns a tm11.PushParameters object based on this model
+        """
+        return tm11.PushParameters(inbox_protocol=self.inbox_protocol,
+                                   inbox_address=self.inbox_address,
+                                   delivery_message_binding=self.delivery_message_binding)
+
+    class Meta:
+        verbose_name = "Push Subscription"
+
+
+class QueuedContent(models.Model):
+    """
+    A content block that matches a PushSubscription and
+    has not been put in a PushDelivery yet
+    """
+    push_subscription = models.ForeignKey(PushSubscription)
+    content_block = models.ForeignKey(ContentBlock)
+    timestamp_label = models.DateTimeField()
+
+    def __unicode__(self):
+        return u'%s: #%s' % (self.push_subscription_id, self.content_block_id)
+
+    class Meta:
+        verbose_name = "Queued Content"
+        verbose_name_plural = "Queued Content"
+        index_together = [('push_subscription', 'timestamp_label', 'content_block')]
+
+
+class PushDelivery(models.Model):
+    """
+    A durable queue entry: content blocks waiting to be pushed to the Inbox
+    Service of a PushSubscription in one Inbox Message. A delivery that fails
+    is tried again at next_attempt, until it has been tried
+    YETI_PUSH_MAX_ATTEMPTS times and is marked failed.
+    """
+    push_subscription = models.ForeignKey(PushSubscription)
+    content_block_ids = models.TextField()  # Comma separated
+    exclusive_begin_timestamp_label = models.DateTimeField(blank=True, null=True)
+    inclusive_end_timestamp_label = models.DateTimeField()
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField()
+    failed = models.BooleanField(default=False)
+    error = models.TextField(blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'%s: %s content blocks' % (self.push_subscription_id, len(self.get_content_block_ids()))
+
+    def get_content_block_ids(self):
+        """
+        Returns the list of content block ids to deliver
+        """
+        return [int(pk) for pk in self.content_block_ids.split(',') if pk]
+
+    class Meta:
+        verbose_name = "Push Delivery"
+        verbose_name_plural = "Push Deliveries"
+        index_together = [('failed', 'next_attempt')]
+
+
+# Compiled XPaths of YETI_INDEXED_TARGETS, keyed by the setting's value
+_indexed_target_xpaths = {}
+
+
+def get_indexed_targets():
+    """
+    Returns a dict mapping each of YETI_INDEXED_TARGETS to an etree.XPath
+    that selects its values (text nodes or attribute values)
+    """
+    targets = tuple(settings.YETI_INDEXED_TARGETS)
+    xpaths = _indexed_target_xpaths.get(targets)
+    if xpaths is None:
+        xpaths = {}
+        for target in targets:
+            if '*' in target:
+                raise ImproperlyConfigured("YETI_INDEXED_TARGETS cannot contain wildcards: %s" % target)
+            try:
+                xpath_builders, nsmap = INDEXED_TARGETS_QUERY_HANDLER.target_to_xpath_builders(None, target)
+            except ValueError as e:
+                raise ImproperlyConfigured("Unsupported target in YETI_INDEXED_TARGETS: %s (%s)" % (target, e))
+            xpath_parts = xpath_builders[0].xpath_parts
+            if not xpath_parts[-1].startswith('@'):
+                xpath_parts = xpath_parts + ['text()']  # The operand XPathBuilder compares
+            xpaths[target] = etree.XPath('/'.join(xpath_parts), namespaces=nsmap, smart_strings=False)
+        _indexed_target_xpaths[targets] = xpaths
+    return xpaths
+
+
+def get_indexed_targets_digest():
+    """
+    Returns the digest that IndexedContentBlock records
+    for the current YETI_INDEXED_TARGETS
+    """
+    return hashlib.sha1('\n'.join(sorted(set(settings.YETI_INDEXED_TARGETS)))).hexdigest()
+
+
+def extract_content_fields(content_block):
+    """
+    Returns the **unsaved** ContentFields of a saved ContentBlock. Content
+    that is not XML has none. The parsed content is left in the content tree cache.
+    """
+    try:
+        root = content_tree_cache.get(content_block.pk, content_block.content)
+    except (etree.XMLSyntaxError, ValueError):
+        return []
+
+    fields = []
+    for target, xpath in get_indexed_targets().items():
+        fields.extend(ContentField.from_value(content_block.pk, target, value) for value in xpath(root))
+    return fields
+
+
+def index_content_fields(content_blocks):
+    """
+    Extracts and saves the ContentFields of content_blocks and marks
+    them as indexed. Does nothing if YETI_INDEXED_TARGETS is empty.
+
+    Arguments:
+        content_blocks - An iterable of saved ContentBlock objects
+            that have no ContentFields or IndexedContentBlock
+    """
+    if not settings.YETI_INDEXED_TARGETS:
+        return
+
+    content_blocks = list(content_blocks)
+    fields = []
+    for content_block in content_blocks:
+        fields.extend(extract_content_fields(content_block))
+    ContentField.objects.bulk_create(fields)
+
+    targets_digest = get_indexed_targets_digest()
+    IndexedContentBlock.objects.bulk_create([IndexedContentBlock(content_block_id=cb.pk, targets_digest=targets_digest)
+                                             for cb in content_blocks])
+
+
+def index_content_blocks(collection, content_blocks):
+    """
+    Adds CollectionMembership rows for content_blocks in collection,
+    skipping any that already exist, and queues the new ones for
+    the push subscriptions they match.
+
+    Arguments:
+        collection - A DataCollection or DataCollection pk
+        content_blocks - An iterable of saved ContentBlock objects
+    """
+    from yeti.matching import queue_matching_content  # It imports this module
+
+    collection_id = collection.pk if hasattr(collection, 'pk') else collection
+    content_blocks = list(content_blocks)
+    existing = set(CollectionMembership.objects.filter(collection_id=collection_id,
+                                                       content_block__in=[cb.pk for cb in content_blocks])
+                                               .values_list('content_block_id', flat=True))
+    memberships = [CollectionMembership.from_content_block(collection_id, cb)
+                   for cb in content_blocks if cb.pk not in existing]
+    CollectionMembership.objects.bulk_create(memberships)
+    add_collection_counts(memberships)
+    # Content blocks read back from the database have no content if it is in the content store
+    queue_matching_content(memberships, dict((cb.pk, cb.content) for cb in content_blocks if cb.content))
+
+
+def get_count_bucket(timestamp_label):
+    """
+    Returns the start of the CollectionCount time bucket of timestamp_label
+    """
+    epoch = EPOCH if timezone.is_aware(timestamp_label) else EPOCH.replace(tzinfo=None)
+    delta = timestamp_label - epoch
+    seconds = delta.days * 24 * 60 * 60 + delta.seconds
+    return epoch + timedelta(seconds=seconds - seconds % COUNT_BUCKET_SECONDS)
+
+
+def add_collection_counts(memberships, sign=1):
+    """
+    Adds CollectionMemberships to the CollectionCounts of their time buckets,
+    or with a sign of -1, takes them out. Call it whenever memberships are
+    created or deleted without the signals in this module.
+    """
+    deltas = Counter()
+    for membership in memberships:
+        deltas[(membership.collection_id, membership.content_binding_and_subtype_id,
+                get_count_bucket(membership.timestamp_label))] += sign
+
+    for (collection_id, cbas_id, bucket_start), delta in sorted(deltas.items()):
+        if delta == 0:
+            continue
+        counts = CollectionCount.objects.filter(collection_id=collection_id,
+                                                content_binding_and_subtype_id=cbas_id,
+                                                bucket_start=bucket_start)
+        if counts.update(count=F('count') + delta):
+            continue
+        try:
+            with transaction.atomic():
+                CollectionCount.objects.create(collection_id=collection_id,
+                                               content_binding_and_subtype_id=cbas_id,
+                                               bucket_start=bucket_start,
+                                               count=delta)
+        except IntegrityError:  # Another process created it first
+            counts.update(count=F('count') + delta)
+
+
+def delete_memberships(memberships):
+    """
+    Deletes a CollectionMembership QuerySet and takes its rows out of the CollectionCounts
+    """
+    add_collection_counts(memberships.only('collection', 'content_binding_and_subtype', 'timestamp_label'), -1)
+    memberships.delete()
+
+
+def count_collection_content(collection, content_bindings=None, exclusive_begin=None, inclusive_end=None):
+    """
+    Counts the content of a Data Collection with one of content_bindings (any
+    binding if empty) and a timestamp label after exclusive_begin and up to
+    inclusive_end (if given). Whole time buckets in the range are counted from
+    CollectionCounts; only the CollectionMembership rows in the partly covered
+    buckets at either end are read, through the (collection, timestamp_label) index.
+    """
+    counts = CollectionCount.objects.filter(collection=collection)
+    memberships = CollectionMembership.objects.filter(collection=collection)
+    if content_bindings:
+        counts = counts.filter(content_binding_and_subtype__in=content_bindings)
+        memberships = memberships.filter(content_binding_and_subtype__in=content_bindings)
+
+    if exclusive_begin is not None and inclusive_end is not None:
+        if exclusive_begin >= inclusive_end:
+            return 0
+        if get_count_bucket(exclusive_begin) == get_count_bucket(inclusive_end):
+            return memberships.filter(timestamp_label__gt=exclusive_begin, timestamp_label__lte=inclusive_end).count()
+
+    total = 0
+    if exclusive_begin is not None:
+        first_bucket = get_count_bucket(exclusive_begin) + timedelta(seconds=COUNT_BUCKET_SECONDS)
+        counts = counts.filter(bucket_start__gte=first_bucket)
+        total += memberships.filter(timestamp_label__gt=exclusive_begin, timestamp_label__lt=first_bucket).count()
+    if inclusive_end is not None:
+        last_bucket = get_count_bucket(inclusive_end)
+        counts = counts.filter(bucket_start__lt=last_bucket)
+        total += memberships.filter(timestamp_label__gte=last_bucket, timestamp_label__lte=inclusive_end).count()
+    return total + (counts.aggregate(total=Sum('count'))['total'] or 0)
+
+
+def rebuild_collection_counts(collection):
+    """
+    Recreates the CollectionCounts of a Data Collection from its CollectionMembership rows
+    """
+    memberships = (CollectionMembership.objects.filter(collection=collection)
+                                               .only('collection', 'content_binding_and_subtype', 'timestamp_label'))
+    with transaction.atomic():
+        CollectionCount.objects.filter(collection=collection).delete()
+        add_collection_counts(memberships.iterator())
+
+
+def chunks(values, size=IN_LOOKUP_SIZE):
+    """
+    Splits values into lists of at most `size` values
+    """
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _add_references(digest, count):
+    """
+    Adds count references to the ContentBlob with digest, if it is stored.
+    Returns True if it is.
+    """
+    return ContentBlob.objects.filter(pk=digest).update(reference_count=F('reference_count') + count) > 0
+
+
+def _reference_blobs(payloads, references):
+    """
+    Adds references, a dict of digest: number of new references, to the
+    ContentBlobs of payloads, a dict of digest: payload bytes. Blobs that are
+    not stored yet are created with those references. Each blob is referenced
+    by one UPDATE, or created referenced by one INSERT, so that
+    delete_unreferenced_blobs() cannot delete it in between.
+    """
+    missing = [digest for digest, count in references.items() if not _add_references(digest, count)]
+
+    in_file_store = settings.YETI_CONTENT_STORE == content_store.STORE_FILE
+    serialized = in_file_store and settings.YETI_CONTENT_STORE_SERIALIZED
+    file_store = content_store.get_file_store() if in_file_store else None
+    blobs = []
+    for digest in missing:
+        data = payloads[digest]
+        compression, compressed = content_store.compress(data)
+        if in_file_store:
+            file_store.put(digest, compressed)
+        if serialized:
+            file_store.put_serialized(digest, content_store.serialize_content(data))
+        blobs.append(ContentBlob(digest=digest, compression=compression,
+                                 data='' if in_file_store else compressed, in_file_store=in_file_store,
+                                 serialized=serialized, size=len(data), stored_size=len(compressed),
+                                 reference_count=references[digest]))
+
+    try:
+        with transaction.atomic():
+            ContentBlob.objects.bulk_create(blobs)
+    except IntegrityError:  # Another process stored some of them first
+        for blob in blobs:
+            while True:
+                if _add_references(blob.digest, blob.reference_count):
+                    break
+                try:
+                    with transaction.atomic():
+                        blob.save(force_insert=True)
+                    break
+                except IntegrityError:  # Stored again since the UPDATE
+                    pass
+
+
+def store_content(content_blocks):
+    """
+    Moves the content of saved ContentBlocks into the content store (see
+    yeti.content_store) and empties their content column, so each distinct
+    payload is stored once. Does nothing unless YETI_CONTENT_STORE is set.
+    Content blocks with empty content are skipped, since that is how the
+    ContentBlocks of stored content read back from the database.
+
+    Arguments:
+        content_blocks - An iterable of saved ContentBlock objects
+
+    Returns:
+        The number of content blocks whose content was stored
+    """
+    store = settings.YETI_CONTENT_STORE
+    if store is None:
+        return 0
+    if store not in (content_store.STORE_DATABASE, content_store.STORE_FILE):
+        raise ImproperlyConfigured("Unsupported YETI_CONTENT_STORE: %s" % store)
+
+    payloads = {}  # Digest: payload bytes
+    digests = {}  # Content block id: digest
+    for content_block in content_blocks:
+        if not content_block.content:
+            continue
+        data = content_block.content
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        digest = content_store.get_digest(data)
+        payloads[digest] = data
+        digests[content_block.pk] = digest
+    if not digests:
+        return 0
+
+    # Content blocks saved again keep their StoredContent unless their content changed
+    previous = {}
+    for chunk in chunks(digests.keys()):
+        previous.update(StoredContent.objects.filter(content_block__in=chunk).values_list('content_block', 'blob'))
+    changed = [pk for pk, digest in previous.items() if digests[pk] != digest]
+    for chunk in chunks(changed):
+        StoredContent.objects.filter(content_block__in=chunk).delete()  # Releases the old blobs
+    added = [pk for pk in digests if pk not in previous or pk in changed]
+
+    _reference_blobs(payloads, Counter(digests[pk] for pk in added))
+    StoredContent.objects.bulk_create([StoredContent(content_block_id=pk, blob_id=digests[pk]) for pk in added])
+    for chunk in chunks(digests.keys()):
+        ContentBlock.objects.filter(pk__in=chunk).update(content='')
+    return len(digests)
+
+
+def get_stored_content(content_block_ids, serialized=False):
+    """
+    Returns a dict of content block id: content (unicode) for
+    those of content_block_ids whose content is in the content store.
+
+    If serialized is True, content that the file store has serialized is
+    returned as a yeti.content_store.SerializedContent instead, without reading it.
+    """
+    contents = {}
+    payloads = {}  # Digest: content, so each blob is decompressed once
+    file_store = content_store.get_file_store()
+    for chunk in chunks(content_block_ids):
+        rows = StoredContent.objects.filter(content_block__in=chunk).values_list('content_block', 'blob',
+                                                                                 'blob__compression', 'blob__data',
+                                                                                 'blob__in_file_store',
+                                                                                 'blob__serialized')
+        for content_block_id, digest, compression, data, in_file_store, is_serialized in rows:
+            if digest not in payloads:
+                if serialized and is_serialized:
+                    payloads[digest] = content_store.SerializedContent(file_store, digest, compression)
+                else:
+                    if in_file_store:
+                        data = file_store.get(digest)
+                    payloads[digest] = content_store.decompress(compression, bytes(data)).decode('utf-8')
+            contents[content_block_id] = payloads[digest]
+    return contents
+
+
+def attach_stored_content(content_blocks, serialized=False):
+    """
+    Sets the content of ContentBlocks read from the database whose
+    content is in the content store. Returns content_blocks.
+
+    Arguments:
+        content_blocks - A list of ContentBlock objects
+        serialized - If True, content that the file store has serialized is set as the
+            serialized_content attribute (a yeti.content_store.SerializedContent) instead,
+            for yeti.messages.StreamingMessage to splice into the response
+    """
+    empty = [cb.pk for cb in content_blocks if isinstance(cb, ContentBlock) and not cb.content and cb.pk is not None]
+    if empty:
+        contents = get_stored_content(empty, serialized)
+        for content_block in content_blocks:
+            if content_block.pk in contents and not content_block.content:
+                content = contents[content_block.pk]
+                if isinstance(content, content_store.SerializedContent):
+                    content_block.serialized_content = content
+                else:
+                    content_block.content = content
+    return content_blocks
+
+
+def serialize_stored_content(batch_size=1000):
+    """
+    Writes the serialized XML of the payloads in the file store that
+    do not have it yet. Returns the number of payloads serialized.
+    """
+    file_store = content_store.get_file_store()
+    unserialized = ContentBlob.objects.filter(in_file_store=True, serialized=False)
+    serialized = 0
+    while True:
+        blobs = list(unserialized.values_list('pk', 'compression')[:batch_size])
+        if not blobs:
+            return serialized
+        for digest, compression in blobs:
+            data = content_store.decompress(compression, file_store.get(digest))
+            file_store.put_serialized(digest, content_store.serialize_content(data))
+        ContentBlob.objects.filter(pk__in=[digest for digest, compression in blobs]).update(serialized=True)
+        serialized += len(blobs)
+
+
+def get_contents(content_block_ids):
+    """
+    Returns a dict of content block id: content for content_block_ids,
+    whether their content is in the ContentBlock table or the content store
+    """
+    contents = {}
+    for chunk in chunks(content_block_ids):
+        contents.update(ContentBlock.objects.filter(pk__in=chunk).values_list('pk', 'content'))
+    contents.update(get_stored_content([pk for pk, content in contents.items() if not content]))
+    return contents
+
+
+def delete_unreferenced_blobs(batch_size=100):
+    """
+    Deletes the ContentBlobs that no ContentBlock references any more, and
+    their files, `batch_size` at a time. Returns the number of blobs deleted.
+
+    Each batch is locked (on databases that support SELECT ... FOR UPDATE)
+    and deleted in one transaction, so store_content() cannot reference a
+    blob in between; it creates the blob again once it is deleted. Files
+    are deleted once the transaction has committed.
+    """
+    file_store = content_store.get_file_store()
+    unreferenced = ContentBlob.objects.filter(reference_count__lte=0).exclude(
+        pk__in=StoredContent.objects.values('blob'))
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            blobs = list(unreferenced.select_for_update().values_list('pk', 'in_file_store')[:batch_size])
+            if not blobs:
+                return deleted
+            unreferenced.filter(pk__in=[digest for digest, in_file_store in blobs]).delete()
+        for digest, in_file_store in blobs:
+            if in_file_store:
+                file_store.delete(digest)
+        deleted += len(blobs)
+
+
+def delete_expired_result_sets(batch_size=100):
+    """
+    Deletes every ResultSet (built-in or YETI) that has expired,
+    along with its parts, `batch_size` result sets at a time.
+    Returns the number of result sets deleted.
+    """
+    expired = ResultSet.objects.filter(expires__lt=timezone.now())
+    deleted = 0
+    while True:
+        pks = list(expired.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        # last_part_returned points back at the parts being deleted
+        ResultSet.objects.filter(pk__in=pks).update(last_part_returned=None)
+        ResultSet.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
+
+
+def get_month_start(timestamp_label):
+    """
+    Returns the start of the UTC calendar month of timestamp_label, the unit in which
+    Data Collection content is pruned. Month starts are also CollectionCount bucket starts.
+    """
+    if timezone.is_aware(timestamp_label):
+        timestamp_label = timestamp_label.astimezone(timezone.utc)
+    return timestamp_label.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month_start, months):
+    """
+    Returns the start of the month `months` months after month_start
+    """
+    month = month_start.month - 1 + months
+    return month_start.replace(year=month_start.year + month // 12, month=month % 12 + 1)
+
+
+def get_retention_cutoff(months, now=None):
+    """
+    Returns the start of the oldest month kept by a retention of `months`
+    months, counting the current month
+    """
+    if months < 1:
+        raise ImproperlyConfigured("Collection retention must be at least one month")
+    return add_months(get_month_start(now or timezone.now()), 1 - months)
+
+
+def prune_collection_month(collection, month_start, batch_size=IN_LOOKUP_SIZE):
+    """
+    Removes the content of a Data Collection with a timestamp label in the month
+    starting at month_start, `batch_size` content blocks per transaction, so
+    the database is never locked for long. Each transaction also takes its
+    content blocks out of the CollectionCounts, so the counts always match
+    the content left. Content blocks left in no Data Collection are deleted.
+    Returns the number of content blocks removed from the collection.
+    """
+    month_end = add_months(month_start, 1)
+    through = DataCollection.content_blocks.through
+    memberships = CollectionMembership.objects.filter(collection=collection, timestamp_label__gte=month_start,
+                                                      timestamp_label__lt=month_end)
+    removed = 0
+    while True:
+        with transaction.atomic():
+            batch = list(memberships.values_list('pk', 'content_block_id')[:batch_size])
+            if not batch:
+                break
+            content_block_ids = [content_block_id for pk, content_block_id in batch]
+            # Deletes from the through table do not send m2m_changed, so the index is updated here
+            through.objects.filter(datacollection=collection, contentblock__in=content_block_ids).delete()
+            delete_memberships(CollectionMembership.objects.filter(pk__in=[pk for pk, content_block_id in batch]))
+            ContentBlock.objects.filter(pk__in=content_block_ids, datacollection__isnull=True).delete()
+        removed += len(batch)
+
+    # Only counts that content added since then has not brought back above 0
+    CollectionCount.objects.filter(collection=collection, bucket_start__gte=month_start,
+                                   bucket_start__lt=month_end, count__lte=0).delete()
+    return removed
+
+
+def prune_collection(collection, months, batch_size=IN_LOOKUP_SIZE):
+    """
+    Removes every month of a Data Collection's content older than a retention
+    of `months` months (see get_retention_cutoff), oldest first, with
+    prune_collection_month. Months are found through the (collection,
+    timestamp_label) index. Returns a tuple of (months pruned, content blocks removed).
+    """
+    cutoff = get_retention_cutoff(months)
+    memberships = CollectionMembership.objects.filter(collection=collection, timestamp_label__lt=cutoff)
+    pruned = removed = 0
+    while True:
+        oldest = memberships.order_by('timestamp_label').values_list('timestamp_label', flat=True).first()
+        if oldest is None:
+            return pruned, removed
+        removed += prune_collection_month(collection, get_month_start(oldest), batch_size)
+        pruned += 1
+
+
+def update_collection_index(sender, **kwargs):
+    """
+    Keeps CollectionMembership in sync with changes
+    to the DataCollection.content_blocks relation, from either side.
+    """
+    action = kwargs['action']
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    instance = kwargs['instance']
+    pk_set = kwargs['pk_set']
+    forward = not kwargs['reverse']  # True when instance is a DataCollection
+
+    if action == 'post_clear':
+        if forward:
+            CollectionMembership.objects.filter(collection=instance).delete()
+            CollectionCount.objects.filter(collection=instance).delete()
+        else:
+            delete_memberships(CollectionMembership.objects.filter(content_block=instance))
+    elif action == 'post_remove':
+        if forward:
+            delete_memberships(CollectionMembership.objects.filter(collection=instance, content_block__in=pk_set))
+        else:
+            delete_memberships(CollectionMembership.objects.filter(content_block=instance, collection__in=pk_set))
+    elif forward:  # post_add to a DataCollection
+        index_content_blocks(instance, ContentBlock.objects.filter(pk__in=pk_set))
+    else:  # post_add to a ContentBlock's collections
+        for collection_id in pk_set:
+            index_content_blocks(collection_id, [instance])
+
+
+def update_collection_index_labels(sender, **kwargs):
+    """
+    Copies an edited ContentBlock's timestamp label and content
+    binding onto its CollectionMembership rows and their CollectionCounts
+    """
+    if kwargs['created'] or kwargs['raw']:
+        return
+
+    instance = kwargs['instance']
+    memberships = CollectionMembership.objects.filter(content_block=instance)
+    changed = list(memberships.exclude(timestamp_label=instance.timestamp_label,
+                                       content_binding_and_subtype=instance.content_binding_and_subtype_id))
+    if not changed:
+        return
+    add_collection_counts(changed, -1)
+    memberships.update(timestamp_label=instance.timestamp_label,
+                       content_binding_and_subtype=instance.content_binding_and_subtype_id)
+    for membership in changed:
+        membership.timestamp_label = instance.timestamp_label
+        membership.content_binding_and_subtype_id = instance.content_binding_and_subtype_id
+    add_collection_counts(changed)
+
+
+def update_content_fields(sender, **kwargs):
+    """
+    Extracts the ContentFields of a saved ContentBlock
+    """
+    if kwargs['raw']:
+        return
+
+    instance = kwargs['instance']
+    if not kwargs['created']:
+        ContentField.objects.filter(content_block=instance).delete()
+        IndexedContentBlock.objects.filter(content_block=instance).delete()
+        attach_stored_content([instance])
+    index_content_fields([instance])
+
+
+def update_content_digest(sender, **kwargs):
+    """
+    Keeps the ContentDigest of a saved ContentBlock up to date with its content
+    binding and content. A content block whose content another content block
+    already has is left without one.
+    """
+    if kwargs['raw']:
+        return
+
+    instance = kwargs['instance']
+    if not kwargs['created']:
+        attach_stored_content([instance])
+    digest = ContentDigest.get_digest(instance.content_binding_and_subtype_id, instance.content)
+    current = ContentDigest.objects.filter(content_block=instance)
+    if current.filter(digest=digest).exists():
+        return
+    current.delete()
+    if ContentDigest.objects.filter(digest=digest).exists():
+        return
+    try:
+        with transaction.atomic():
+            ContentDigest.objects.create(content_block=instance, digest=digest)
+    except IntegrityError:  # Another transaction saved the same content first
+        pass
+
+
+def store_saved_content(sender, **kwargs):
+    """
+    Moves the content of a saved ContentBlock into the content store
+    """
+    if kwargs['raw']:
+        return
+    store_content([kwargs['instance']])
+
+
+def remove_collection_counts(sender, **kwargs):
+    """
+    Takes a ContentBlock about to be deleted out of the CollectionCounts
+    of its Data Collections. Its CollectionMembership rows are deleted with it.
+    """
+    add_collection_counts(CollectionMembership.objects.filter(content_block=kwargs['instance']), -1)
+
+
+def release_blob(sender, **kwargs):
+    """
+    Removes a deleted StoredContent's reference to its ContentBlob
+    """
+    ContentBlob.objects.filter(pk=kwargs['instance'].blob_id).update(reference_count=F('reference_count') - 1)
+
+
+m2m_changed.connect(update_collection_index, sender=DataCollection.content_blocks.through)
+post_save.connect(update_collection_index_labels, sender=ContentBlock)
+post_save.connect(update_content_fields, sender=ContentBlock)
+post_save.connect(update_content_digest, sender=ContentBlock)
+post_save.connect(store_saved_content, sender=ContentBlock)
+pre_delete.connect(remove_collection_counts, sender=ContentBlock)
+post_delete.connect(release_blob, sender=StoredContent)
+connection_created.connect(configure_sqlite)
@@ -0,0 +1,162 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# Notices of new content in Data Collections, for long polls (see
+# yeti.poll_handlers.WaitingPollRequest11Handler). Once they have committed
+# content to a Data Collection, YETI's Inbox handlers increment its counter
+# in the store (see yeti.store). Each process reads the counters of the Data
+# Collections its polls have asked about every YETI_LONG_POLL_CHECK_INTERVAL
+# seconds, in one thread, and wakes the polls waiting on any that changed.
+# Content committed in the same process wakes them right away.
+
+from yeti.store import StoreError, get_key, get_store
+
+from django.conf import settings
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class WaitForContent(Exception):
+    """
+    Raised by a Poll Request handler under a server that waits for content
+    itself (see yeti.green), instead of waiting in the handler's thread.
+    The server calls the application again once the Data Collection's
+    counter is no longer generation, or at deadline.
+    """
+
+    def __init__(self, collection_name, generation, deadline):
+        super(WaitForContent, self).__init__(collection_name, generation, deadline)
+        self.collection_name = collection_name
+        self.generation = generation
+        self.deadline = deadline
+
+
+class ContentNotifier(object):
+    """
+    The counters of new content in Data Collections, by Data Collection name
+    """
+
+    def __init__(self):
+        self._generations = {}  # Data Collection name: the value of its counter last seen
+        self._empty = {}  # Key: (generation, timestamp label) of the last poll found empty
+        self._listeners = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def publish(self, collection_names):
+        """
+        Tells the polls of every process that content was added to
+        the named Data Collections. Call it after the content is committed.
+        """
+        generations = {}
+        for name in collection_names:
+            try:
+                generations[name] = str(get_store().incr(get_key('content', name)))
+            except StoreError:
+                log.exception("Cannot tell other processes about new content in %s", name)
+        self._update(generations)
+
+    def get_generation(self, collection_name):
+        """
+        Returns the counter of the named Data Collection, as of the last check,
+        and keeps checking it. Returns None if the store cannot be reached.
+        """
+        generation = self._generations.get(collection_name)
+        if generation is not None:
+            return generation
+
+        try:
+            generation = get_store().get(get_key('content', collection_name)) or '0'
+        except StoreError:
+            log.exception("Cannot read the content counter of %s", collection_name)
+            return None
+
+        with self._condition:
+            generation = self._generations.setdefault(collection_name, generation)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='yeti.notify')
+                self._thread.daemon = True
+                self._thread.start()
+        return generation
+
+    def peek(self, collection_name):
+        """
+        Returns the counter of the named Data Collection as of the last check,
+        without reading the store
+        """
+        return self._generations.get(collection_name)
+
+    def wait(self, collection_name, generation, timeout):
+        """
+        Blocks until the counter of the named Data Collection is no
+        longer generation, or for timeout seconds.
+
+        Returns:
+            True if the counter changed
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._generations.get(collection_name) == generation:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def add_listener(self, listener):
+        """
+        Calls listener (with no arguments, from any thread)
+        each time the counter of a Data Collection changes
+        """
+        self._listeners.append(listener)
+
+    def set_empty(self, key, generation, timestamp_label):
+        """
+        Records that a poll (identified by key) of everything after timestamp_label
+        found no content while the Data Collection's counter was generation
+        """
+        self._empty[key] = (generation, timestamp_label)
+
+    def is_empty(self, key, generation, timestamp_label):
+        """
+        Returns True if a poll (identified by key) of content after timestamp_label
+        is known to find nothing while the Data Collection's counter is generation
+        """
+        empty = self._empty.get(key)
+        return empty is not None and empty[0] == generation and timestamp_label >= empty[1]
+
+    def clear(self):
+        with self._condition:
+            self._generations = {}
+            self._empty = {}
+
+    def _update(self, generations):
+        with self._condition:
+            changed = False
+            for name, generation in generations.items():
+                if self._generations.get(name) != generation:
+                    self._generations[name] = generation
+                    changed = True
+            if changed:
+                self._condition.notify_all()
+        if changed:
+            for listener in self._listeners:
+                listener()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.YETI_LONG_POLL_CHECK_INTERVAL)
+            generations = {}
+            for name in list(self._generations):
+                try:
+                    generations[name] = get_store().get(get_key('content', name)) or '0'
+                except StoreError:
+                    log.debug("Cannot read the content counter of %s", name, exc_info=True)
+            self._update(generations)
+
+
+#: The notifier of this process
+content_notifier = ContentNotifier()
@@ -0,0 +1,291 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# An incremental front end for libtaxii's message parsers, used by YETI's
+# service router. The request body is fed in pieces to a per-thread lxml
+# pull parser, which validates it against a cached TAXII schema as it goes.
+# The message type is checked as soon as the root element starts, before
+# the rest of the message is read. Each Content Block is turned into a libtaxii
+# ContentBlock (with its content as a string) and removed from the tree as
+# soon as it has been parsed, so the tree never holds more than one Content Block.
+
+from taxii_services.exceptions import StatusMessageException
+from taxii_services.views import PV_ERR
+
+import libtaxii.messages_11 as tm11
+import libtaxii.messages_10 as tm10
+from libtaxii.common import get_xml_parser
+from libtaxii.constants import *
+from libtaxii.validation import TAXII_10_SCHEMA, TAXII_11_SCHEMA
+
+from django.conf import settings
+from lxml import etree
+import sys
+import threading
+
+#: Number of bytes of the request body fed to the parser at a time
+FEED_SIZE = 64 * 1024
+
+
+class SerializedContentMixin(object):
+    """
+    Mixin for a libtaxii ContentBlock that keeps XML content as a string.
+    libtaxii keeps it as an element of the request's parse tree, which keeps
+    the whole tree alive. The string is only parsed again if the Content Block
+    itself is serialized.
+    """
+
+    @property
+    def content(self):
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content, self.content_is_xml = self._stringify_content(value)
+        if self.content_is_xml:
+            self._content = etree.tostring(self._content)
+
+    def _with_content_element(self, method):
+        content = self._content
+        if self.content_is_xml:
+            self._content = etree.fromstring(content, get_xml_parser())
+        try:
+            return method()
+        finally:
+            self._content = content
+
+    def to_etree(self):
+        return self._with_content_element(super(SerializedContentMixin, self).to_etree)
+
+    def to_dict(self):
+        return self._with_content_element(super(SerializedContentMixin, self).to_dict)
+
+
+class ContentBlock11(SerializedContentMixin, tm11.ContentBlock):
+    """
+    A tm11.ContentBlock that keeps XML content as a string
+    """
+
+    @staticmethod
+    def from_etree(etree_xml):
+        cb = tm11.ContentBlock.from_etree(etree_xml)
+        return ContentBlock11(cb.content_binding, cb._content, cb.timestamp_label, cb.padding, cb.message)
+
+
+class ContentBlock10(SerializedContentMixin, tm10.ContentBlock):
+    """
+    A tm10.ContentBlock that keeps XML content as a string
+    """
+
+    @staticmethod
+    def from_etree(etree_xml):
+        cb = tm10.ContentBlock.from_etree(etree_xml)
+        return ContentBlock10(cb.content_binding, cb._content, cb.timestamp_label, cb.padding)
+
+
+class TaxiiXmlFormat(object):
+    """
+    How to parse one X-TAXII-Content-Type
+    """
+
+    def __init__(self, namespace, schema_file, content_block_class, message_classes):
+        self.namespace = namespace
+        self.schema_file = schema_file
+        self.content_block_class = content_block_class
+        self.message_classes = message_classes
+        self.content_block_tag = '{%s}Content_Block' % namespace
+
+
+#: Maps each supported X-TAXII-Content-Type to its TaxiiXmlFormat
+FORMATS = {
+    VID_TAXII_XML_11: TaxiiXmlFormat(ns_map['taxii_11'], TAXII_11_SCHEMA, ContentBlock11, {
+        MSG_DISCOVERY_REQUEST: tm11.DiscoveryRequest,
+        MSG_DISCOVERY_RESPONSE: tm11.DiscoveryResponse,
+        MSG_COLLECTION_INFORMATION_REQUEST: tm11.CollectionInformationRequest,
+        MSG_COLLECTION_INFORMATION_RESPONSE: tm11.CollectionInformationResponse,
+        MSG_POLL_REQUEST: tm11.PollRequest,
+        MSG_POLL_RESPONSE: tm11.PollResponse,
+        MSG_STATUS_MESSAGE: tm11.StatusMessage,
+        MSG_INBOX_MESSAGE: tm11.InboxMessage,
+        MSG_MANAGE_COLLECTION_SUBSCRIPTION_REQUEST: tm11.ManageCollectionSubscriptionRequest,
+        MSG_MANAGE_COLLECTION_SUBSCRIPTION_RESPONSE: tm11.ManageCollectionSubscriptionResponse,
+        MSG_POLL_FULFILLMENT_REQUEST: tm11.PollFulfillmentRequest}),
+    VID_TAXII_XML_10: TaxiiXmlFormat(ns_map['taxii'], TAXII_10_SCHEMA, ContentBlock10, {
+        MSG_DISCOVERY_REQUEST: tm10.DiscoveryRequest,
+        MSG_DISCOVERY_RESPONSE: tm10.DiscoveryResponse,
+        MSG_FEED_INFORMATION_REQUEST: tm10.FeedInformationRequest,
+        MSG_FEED_INFORMATION_RESPONSE: tm10.FeedInformationResponse,
+        MSG_POLL_REQUEST: tm10.PollRequest,
+        MSG_POLL_RESPONSE: tm10.PollResponse,
+        MSG_STATUS_MESSAGE: tm10.StatusMessage,
+        MSG_INBOX_MESSAGE: tm10.InboxMessage,
+        MSG_MANAGE_FEED_SUBSCRIPTION_REQUEST: tm10.ManageFeedSubscriptionRequest,
+        MSG_MANAGE_FEED_SUBSCRIPTION_RESPONSE: tm10.ManageFeedSubscriptionResponse}),
+}
+
+# lxml parsers and schemas must not be used by two threads at once
+_local = threading.local()
+
+
+def get_schema(xml_format):
+    """
+    Returns this thread's etree.XMLSchema for a TaxiiXmlFormat
+    """
+    schemas = _local.__dict__.setdefault('schemas', {})
+    schema = schemas.get(xml_format.schema_file)
+    if schema is None:
+        schema = etree.XMLSchema(etree.parse(xml_format.schema_file))
+        schemas[xml_format.schema_file] = schema
+    return schema
+
+
+def get_parser(xml_format, validate):
+    """
+    Returns this thread's etree.XMLPullParser for a TaxiiXmlFormat. It has
+    the same options as libtaxii.common.get_xml_parser(), and also validates
+    against the TAXII schema if validate is True.
+    """
+    parsers = _local.__dict__.setdefault('parsers', {})
+    key = (xml_format.schema_file, validate)
+    parser = parsers.get(key)
+    if parser is None:
+        parser = etree.XMLPullParser(events=('start', 'end'),
+                                     tag='{%s}*' % xml_format.namespace,  # No events for the content
+                                     schema=get_schema(xml_format) if validate else None,
+                                     attribute_defaults=False,
+                                     dtd_validation=False,
+                                     load_dtd=False,
+                                     no_network=True,
+                                     ns_clean=True,
+                                     recover=False,
+                                     remove_blank_text=False,
+                                     remove_comments=False,
+                                     remove_pis=False,
+                                     strip_cdata=True,
+                                     compact=True,
+                                     resolve_entities=False,
+                                     huge_tree=False)
+        parsers[key] = parser
+    return parser
+
+
+def discard_parser(xml_format, validate):
+    """
+    Drops this thread's parser for a TaxiiXmlFormat, after it has failed part way through a message
+    """
+    _local.__dict__.get('parsers', {}).pop((xml_format.schema_file, validate), None)
+
+
+class MessageBuilder(object):
+    """
+    Consumes the parser events of one TAXII Message
+    """
+
+    def __init__(self, xml_format):
+        self.xml_format = xml_format
+        self.root = None
+        self.message_class = None
+        self.content_blocks = []
+        self.error = None
+        self.complete = False
+
+    def handle_event(self, event, element):
+        if self.root is None:  # The start of the root element
+            if element.getparent() is not None:
+                raise ValueError('The message is not in the %s namespace' % self.xml_format.namespace)
+            qn = etree.QName(element)
+            self.message_class = self.xml_format.message_classes.get(qn.localname)
+            if self.message_class is None:
+                raise ValueError('Unknown message_type: %s' % qn.localname)
+            self.root = element
+        elif element is self.root:
+            self.complete = event == 'end'
+        elif event == 'end' and element.tag == self.xml_format.content_block_tag and element.getparent() is self.root:
+            if self.error is None:
+                try:
+                    self.content_blocks.append(self.xml_format.content_block_class.from_etree(element))
+                except Exception:
+                    # The parser only raises schema errors when it is closed. Those explain
+                    # the problem better, so this is raised only if there are none.
+                    self.error = sys.exc_info()
+            element.clear()
+
+    def get_message(self):
+        """
+        Returns the libtaxii message, once the whole message has been parsed
+        """
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        for element in self.root.findall(self.xml_format.content_block_tag):
+            self.root.remove(element)
+        message = self.message_class.from_etree(self.root)
+        if hasattr(message, 'content_blocks'):  # Inbox Messages and Poll Responses
+            message.content_blocks = self.content_blocks
+        return message
+
+
+def parse_message(xml_string, xtct, validate=True):
+    """
+    Parses a TAXII Message.
+
+    Arguments:
+        xml_string (str) - The XML of the message
+        xtct (str) - The X-TAXII-Content-Type of the message (a key of FORMATS)
+        validate (bool) - Whether to validate the message against the TAXII schema
+
+    Returns:
+        A libtaxii message, the same as the get_message_from_xml() function of the
+        libtaxii module for xtct would have returned
+
+    Raises:
+        etree.XMLSyntaxError if the message is not well-formed XML or (if validate
+        is True) not schema valid, and ValueError if the root element is not a
+        TAXII Message
+    """
+    xml_format = FORMATS[xtct]
+    parser = get_parser(xml_format, validate)
+    builder = MessageBuilder(xml_format)
+    try:
+        for i in range(0, len(xml_string), FEED_SIZE):
+            parser.feed(xml_string[i:i + FEED_SIZE])
+            for event, element in parser.read_events():
+                builder.handle_event(event, element)
+        parser.close()
+        for event, element in parser.read_events():
+            builder.handle_event(event, element)
+    except Exception:
+        discard_parser(xml_format, validate)
+        raise
+    if builder.root is None:  # The parser only reports TAXII elements
+        raise ValueError('The message is not in the %s namespace' % xml_format.namespace)
+    if not builder.complete:
+        # A schema-validating parser can stop at a well-formedness error without raising it
+        discard_parser(xml_format, validate)
+        raise etree.XMLSyntaxError('The message ended before its root element was closed', None, 0, 0)
+    return builder.get_message()
+
+
+def parse_request(request, xtct, validate=True):
+    """
+    Checks the size of a Django request's body and parses it with `parse_message()`.
+
+    Raises:
+        StatusMessageException if the body is larger than YETI_MAX_MESSAGE_SIZE
+        or cannot be parsed
+    """
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > settings.YETI_MAX_MESSAGE_SIZE:  # Checked before the body is read
+        raise StatusMessageException('0', ST_BAD_MESSAGE,
+                                     'The request message is larger than %s bytes.' % settings.YETI_MAX_MESSAGE_SIZE)
+
+    try:
+        return parse_message(request.body, xtct, validate)
+    except (etree.XMLSyntaxError, ValueError) as e:
+        if settings.DEBUG is True:
+            msg = 'Request was not well-formed, schema valid TAXII XML: %s' % e
+        else:
+            msg = PV_ERR
+        raise StatusMessageException('0', ST_BAD_MESSAGE, msg)
@@ -0,0 +1,559 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.exceptions import StatusMessageException
+from taxii_services.message_handlers.base_handlers import BaseMessageHandler
+from taxii_services.message_handlers.poll_request_handlers import PollRequest10Handler, PollRequest11Handler
+from taxii_services.message_handlers.poll_fulifllment_request_handlers import PollFulfillmentRequest11Handler
+from taxii_services.models import ContentBlock, ResultSet, ResultSetPart
+
+from yeti.messages import StreamingMessage
+from yeti.models import (CollectionMembership, ResultSetCursor, ResultSetSnapshot, attach_stored_content,
+                         count_collection_content)
+from yeti.notify import WaitForContent, content_notifier
+
+import libtaxii.messages_11 as tm11
+import libtaxii.messages_10 as tm10
+from libtaxii.constants import *
+from libtaxii.common import generate_message_id
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from datetime import timedelta
+import time
+
+#: The related objects needed to turn a ContentBlock into a libtaxii ContentBlock
+CONTENT_BLOCK_RELATED = ('content_binding_and_subtype__content_binding',
+                         'content_binding_and_subtype__subtype')
+
+
+def iterate_content(content, batch_size=None, serialized=False):
+    """
+    Iterates over content without holding all of it in memory.
+
+    QuerySets of ContentBlocks or of yeti.models.CollectionMembership rows
+    (e.g., from get_indexed_content) are read in batches of `batch_size` rows,
+    ordered by (timestamp label, content block id), each batch picking up
+    after the key of the last row of the previous batch. Every batch is a
+    short, index-friendly query, so no cursor is held open while the response
+    is being written. CollectionMembership rows are yielded as their content
+    blocks. Anything else is iterated as-is, `batch_size` items at a time.
+    Content blocks whose content is in the content store (see
+    yeti.content_store) are yielded with their content, read once per batch,
+    or if serialized is True, with the serialized content to splice into a
+    StreamingMessage where the file store has it.
+    """
+    if batch_size is None:
+        batch_size = settings.YETI_POLL_STREAM_BATCH_SIZE
+
+    if not isinstance(content, QuerySet):
+        batch = []
+        for item in content:
+            batch.append(item)
+            if len(batch) == batch_size:
+                for item in attach_stored_content(batch, serialized):
+                    yield item
+                batch = []
+        for item in attach_stored_content(batch, serialized):
+            yield item
+        return
+
+    membership = content.model is CollectionMembership
+    if membership:
+        related = ['content_block__' + field for field in CONTENT_BLOCK_RELATED]
+        key_field = 'content_block'
+    else:
+        related = CONTENT_BLOCK_RELATED
+        key_field = 'pk'
+
+    content = content.select_related(*related).order_by('timestamp_label', key_field)
+    last = None
+    while True:
+        batch = content
+        if last is not None:
+            batch = batch.filter(Q(timestamp_label__gt=last.timestamp_label) |
+                                 Q(**{'timestamp_label': last.timestamp_label, key_field + '__gt': last.pk}))
+        batch = list(batch[:batch_size])
+        if membership:
+            batch = [m.content_block for m in batch]
+
+        for item in attach_stored_content(batch, serialized):
+            yield item
+
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+
+
+def get_indexed_content(prp):
+    """
+    Returns the content of a Poll Request as a yeti.models.CollectionMembership
+    QuerySet, so the database answers it with a seek on the
+    (collection, timestamp_label) index.
+
+    Arguments:
+        prp (taxii_services.util.PollRequestProperties) - The Poll Request Properties of the Poll Request
+    """
+    kwargs = {'collection': prp.collection}
+    if prp.collection.type == CT_DATA_FEED:
+        if prp.exclusive_begin_timestamp_label:
+            kwargs['timestamp_label__gt'] = prp.exclusive_begin_timestamp_label
+        if prp.inclusive_end_timestamp_label:
+            kwargs['timestamp_label__lte'] = prp.inclusive_end_timestamp_label
+    if prp.content_bindings:
+        kwargs['content_binding_and_subtype__in'] = prp.content_bindings
+
+    return CollectionMembership.objects.filter(**kwargs).order_by('timestamp_label', 'content_block')
+
+
+def create_result_set(poll_service, prp, content):
+    """
+    Creates a multi-part result set from a CollectionMembership QuerySet
+    (see get_indexed_content). Unlike taxii_services.handlers.create_result_set,
+    no content blocks are stored: one pass over the (timestamp label, content block id)
+    keys of the content records where each part starts and ends as a
+    yeti.models.ResultSetCursor.
+
+    Returns the ResultSetSnapshot of the new result set.
+    """
+    part_size = poll_service.max_result_size
+    cursors = []
+    keys = content.order_by('timestamp_label', 'content_block').values_list('timestamp_label', 'content_block')
+    for i, (timestamp_label, content_block_id) in enumerate(keys.iterator()):
+        if i % part_size == 0:
+            cursor = ResultSetCursor(part_number=len(cursors) + 1,
+                                     first_timestamp_label=timestamp_label,
+                                     first_content_block_id=content_block_id,
+                                     content_block_count=0,
+                                     more=True)
+            cursors.append(cursor)
+        cursor.last_timestamp_label = timestamp_label
+        cursor.last_content_block_id = content_block_id
+        cursor.content_block_count += 1
+
+    # Timestamp labels work the same way as in the built-in result sets
+    previous = None
+    for cursor in cursors:
+        if prp.collection.type == CT_DATA_FEED:
+            if previous is None:
+                cursor.exclusive_begin_timestamp_label = prp.exclusive_begin_timestamp_label
+            else:
+                cursor.exclusive_begin_timestamp_label = previous.last_timestamp_label
+            cursor.inclusive_end_timestamp_label = cursor.last_timestamp_label
+        previous = cursor
+    if cursors:
+        cursors[-1].more = False
+        if prp.collection.type == CT_DATA_FEED:
+            cursors[-1].inclusive_end_timestamp_label = prp.inclusive_end_timestamp_label
+
+    with transaction.atomic():
+        result_set = ResultSet(data_collection=prp.collection,
+                               subscription=prp.subscription,
+                               total_content_blocks=sum(c.content_block_count for c in cursors),
+                               expires=timezone.now() + timedelta(seconds=settings.YETI_RESULT_SET_TTL))
+        result_set.save()
+        snapshot = ResultSetSnapshot.objects.create(result_set=result_set)
+        if prp.content_bindings:
+            snapshot.content_bindings = prp.content_bindings
+        for cursor in cursors:
+            cursor.snapshot = snapshot
+        ResultSetCursor.objects.bulk_create(cursors)
+
+    return snapshot
+
+
+def create_result_set_poll_response(cursor, in_response_to):
+    """
+    Returns a yeti.messages.StreamingMessage wrapping
+    a tm11.PollResponse for one part of a result set.
+
+    Arguments:
+        cursor (yeti.models.ResultSetCursor) - The result set part
+        in_response_to (str) - The message_id of the request
+    """
+    result_set = cursor.snapshot.result_set
+    envelope = tm11.PollResponse(message_id=generate_message_id(),
+                                 in_response_to=in_response_to,
+                                 collection_name=result_set.data_collection.name,
+                                 result_id=str(result_set.pk),
+                                 result_part_number=cursor.part_number,
+                                 more=cursor.more,
+                                 exclusive_begin_timestamp_label=cursor.exclusive_begin_timestamp_label,
+                                 inclusive_end_timestamp_label=cursor.inclusive_end_timestamp_label,
+                                 record_count=tm11.RecordCount(result_set.total_content_blocks, False))
+    if result_set.subscription:
+        envelope.subscription_id = result_set.subscription.subscription_id
+
+    return StreamingMessage(envelope,
+                            iterate_content(cursor.get_content(), serialized=True),
+                            lambda content_block: content_block.to_content_block_11())
+
+
+def count_content(content):
+    """
+    Counts content without fetching it
+    """
+    if isinstance(content, QuerySet):
+        return content.count()
+    return len(content)
+
+
+class StreamingPollRequest11Handler(PollRequest11Handler):
+    """
+    TAXII 1.1 Poll Request Handler that streams single-part Poll Responses
+    instead of building them in memory.
+    """
+
+    supported_request_messages = [tm11.PollRequest]
+    version = "1"
+
+    @classmethod
+    def count_content(cls, prp, content):
+        """
+        Returns the number of content blocks in content
+        """
+        return count_content(content)
+
+    @classmethod
+    def create_multipart_response(cls, poll_service, prp, content):
+        """
+        Returns the first part of a multi-part result set, created by the built-in handler
+        """
+        return super(StreamingPollRequest11Handler, cls).create_poll_response(poll_service, prp, content)
+
+    @classmethod
+    def create_poll_response(cls, poll_service, prp, content):
+        """
+        Creates a poll response.
+
+        Content is counted once (see count_content), without being fetched.
+        A Count Only response carries just that count. Multi-part responses are
+        created by create_multipart_response. A Full response that fits in a
+        single part is returned as a yeti.messages.StreamingMessage, so only
+        a batch of content blocks is in memory at any one time.
+        """
+        content_count = cls.count_content(prp, content)
+
+        if (prp.response_type == RT_FULL and
+            poll_service.max_result_size is not None and
+            content_count > poll_service.max_result_size):
+            return cls.create_multipart_response(poll_service, prp, content)
+
+        envelope = tm11.PollResponse(message_id=generate_message_id(),
+                                     in_response_to=prp.message_id,
+                                     collection_name=prp.collection.name,
+                                     result_part_number=1,
+                                     more=False,
+                                     exclusive_begin_timestamp_label=prp.exclusive_begin_timestamp_label,
+                                     inclusive_end_timestamp_label=prp.inclusive_end_timestamp_label,
+                                     record_count=tm11.RecordCount(content_count, False))
+        if prp.subscription:
+            envelope.subscription_id = prp.subscription.subscription_id
+
+        if prp.response_type == RT_COUNT_ONLY:
+            return envelope
+
+        return StreamingMessage(envelope,
+                                iterate_content(content, serialized=True),
+                                lambda content_block: content_block.to_content_block_11())
+
+
+class StreamingPollRequest10Handler(PollRequest10Handler):
+    """
+    TAXII 1.0 Poll Request Handler that streams Poll Responses
+    instead of building them in memory.
+    """
+
+    supported_request_messages = [tm10.PollRequest]
+    version = "1"
+
+    @classmethod
+    def create_poll_response(cls, poll_service, prp, content_blocks):
+        """
+        Returns a yeti.messages.StreamingMessage wrapping a tm10.PollResponse.
+        """
+        ietl = prp.exclusive_begin_timestamp_label
+        if ietl is not None:
+            ietl += timedelta(milliseconds=1)
+
+        envelope = tm10.PollResponse(message_id=generate_message_id(),
+                                     in_response_to=prp.message_id,
+                                     feed_name=prp.collection.name,
+                                     inclusive_begin_timestamp_label=ietl,
+                                     inclusive_end_timestamp_label=prp.inclusive_end_timestamp_label)
+
+        return StreamingMessage(envelope,
+                                iterate_content(content_blocks, serialized=True),
+                                lambda content_block: content_block.to_content_block_10())
+
+
+class StreamingPollRequestHandler(BaseMessageHandler):
+    """
+    TAXII 1.1 and TAXII 1.0 Poll Request Handler that streams Poll Responses.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+
+    supported_request_messages = [tm10.PollRequest, tm11.PollRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(poll_service, poll_request, django_request):
+        """
+        Passes the request to either StreamingPollRequest10Handler or StreamingPollRequest11Handler
+        """
+        if isinstance(poll_request, tm10.PollRequest):
+            return StreamingPollRequest10Handler.handle_message(poll_service, poll_request, django_request)
+        elif isinstance(poll_request, tm11.PollRequest):
+            return StreamingPollRequest11Handler.handle_message(poll_service, poll_request, django_request)
+        else:
+            raise StatusMessageException(poll_request.message_id,
+                                         ST_FAILURE,
+                                         "TAXII Message not supported by Message Handler.")
+
+
+class IndexedPollRequest11Handler(StreamingPollRequest11Handler):
+    """
+    TAXII 1.1 Poll Request Handler that finds content through
+    the yeti.models.CollectionMembership index and streams it.
+    Multi-part result sets are stored as yeti.models.ResultSetCursors,
+    which IndexedPollFulfillmentRequest11Handler serves.
+    """
+
+    supported_request_messages = [tm11.PollRequest]
+    version = "1"
+
+    @classmethod
+    def get_content(cls, prp, query_kwargs):
+        """
+        Returns the result of get_indexed_content(prp). query_kwargs
+        (ContentBlock lookups) is ignored, but a Query Handler's
+        update_db_kwargs() is still called with it before this.
+
+        If the request has a query, the Query Handler's filter_content()
+        needs ContentBlocks, so the matching ContentBlocks are returned instead.
+        """
+        content = get_indexed_content(prp)
+        if prp.supported_query:
+            return ContentBlock.objects.filter(pk__in=content.values('content_block')).order_by('timestamp_label')
+        return content
+
+    @classmethod
+    def count_content(cls, prp, content):
+        """
+        Indexed content is counted from the yeti.models.CollectionCount time
+        buckets of the Data Collection (see count_collection_content), so a
+        Count Only response, or one that overflows the Poll Service's
+        max_result_size, does not read every CollectionMembership row.
+        """
+        if not (isinstance(content, QuerySet) and content.model is CollectionMembership):
+            return count_content(content)
+
+        if prp.collection.type == CT_DATA_FEED:
+            return count_collection_content(prp.collection, prp.content_bindings,
+                                            prp.exclusive_begin_timestamp_label, prp.inclusive_end_timestamp_label)
+        return count_collection_content(prp.collection, prp.content_bindings)
+
+    @classmethod
+    def create_multipart_response(cls, poll_service, prp, content):
+        """
+        When indexed content does not fit in a single part, a result set
+        of keyset cursors is created (see create_result_set) and its first
+        part is returned. Other content is passed to the built-in handler.
+        """
+        if isinstance(content, QuerySet) and content.model is CollectionMembership:
+            snapshot = create_result_set(poll_service, prp, content)
+            cursor = snapshot.resultsetcursor_set.get(part_number=1)
+            return create_result_set_poll_response(cursor, prp.message_id)
+
+        return super(IndexedPollRequest11Handler, cls).create_multipart_response(poll_service, prp, content)
+
+
+class IndexedPollRequest10Handler(StreamingPollRequest10Handler):
+    """
+    TAXII 1.0 Poll Request Handler that finds content through
+    the yeti.models.CollectionMembership index and streams it.
+    """
+
+    supported_request_messages = [tm10.PollRequest]
+    version = "1"
+
+    @classmethod
+    def get_content(cls, prp, query_kwargs):
+        """
+        Returns the result of get_indexed_content(prp)
+        """
+        return get_indexed_content(prp)
+
+
+class IndexedPollRequestHandler(BaseMessageHandler):
+    """
+    TAXII 1.1 and TAXII 1.0 Poll Request Handler that finds content through
+    the yeti.models.CollectionMembership index and streams it.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+
+    supported_request_messages = [tm10.PollRequest, tm11.PollRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(poll_service, poll_request, django_request):
+        """
+        Passes the request to either IndexedPollRequest10Handler or IndexedPollRequest11Handler
+        """
+        if isinstance(poll_request, tm10.PollRequest):
+            return IndexedPollRequest10Handler.handle_message(poll_service, poll_request, django_request)
+        elif isinstance(poll_request, tm11.PollRequest):
+            return IndexedPollRequest11Handler.handle_message(poll_service, poll_request, django_request)
+        else:
+            raise StatusMessageException(poll_request.message_id,
+                                         ST_FAILURE,
+                                         "TAXII Message not supported by Message Handler.")
+
+
+def is_empty_poll_response(response):
+    """
+    Returns True if response is a single-part Poll Response without content
+    """
+    envelope = getattr(response, 'envelope', response)  # A yeti.messages.StreamingMessage's, or a libtaxii message
+    return (isinstance(envelope, tm11.PollResponse) and
+            not envelope.more and
+            envelope.record_count is not None and
+            envelope.record_count.record_count == 0)
+
+
+def is_unfiltered_poll_request(poll_request):
+    """
+    Returns True if poll_request asks for all content (after its
+    Exclusive Begin Timestamp Label), rather than some of it
+    """
+    poll_parameters = poll_request.poll_parameters
+    return (poll_request.subscription_id is None and
+            poll_parameters is not None and
+            not poll_parameters.content_bindings and
+            poll_parameters.query is None)
+
+
+class WaitingPollRequest11Handler(IndexedPollRequest11Handler):
+    """
+    TAXII 1.1 Poll Request Handler for long polls. A Poll Request with an
+    Exclusive Begin Timestamp Label and no Inclusive End Timestamp Label that
+    finds no content waits, for up to YETI_LONG_POLL_TIMEOUT seconds, until
+    YETI's Inbox handlers add content to the Data Collection (see yeti.notify),
+    and then polls again. Each request polls the database when it arrives;
+    a waiting poll that is known to find nothing while the Data Collection is
+    unchanged is not polled again when it times out, or when yeti.green calls
+    the application again. Otherwise the same as IndexedPollRequest11Handler.
+    """
+
+    supported_request_messages = [tm11.PollRequest]
+    version = "1"
+
+    @classmethod
+    def handle_message(cls, poll_service, poll_request, django_request):
+        """
+        Polls, and waits for new content while the response would be empty.
+
+        Under yeti.green, which waits for content without holding a thread,
+        raises yeti.notify.WaitForContent instead of waiting.
+        """
+        poll = super(WaitingPollRequest11Handler, cls).handle_message
+        if (poll_request.exclusive_begin_timestamp_label is None or
+            poll_request.inclusive_end_timestamp_label is not None):
+            return poll(poll_service, poll_request, django_request)
+
+        collection_name = poll_request.collection_name
+        begin = poll_request.exclusive_begin_timestamp_label
+        empty_key = (poll_service.path, collection_name)
+        # Set when yeti.green calls the application again after waiting
+        resumed = 'yeti.poll_deadline' in django_request.META
+        deadline = django_request.META.get('yeti.poll_deadline') or time.time() + settings.YETI_LONG_POLL_TIMEOUT
+
+        response = None
+        while True:
+            generation = content_notifier.get_generation(collection_name)
+            if generation is None:  # The store cannot be reached
+                return poll(poll_service, poll_request, django_request)
+
+            timed_out = time.time() >= deadline
+            # Content added without a notice (e.g., by the built-in Inbox handler) is found when a request arrives
+            if (response is None and (timed_out or not resumed)) or not content_notifier.is_empty(empty_key,
+                                                                                                 generation, begin):
+                response = poll(poll_service, poll_request, django_request)
+                if not is_empty_poll_response(response):
+                    return response
+                if is_unfiltered_poll_request(poll_request):
+                    content_notifier.set_empty(empty_key, generation, begin)
+
+            if timed_out:
+                return response
+            if 'yeti.green' in django_request.META:
+                raise WaitForContent(collection_name, generation, deadline)
+            content_notifier.wait(collection_name, generation, deadline - time.time())
+
+
+class WaitingPollRequestHandler(BaseMessageHandler):
+    """
+    TAXII 1.1 Poll Request Handler for long polls (see WaitingPollRequest11Handler).
+    TAXII 1.0 Poll Requests, whose responses have no record count, are answered
+    right away by IndexedPollRequest10Handler.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+
+    supported_request_messages = [tm10.PollRequest, tm11.PollRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(poll_service, poll_request, django_request):
+        """
+        Passes the request to either IndexedPollRequest10Handler or WaitingPollRequest11Handler
+        """
+        if isinstance(poll_request, tm10.PollRequest):
+            return IndexedPollRequest10Handler.handle_message(poll_service, poll_request, django_request)
+        elif isinstance(poll_request, tm11.PollRequest):
+            return WaitingPollRequest11Handler.handle_message(poll_service, poll_request, django_request)
+        else:
+            raise StatusMessageException(poll_request.message_id,
+                                         ST_FAILURE,
+                                         "TAXII Message not supported by Message Handler.")
+
+
+class IndexedPollFulfillmentRequest11Handler(PollFulfillmentRequest11Handler):
+    """
+    TAXII 1.1 Poll Fulfillment Request Handler that streams parts of result sets
+    created by IndexedPollRequest11Handler. Every part costs one index range read.
+    Other result sets are passed to the built-in handler.
+    Requires YETI's service router (yeti.views.service_router).
+    """
+
+    supported_request_messages = [tm11.PollFulfillmentRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(poll_service, poll_fulfillment_request, django_request):
+        """
+        Looks up the yeti.models.ResultSetCursor matching the request and returns its part
+        """
+        pfr = poll_fulfillment_request
+        try:
+            cursor = (ResultSetCursor.objects
+                      .select_related('snapshot__result_set__data_collection',
+                                      'snapshot__result_set__subscription')
+                      .get(snapshot__result_set=pfr.result_id,
+                           part_number=pfr.result_part_number,
+                           snapshot__result_set__data_collection__name=pfr.collection_name))
+        except ResultSetCursor.DoesNotExist:
+            cursor = None
+
+        if cursor is None or cursor.snapshot.result_set.expires < timezone.now():
+            if cursor is None and ResultSetPart.objects.filter(result_set=pfr.result_id).exists():
+                # A result set created by the built-in handlers
+                return PollFulfillmentRequest11Handler.handle_message(poll_service, pfr, django_request)
+
+            raise StatusMessageException(pfr.message_id,
+                                         ST_NOT_FOUND,
+                                         status_detail={SD_ITEM: str(pfr.result_id)})
+
+        return create_result_set_poll_response(cursor, pfr.message_id)
@@ -0,0 +1,392 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# Push delivery of Subscriptions. Content is queued for the push subscriptions
+# it matches as it is added to a Data Collection (see yeti.matching), and
+# fan_out() moves the queue of each active subscription into PushDeliveries
+# (see yeti.models) of up to YETI_PUSH_BATCH_SIZE content blocks, each sent as
+# one Inbox Message. A PushDeliverer claims due deliveries and sends them from a
+# pool of threads over persistent HTTP connections, with no more than
+# YETI_PUSH_MAX_CONNECTIONS_PER_DESTINATION requests to one Inbox Service at
+# a time. A delivery that fails is tried again later, with exponential backoff.
+# The deliver_subscriptions management command runs both.
+
+from taxii_services.models import ContentBlock
+
+from yeti.models import PushDelivery, PushSubscription, QueuedContent, attach_stored_content
+from yeti.parsing import parse_message
+
+import libtaxii.messages_11 as tm11
+import libtaxii.messages_10 as tm10
+from libtaxii.constants import *
+from libtaxii.common import generate_message_id
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+from datetime import timedelta
+from lxml import etree
+from multiprocessing.pool import ThreadPool
+import httplib
+import logging
+import select
+import socket
+import threading
+import urlparse
+
+log = logging.getLogger(__name__)
+
+#: The URL scheme of each supported Inbox Protocol
+PROTOCOL_SCHEMES = {VID_TAXII_HTTP_10: 'http',
+                    VID_TAXII_HTTPS_10: 'https'}
+
+#: The X-TAXII-Services of a pushed Inbox Message, by its Delivery Message Binding
+SERVICES_VERSIONS = {VID_TAXII_XML_11: VID_TAXII_SERVICES_11,
+                     VID_TAXII_XML_10: VID_TAXII_SERVICES_10}
+
+
+class Destination(object):
+    """
+    The connections of a ConnectionPool to one scheme, host and port
+    """
+
+    def __init__(self, max_connections):
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.idle = []  # Open connections that are not in use
+
+
+def is_dropped(connection):
+    """
+    Returns True if an idle connection can no longer be used: it was closed,
+    or the other end has closed it (or sent something unasked for)
+    """
+    if connection.sock is None:
+        return True
+    try:
+        readable, writable, errors = select.select([connection.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+class ConnectionPool(object):
+    """
+    Persistent HTTP and HTTPS connections to Inbox Services. A connection is
+    kept open (HTTP/1.1 keep-alive) after its response has been read and reused
+    for the next message to the same destination (scheme, host and port). At
+    most max_connections requests are sent to one destination at once; other
+    threads wait for one of them to finish. A message is only sent again on
+    another connection if it could not be sent on a reused one; once it has
+    been sent, a lost response is raised rather than risk delivering it twice.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, max_connections=None, timeout=None):
+        self.max_connections = max_connections  # Default: YETI_PUSH_MAX_CONNECTIONS_PER_DESTINATION
+        self.timeout = timeout  # Default: YETI_PUSH_TIMEOUT
+        self._destinations = {}
+        self._lock = threading.Lock()
+
+    def get_destination(self, key):
+        """
+        Returns the Destination for a (scheme, host, port) key
+        """
+        with self._lock:
+            destination = self._destinations.get(key)
+            if destination is None:
+                max_connections = self.max_connections or settings.YETI_PUSH_MAX_CONNECTIONS_PER_DESTINATION
+                destination = self._destinations[key] = Destination(max_connections)
+            return destination
+
+    def post(self, inbox_protocol, inbox_address, body, headers):
+        """
+        POSTs body to inbox_address.
+
+        Returns:
+            A tuple of (HTTP status, X-TAXII-Content-Type, response body)
+
+        Raises:
+            httplib.HTTPException or socket.error if no response was received
+        """
+        scheme = PROTOCOL_SCHEMES[inbox_protocol]
+        url = urlparse.urlsplit(inbox_address)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+
+        destination = self.get_destination((scheme, url.hostname, url.port))
+        with destination.slots:
+            while True:
+                try:
+                    connection, reused = destination.idle.pop(), True
+                except IndexError:
+                    connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+                    timeout = self.timeout or settings.YETI_PUSH_TIMEOUT
+                    connection, reused = connection_class(url.hostname, url.port, timeout=timeout), False
+                else:
+                    if is_dropped(connection):
+                        connection.close()
+                        continue
+
+                try:
+                    connection.request('POST', path, body, headers)
+                except (httplib.HTTPException, socket.error):
+                    connection.close()
+                    if reused:
+                        continue  # The request was not sent: the Inbox Service closed the idle connection
+                    raise
+
+                try:
+                    response = connection.getresponse()
+                    response_body = response.read()
+                except (httplib.HTTPException, socket.error):
+                    connection.close()  # The message may have been received, so it is not sent again here
+                    raise
+
+                if response.will_close:
+                    connection.close()
+                else:
+                    destination.idle.append(connection)
+                return response.status, response.getheader('X-TAXII-Content-Type'), response_body
+
+    def close(self):
+        """
+        Closes every idle connection
+        """
+        with self._lock:
+            destinations, self._destinations = self._destinations.values(), {}
+        for destination in destinations:
+            while destination.idle:
+                destination.idle.pop().close()
+
+
+def queue_new_content(push_subscription, batch_size):
+    """
+    Moves the QueuedContent of a PushSubscription into PushDeliveries
+    of at most batch_size content blocks, oldest first.
+    Returns the number of PushDeliveries queued.
+    """
+    content = (QueuedContent.objects.filter(push_subscription=push_subscription)
+                                    .order_by('timestamp_label', 'content_block'))
+    queued = 0
+    begin, count = push_subscription.queued_timestamp_label, push_subscription.queued_deliveries
+    while True:
+        rows = list(content.values_list('pk', 'timestamp_label', 'content_block')[:batch_size])
+        if not rows:
+            return queued
+
+        exclusive_begin, end = None, rows[-1][1]
+        if begin is not None:
+            # Content can arrive with an older timestamp label than content already sent
+            exclusive_begin = begin if begin < rows[0][1] else None
+            end = max(begin, end)
+        with transaction.atomic():
+            # Only one process moves the content that was read for delivery number `count`
+            advanced = PushSubscription.objects.filter(pk=push_subscription.pk, queued_deliveries=count
+                                                       ).update(queued_timestamp_label=end,
+                                                                queued_deliveries=count + 1)
+            if not advanced:
+                return queued
+            QueuedContent.objects.filter(pk__in=[pk for pk, label, content_block_id in rows]).delete()
+            PushDelivery.objects.create(push_subscription=push_subscription,
+                                        content_block_ids=','.join(str(content_block_id)
+                                                                   for pk, label, content_block_id in rows),
+                                        exclusive_begin_timestamp_label=exclusive_begin,
+                                        inclusive_end_timestamp_label=end,
+                                        next_attempt=timezone.now())
+        queued += 1
+        begin, count = end, count + 1
+
+
+def fan_out(batch_size=None):
+    """
+    Moves the QueuedContent of every active PushSubscription into PushDeliveries
+    of at most batch_size (default: YETI_PUSH_BATCH_SIZE) content blocks, and
+    drops the queues of Subscriptions that have been unsubscribed.
+    Returns the number of PushDeliveries queued.
+    """
+    batch_size = batch_size or settings.YETI_PUSH_BATCH_SIZE
+    unsubscribed = PushSubscription.objects.filter(subscription__status=SS_UNSUBSCRIBED)
+    PushDelivery.objects.filter(push_subscription__in=unsubscribed).delete()
+    QueuedContent.objects.filter(push_subscription__in=unsubscribed).delete()
+
+    queued = 0
+    with_content = QueuedContent.objects.values('push_subscription')
+    for push_subscription in PushSubscription.objects.active().filter(pk__in=with_content):
+        queued += queue_new_content(push_subscription, batch_size)
+    return queued
+
+
+def get_stats():
+    """
+    Returns a dict of the number of deliveries waiting to be sent (depth), the
+    age in seconds of the oldest of them (lag), and the number that failed
+    """
+    waiting = PushDelivery.objects.filter(failed=False)
+    oldest = waiting.aggregate(oldest=Min('date_created'))['oldest']
+    return {'depth': waiting.count(),
+            'lag': (timezone.now() - oldest).total_seconds() if oldest is not None else 0,
+            'failed': PushDelivery.objects.filter(failed=True).count()}
+
+
+def create_inbox_message(delivery):
+    """
+    Returns the libtaxii Inbox Message of a PushDelivery in its Delivery Message
+    Binding, or None if none of its content blocks exist any more
+    """
+    content_blocks = list(ContentBlock.objects.filter(pk__in=delivery.get_content_block_ids())
+                                              .select_related('content_binding_and_subtype__content_binding',
+                                                              'content_binding_and_subtype__subtype')
+                                              .order_by('timestamp_label', 'pk'))
+    if not content_blocks:
+        return None
+    attach_stored_content(content_blocks)
+
+    push_subscription = delivery.push_subscription
+    subscription = push_subscription.subscription
+    collection_name = subscription.data_collection.name
+    if push_subscription.delivery_message_binding == VID_TAXII_XML_10:
+        si = tm10.SubscriptionInformation(feed_name=collection_name,
+                                          subscription_id=str(subscription.subscription_id),
+                                          inclusive_begin_timestamp_label=content_blocks[0].timestamp_label,
+                                          inclusive_end_timestamp_label=delivery.inclusive_end_timestamp_label)
+        return tm10.InboxMessage(message_id=generate_message_id(),
+                                 subscription_information=si,
+                                 content_blocks=[cb.to_content_block_10() for cb in content_blocks])
+
+    si = tm11.SubscriptionInformation(collection_name=collection_name,
+                                      subscription_id=str(subscription.subscription_id),
+                                      exclusive_begin_timestamp_label=delivery.exclusive_begin_timestamp_label,
+                                      inclusive_end_timestamp_label=delivery.inclusive_end_timestamp_label)
+    return tm11.InboxMessage(message_id=generate_message_id(),
+                             subscription_information=si,
+                             content_blocks=[cb.to_content_block_11() for cb in content_blocks])
+
+
+def get_headers(push_subscription):
+    """
+    Returns the HTTP headers of an Inbox Message pushed to a PushSubscription
+    """
+    binding = push_subscription.delivery_message_binding
+    return {'Content-Type': 'application/xml',
+            'Accept': 'application/xml',
+            'X-TAXII-Content-Type': binding,
+            'X-TAXII-Accept': binding,
+            'X-TAXII-Services': SERVICES_VERSIONS[binding],
+            'X-TAXII-Protocol': push_subscription.inbox_protocol}
+
+
+def get_response_error(status, taxii_content_type, body):
+    """
+    Returns why an Inbox Service did not accept a pushed Inbox Message,
+    or None if it responded with a Status Message of Success
+    """
+    if status != 200:
+        return 'HTTP status %s' % status
+    try:
+        message = parse_message(body, taxii_content_type, validate=False)
+    except (KeyError, etree.XMLSyntaxError, ValueError) as e:
+        return 'The response was not a TAXII Message: %r' % e
+    if message.message_type != MSG_STATUS_MESSAGE:
+        return 'The response was a %s, not a Status Message' % message.message_type
+    if message.status_type != ST_SUCCESS:
+        return 'Status Message of %s: %s' % (message.status_type, message.message or '')
+    return None
+
+
+def schedule_retry(delivery, error):
+    """
+    Records a failed attempt to send a PushDelivery. It is tried again after
+    YETI_PUSH_RETRY_DELAY seconds, doubled for every attempt so far (up to
+    YETI_PUSH_MAX_RETRY_DELAY), or marked failed after YETI_PUSH_MAX_ATTEMPTS.
+    """
+    delivery.attempts += 1
+    delivery.error = error
+    if delivery.attempts >= settings.YETI_PUSH_MAX_ATTEMPTS:
+        log.error("Push delivery %s to %s failed: %s", delivery.pk, delivery.push_subscription.inbox_address, error)
+        delivery.failed = True
+    else:
+        delay = min(settings.YETI_PUSH_RETRY_DELAY * 2 ** (delivery.attempts - 1), settings.YETI_PUSH_MAX_RETRY_DELAY)
+        delivery.next_attempt = timezone.now() + timedelta(seconds=delay)
+    delivery.save()
+
+
+class PushDeliverer(object):
+    """
+    Sends PushDeliveries from a pool of `workers` threads sharing a
+    ConnectionPool. Only the calling thread uses the database.
+    """
+
+    def __init__(self, workers=None):
+        self.connections = ConnectionPool()
+        self.threads = ThreadPool(workers or settings.YETI_PUSH_WORKERS)
+
+    def claim(self, count):
+        """
+        Claims up to count due deliveries of active Subscriptions, so that no other
+        process sends them for YETI_PUSH_CLAIM_TIMEOUT seconds. Returns the claimed
+        deliveries, oldest first.
+        """
+        now = timezone.now()
+        claimed_until = now + timedelta(seconds=settings.YETI_PUSH_CLAIM_TIMEOUT)
+        due = (PushDelivery.objects.filter(failed=False, next_attempt__lte=now)
+                                   .filter(push_subscription__in=PushSubscription.objects.active())
+                                   .select_related('push_subscription__subscription__data_collection')
+                                   .order_by('next_attempt', 'pk'))
+        claimed = []
+        for delivery in list(due[:count]):  # Read before any are updated
+            if PushDelivery.objects.filter(pk=delivery.pk, next_attempt=delivery.next_attempt
+                                           ).update(next_attempt=claimed_until):
+                claimed.append(delivery)
+        return claimed
+
+    def send(self, job):
+        """
+        Sends a (PushDelivery, Inbox Message) job. Runs in a worker thread.
+        Returns (the PushDelivery, None or why it was not delivered)
+        """
+        delivery, inbox_message = job
+        push_subscription = delivery.push_subscription
+        try:
+            response = self.connections.post(push_subscription.inbox_protocol,
+                                             push_subscription.inbox_address,
+                                             inbox_message.to_xml(),
+                                             get_headers(push_subscription))
+        except (httplib.HTTPException, socket.error) as e:
+            return delivery, 'Could not reach the Inbox Service: %r' % e
+        return delivery, get_response_error(*response)
+
+    def deliver(self, count=100):
+        """
+        Claims up to count due deliveries and
+        sends them concurrently. Delivered ones are removed from the queue and
+        the others are scheduled to be tried again.
+
+        Returns the number of deliveries claimed
+        """
+        deliveries = self.claim(count)
+        jobs = []
+        for delivery in deliveries:
+            inbox_message = create_inbox_message(delivery)
+            if inbox_message is None:  # Its content has been deleted
+                delivery.delete()
+            else:
+                jobs.append((delivery, inbox_message))
+
+        for delivery, error in self.threads.imap_unordered(self.send, jobs):
+            if error is None:
+                delivery.delete()
+            else:
+                log.warning("Push delivery %s to %s: %s", delivery.pk, delivery.push_subscription.inbox_address, error)
+                schedule_retry(delivery, error)
+        return len(deliveries)
+
+    def close(self):
+        """
+        Stops the worker threads and closes the connections
+        """
+        self.threads.close()
+        self.threads.join()
+        self.connections.close()
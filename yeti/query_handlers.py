@@ -0,0 +1,381 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.exceptions import StatusMessageException
+from taxii_services.query_handlers.stix_xml_111_handler import StixXml111QueryHandler
+
+from yeti.content_cache import content_tree_cache
+from yeti.db import close_db_connection
+from yeti.models import ContentField, IndexedContentBlock, get_indexed_targets, get_indexed_targets_digest
+from yeti.poll_handlers import count_content, iterate_content
+
+import libtaxii.taxii_default_query as tdq
+from libtaxii.constants import *
+
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from collections import OrderedDict
+from lxml import etree
+import multiprocessing
+import operator
+import os
+import threading
+
+#: The ContentField.number lookup of each relationship that compares numbers
+NUMBER_LOOKUPS = {R_GREATER_THAN: 'gt',
+                  R_GREATER_THAN_OR_EQUAL: 'gte',
+                  R_LESS_THAN: 'lt',
+                  R_LESS_THAN_OR_EQUAL: 'lte'}
+
+#: Cost of a '//' step in a Criterion's XPath, relative to a '/' step. It searches a whole subtree.
+DESCENDANT_STEP_COST = 10
+
+
+def normalize_criteria(criteria):
+    """
+    Returns a hashable key for a tdq.Criteria that is the same for all
+    Criteria that differ only in the order of their children
+    """
+    children = [normalize_criteria(child) for child in criteria.criteria]
+    for criterion in criteria.criterion:
+        test = criterion.test
+        children.append((criterion.target, test.capability_id, test.relationship,
+                         tuple(sorted(test.parameters.items())), bool(criterion.negate)))
+    return criteria.operator, tuple(sorted(children))
+
+
+class CriterionPlan(object):
+    """
+    A Criterion compiled into an etree.XPath
+    """
+
+    def __init__(self, xpath, nsmap, negate):
+        self.xpath = etree.XPath(xpath, namespaces=nsmap)
+        self.negate = negate
+        self.cost = xpath.count('/') + (DESCENDANT_STEP_COST - 2) * xpath.count('//')
+
+    def evaluate(self, content_etree):
+        matches = self.xpath(content_etree)
+        # XPath results can be a boolean (for an 'or' of XPaths) or a NodeSet
+        if matches in (True, False):
+            result = matches
+        else:
+            result = len(matches) > 0
+        return result != self.negate
+
+
+class CriteriaPlan(object):
+    """
+    A Criteria compiled into a tree of plans, with the cheapest children evaluated first
+    """
+
+    def __init__(self, operator, children):
+        self.operator = operator
+        self.children = sorted(children, key=lambda child: child.cost)
+        self.cost = sum(child.cost for child in self.children)
+
+    def evaluate(self, content_etree):
+        """
+        Returns whether content_etree matches, evaluating
+        children only until the result is known
+        """
+        if self.operator == tdq.OP_AND:
+            return all(child.evaluate(content_etree) for child in self.children)
+        return any(child.evaluate(content_etree) for child in self.children)
+
+
+class QueryPlanCache(object):
+    """
+    Per-thread LRU cache of the CriteriaPlans of Default Queries, holding at most
+    YETI_QUERY_PLAN_CACHE_SIZE plans per thread. lxml XPath objects must not
+    be used by two threads at once.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, key, compile_plan):
+        """
+        Returns the plan for key, creating it with compile_plan() if needed
+        """
+        plans = self._local.__dict__.setdefault('plans', OrderedDict())
+        plan = plans.pop(key, None)
+        if plan is None:
+            plan = compile_plan()
+            while len(plans) >= settings.YETI_QUERY_PLAN_CACHE_SIZE:
+                plans.popitem(last=False)
+        plans[key] = plan  # Now the most recently used
+        return plan
+
+    def clear(self):
+        """
+        Drops this thread's plans
+        """
+        self._local.__dict__.pop('plans', None)
+
+
+#: The cache used by the query handlers in this module
+query_plan_cache = QueryPlanCache()
+
+_pool = None
+_pool_key = None  # (pid, size) the pool was created for
+_pool_lock = threading.Lock()
+
+
+def start_query_pool():
+    """
+    Starts this process's multiprocessing.Pool of YETI_QUERY_POOL_SIZE workers
+    for evaluating queries, if YETI_QUERY_POOL_SIZE is not 0, and returns it.
+    The workers are forked from the calling process, so call it when the
+    process starts, before it starts threads (yeti.dispatch.get_wsgi_application
+    does). Each forked WSGI worker needs its own.
+    """
+    global _pool, _pool_key
+    size = settings.YETI_QUERY_POOL_SIZE
+    if not size:
+        return None
+
+    key = (os.getpid(), size)
+    with _pool_lock:
+        if _pool_key != key:
+            if _pool is not None and _pool_key[0] == key[0]:
+                _pool.terminate()
+            _pool = multiprocessing.Pool(size, initializer=close_db_connection)
+            _pool_key = key
+        return _pool
+
+
+def get_query_pool():
+    """
+    Returns the pool started by start_query_pool() in this process, or None
+    if it has not started one (for YETI_QUERY_POOL_SIZE workers). Queries are
+    then evaluated in the request's thread; the pool is never forked from a
+    request thread.
+    """
+    if _pool_key != (os.getpid(), settings.YETI_QUERY_POOL_SIZE):
+        return None
+    return _pool
+
+
+def close_query_pool():
+    """
+    Stops this process's query pool, if it has one
+    """
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is not None and _pool_key[0] == os.getpid():
+            _pool.terminate()
+            _pool.join()
+        _pool = None
+        _pool_key = None
+
+
+def evaluate_chunk(args):
+    """
+    Runs in a query pool worker. Returns whether the content of each content block matches a Criteria.
+
+    Arguments:
+        args - A tuple of (Query Handler class, tdq.Criteria, list of (content block id, content) tuples)
+    """
+    handler_class, criteria, content_blocks = args
+    plan = handler_class.get_plan(criteria)
+    return [plan.evaluate(content_tree_cache.get(pk, content)) for pk, content in content_blocks]
+
+
+class IndexedStixXml111QueryHandler(StixXml111QueryHandler):
+    """
+    STIX 1.1.1 Query Handler that answers the Criteria of a Default Query
+    from the yeti.models.ContentField index, and only runs XPath over
+    content blocks the index cannot answer for.
+
+    A Criterion is answered from the index if its target is one of
+    YETI_INDEXED_TARGETS and its Test is equals or not equals (any match type),
+    or greater/less than (or equal) with a numeric value. The index gives the
+    same answers as the XPath of StixXml111QueryHandler. Other Criteria,
+    and content blocks indexed for different YETI_INDEXED_TARGETS (or not at
+    all), are evaluated with XPath. The XPath of each Default Query is compiled
+    once (see QueryPlanCache) and its cheapest criteria are evaluated first.
+    """
+
+    @classmethod
+    def compile_plan(cls, criteria):
+        """
+        Compiles a tdq.Criteria into a CriteriaPlan
+        """
+        children = [cls.compile_plan(child) for child in criteria.criteria]
+        for criterion in criteria.criterion:
+            xpath, nsmap = cls.get_xpath(None, criterion)
+            children.append(CriterionPlan(xpath, nsmap, bool(criterion.negate)))
+        return CriteriaPlan(criteria.operator, children)
+
+    @classmethod
+    def get_plan(cls, criteria):
+        """
+        Returns the cached CriteriaPlan of a tdq.Criteria
+        """
+        key = (cls, normalize_criteria(criteria))
+        return query_plan_cache.get(key, lambda: cls.compile_plan(criteria))
+
+    @classmethod
+    def evaluate_content(cls, criteria, content_blocks, is_answered=None):
+        """
+        Yields the content blocks that match a tdq.Criteria, in order, evaluating
+        its plan on each. If there are at least YETI_QUERY_POOL_MIN_CONTENT_BLOCKS
+        content blocks, they are evaluated in chunks of YETI_QUERY_POOL_CHUNK_SIZE
+        by the query pool (see get_query_pool).
+
+        Arguments:
+            criteria (tdq.Criteria) - The Criteria
+            content_blocks - A list or QuerySet of ContentBlocks
+            is_answered - Optional. A function that returns True for
+                content blocks known to match without evaluating the plan.
+        """
+        plan = cls.get_plan(criteria)  # Raises any compilation errors here
+        if is_answered is None:
+            is_answered = lambda content_block: False
+
+        pool = get_query_pool()
+        if pool is None or count_content(content_blocks) < settings.YETI_QUERY_POOL_MIN_CONTENT_BLOCKS:
+            for content_block in iterate_content(content_blocks):
+                if is_answered(content_block) or plan.evaluate(content_tree_cache.get(content_block.pk,
+                                                                                      content_block.content)):
+                    yield content_block
+            return
+
+        chunk_size = settings.YETI_QUERY_POOL_CHUNK_SIZE
+        window_size = chunk_size * settings.YETI_QUERY_POOL_SIZE * 2  # Keeps every worker busy
+        window = []
+        for content_block in iterate_content(content_blocks):
+            window.append(content_block)
+            if len(window) == window_size:
+                for match in cls._evaluate_window(pool, criteria, window, is_answered):
+                    yield match
+                window = []
+        for match in cls._evaluate_window(pool, criteria, window, is_answered):
+            yield match
+
+    @classmethod
+    def _evaluate_window(cls, pool, criteria, window, is_answered):
+        to_evaluate = [content_block for content_block in window if not is_answered(content_block)]
+        chunk_size = settings.YETI_QUERY_POOL_CHUNK_SIZE
+        chunks = [(cls, criteria, [(content_block.pk, content_block.content)
+                                   for content_block in to_evaluate[i:i + chunk_size]])
+                  for i in range(0, len(to_evaluate), chunk_size)]
+        results = []
+        for chunk_results in pool.map(evaluate_chunk, chunks):
+            results.extend(chunk_results)
+        matches = set(id(content_block) for content_block, result in zip(to_evaluate, results) if result)
+        return [content_block for content_block in window
+                if id(content_block) in matches or is_answered(content_block)]
+
+    @classmethod
+    def compile_criterion(cls, criterion, targets):
+        """
+        Returns a Q object that matches the ContentBlocks a Criterion
+        is true for, or None if the index cannot answer it.
+
+        Arguments:
+            criterion (tdq.Criterion) - The Criterion
+            targets - The indexed targets
+        """
+        test = criterion.test
+        if criterion.target not in targets or test.capability_id != tdq.CM_CORE:
+            return None
+
+        value = test.parameters.get(P_VALUE)
+        if value is None:
+            return None
+        value = unicode(value)
+
+        fields = ContentField.objects.filter(target=criterion.target)
+        if test.relationship in (R_EQUALS, R_NOT_EQUALS):
+            match_type = test.parameters.get(P_MATCH_TYPE)
+            if match_type in ('case_sensitive_string', 'number'):  # XPath compares both as strings
+                lookup = {'value_digest': ContentField.get_digest(value)}
+            elif match_type == 'case_insensitive_string':
+                lookup = {'folded_digest': ContentField.get_digest(value.lower())}
+            else:
+                return None
+
+            if test.relationship == R_EQUALS:
+                fields = fields.filter(**lookup)
+            else:  # True if any value is different
+                fields = fields.exclude(**lookup)
+        elif test.relationship in NUMBER_LOOKUPS:
+            number = ContentField.get_number(value)
+            if number is None:
+                return None
+            fields = fields.filter(**{'number__' + NUMBER_LOOKUPS[test.relationship]: number})
+        else:
+            return None
+
+        q = Q(pk__in=fields.values('content_block'))
+        if criterion.negate:
+            return ~q
+        return q
+
+    @classmethod
+    def compile_criteria(cls, criteria, targets):
+        """
+        Compiles a Criteria into a Q object over ContentBlocks.
+
+        Arguments:
+            criteria (tdq.Criteria) - The Criteria
+            targets - The indexed targets
+
+        Returns:
+            A tuple of (Q object or None, exact). The Q object matches every
+            indexed content block the Criteria is true for; if exact is True,
+            it matches no others. None means the index rules nothing out.
+        """
+        parts = [cls.compile_criteria(child, targets) for child in criteria.criteria]
+        for criterion in criteria.criterion:
+            q = cls.compile_criterion(criterion, targets)
+            parts.append((q, q is not None))
+
+        exact = all(part_exact for q, part_exact in parts)
+        qs = [q for q, part_exact in parts if q is not None]
+        if criteria.operator == tdq.OP_AND:
+            # Any part ruling a content block out rules it out
+            q = reduce(operator.and_, qs) if qs else None
+        elif len(qs) == len(parts):
+            q = reduce(operator.or_, qs)
+        else:  # A part the index cannot answer could match anything
+            q = None
+
+        return q, exact and q is not None
+
+    @classmethod
+    def filter_content(cls, prp, content_blocks):
+        """
+        Returns the content blocks matching the query of a Poll Request.
+
+        If content_blocks is a QuerySet, the index narrows it down first. When
+        the index answers the whole query and every content block is indexed,
+        the result is a QuerySet; otherwise it is a list, like the result of
+        StixXml111QueryHandler.filter_content().
+        """
+        if prp.query.targeting_expression_id not in cls.get_supported_tevs():
+            raise StatusMessageException(prp.message_id,
+                                         ST_UNSUPPORTED_TARGETING_EXPRESSION_ID,
+                                         status_detail={SD_TARGETING_EXPRESSION_ID: cls.get_supported_tevs()})
+
+        criteria = prp.query.criteria
+        q, exact = cls.compile_criteria(criteria, get_indexed_targets())
+        if q is None or not isinstance(content_blocks, QuerySet):
+            return list(cls.evaluate_content(criteria, content_blocks))
+
+        indexed = Q(pk__in=IndexedContentBlock.objects.filter(targets_digest=get_indexed_targets_digest())
+                                                      .values('content_block'))
+        unindexed = None
+        if exact:
+            unindexed = set(content_blocks.exclude(indexed).values_list('pk', flat=True))
+            if not unindexed:
+                return content_blocks.filter(q)
+
+        candidates = content_blocks.filter((indexed & q) | ~indexed)
+        if unindexed is None:
+            return list(cls.evaluate_content(criteria, candidates))
+        return list(cls.evaluate_content(criteria, candidates,
+                                         lambda content_block: content_block.pk not in unindexed))
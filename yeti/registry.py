@@ -0,0 +1,99 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# An in-process cache of TAXII Service configuration for YETI's service
+# router (yeti.views.service_router). It is rebuilt after any TAXII Service
+# or Message Handler is saved or deleted in this process, within
+# YETI_STORE_CHECK_INTERVAL seconds of a change saved by another process that
+# shares the store (see yeti.store), and at least every YETI_SERVICE_REGISTRY_TTL seconds.
+
+from taxii_services import models
+
+from yeti.store import SharedGeneration
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.http import Http404
+from importlib import import_module
+import threading
+import time
+
+#: Each TAXII Service model, with the Message Handler foreign keys that get_message_handler() follows
+SERVICE_MODELS = ((models.InboxService, ('inbox_message_handler',)),
+                  (models.DiscoveryService, ('discovery_handler',)),
+                  (models.PollService, ('poll_request_handler', 'poll_fulfillment_handler')),
+                  (models.CollectionManagementService, ('collection_information_handler',
+                                                        'subscription_management_handler')))
+
+
+class ServiceRegistry(object):
+    """
+    Maps the path of every enabled TAXII Service to its model object (with
+    its Message Handlers already loaded), and each Message Handler to its
+    imported class, so that dispatching a request costs no configuration queries.
+    """
+
+    def __init__(self):
+        self._services = None
+        self._handler_classes = {}
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        self._generation = SharedGeneration('registry')
+
+    def invalidate(self, **kwargs):
+        """
+        Drops the cached configuration, in this process and the others that
+        share the store. Can be connected to model signals.
+        """
+        self._drop()
+        self._generation.bump()
+
+    def _drop(self):
+        self._services = None
+        self._handler_classes = {}
+
+    def _get_services(self):
+        if self._generation.changed():
+            self._drop()
+        services = self._services
+        if services is not None and time.time() - self._loaded_at < settings.YETI_SERVICE_REGISTRY_TTL:
+            return services
+
+        with self._lock:
+            if self._services is services:  # No other thread has reloaded it
+                services = {}
+                for model, handler_fields in SERVICE_MODELS:
+                    for service in model.objects.filter(enabled=True).select_related(*handler_fields):
+                        services[service.path] = service
+                self._services = services
+                self._loaded_at = time.time()
+            return self._services
+
+    def get_service(self, path):
+        """
+        Given a path, return a TAXII Service model object.
+        If no service is found, raise Http404.
+        """
+        try:
+            return self._get_services()[path]
+        except KeyError:
+            raise Http404("No TAXII service at specified path")
+
+    def get_handler_class(self, handler):
+        """
+        Returns the class named by a models.MessageHandler's handler field
+        """
+        handler_class = self._handler_classes.get(handler)
+        if handler_class is None:
+            module_name, class_name = handler.rsplit('.', 1)
+            handler_class = getattr(import_module(module_name), class_name)
+            self._handler_classes[handler] = handler_class
+        return handler_class
+
+
+#: The registry used by yeti.views.service_router
+registry = ServiceRegistry()
+
+for model, handler_fields in SERVICE_MODELS + ((models.MessageHandler, ()),):
+    post_save.connect(registry.invalidate, sender=model, dispatch_uid='yeti.registry.%s.save' % model.__name__)
+    post_delete.connect(registry.invalidate, sender=model, dispatch_uid='yeti.registry.%s.delete' % model.__name__)
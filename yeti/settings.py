@@ -9,7 +9,8 @@ import django
 
 sys.path.insert(0, os.path.dirname(__file__))
 
-TEST_RUNNER = 'django.test.runner.DiscoverRunner'
+# Runs the tests with the store (YETI_STORE_PATH) in a temporary directory
+TEST_RUNNER = 'yeti.test_runner.YetiTestRunner'
 
 # calculated paths for django and the site
 DJANGO_ROOT = os.path.dirname(os.path.realpath(django.__file__))
@@ -27,7 +28,8 @@ ADMINS = (
 
 MANAGERS = ADMINS
 
-DB_PATH = os.path.join(os.path.dirname(SITE_ROOT), 'sqlite3.db') # one directory up from the SITE_ROOT
+DB_PATH = os.environ.get('YETI_DB_PATH',
+                         os.path.join(os.path.dirname(SITE_ROOT), 'sqlite3.db')) # one directory up from the SITE_ROOT
 
 # YETI is configured to use SQLLite by default. To change
 # the database used by YETI, see the Django documentation on 
@@ -44,6 +46,41 @@ DATABASES = {
     }
 }
 
+# The YETI_DB_PROFILE environment variable selects a database profile:
+#   default    - The SQLite database above, with Django's defaults.
+#   sqlite-wal - The SQLite database above in WAL mode, so readers do not block
+#                the writer, with the PRAGMAs in YETI_SQLITE_PRAGMAS and
+#                persistent connections.
+#   postgresql - PostgreSQL with persistent connections, configured by the
+#                YETI_DB_NAME, YETI_DB_USER, YETI_DB_PASSWORD, YETI_DB_HOST and
+#                YETI_DB_PORT environment variables. Requires psycopg2. To share
+#                a pool of connections between server processes, point
+#                YETI_DB_HOST and YETI_DB_PORT at PgBouncer.
+YETI_DB_PROFILE = os.environ.get('YETI_DB_PROFILE', 'default')
+
+# PRAGMAs that yeti.db runs on every new SQLite connection
+YETI_SQLITE_PRAGMAS = []
+
+if YETI_DB_PROFILE == 'sqlite-wal':
+    DATABASES['default']['CONN_MAX_AGE'] = 600
+    DATABASES['default']['OPTIONS'] = {'timeout': 5}  # Seconds to wait for a lock
+    YETI_SQLITE_PRAGMAS = ['journal_mode=WAL',
+                           'synchronous=NORMAL',    # Durable in WAL mode, except across a power loss
+                           'mmap_size=268435456',   # 256 MB
+                           'busy_timeout=5000']     # Milliseconds
+elif YETI_DB_PROFILE == 'postgresql':
+    DATABASES['default'] = {
+        'ENGINE':       'django.db.backends.postgresql_psycopg2',
+        'NAME':         os.environ.get('YETI_DB_NAME', 'yeti'),
+        'USER':         os.environ.get('YETI_DB_USER', ''),
+        'PASSWORD':     os.environ.get('YETI_DB_PASSWORD', ''),
+        'HOST':         os.environ.get('YETI_DB_HOST', ''),
+        'PORT':         os.environ.get('YETI_DB_PORT', ''),
+        'CONN_MAX_AGE': int(os.environ.get('YETI_DB_CONN_MAX_AGE', 600)),
+    }
+elif YETI_DB_PROFILE != 'default':
+    raise ValueError("Unknown YETI_DB_PROFILE: %s" % YETI_DB_PROFILE)
+
 
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
@@ -226,6 +263,160 @@ LOGGING = {
     }
 }
 
+# YETI TAXII service settings
+
+# Maximum number of seconds YETI's service router caches TAXII Service
+# configuration (see yeti.registry). Changes saved in the same process
+# take effect immediately.
+YETI_SERVICE_REGISTRY_TTL = 60
+
+# Requests whose path starts with YETI_SERVICE_PATH_PREFIX are TAXII Service
+# requests. YETI's WSGI application (yeti.dispatch) runs them through
+# YETI_SERVICE_MIDDLEWARE_CLASSES instead of MIDDLEWARE_CLASSES.
+YETI_SERVICE_PATH_PREFIX = '/services/'
+YETI_SERVICE_MIDDLEWARE_CLASSES = (
+    'taxii_services.middleware.StatusMessageExceptionMiddleware',
+)
+
+# Largest request body, in bytes, YETI's service router will parse. Larger
+# requests get a Status Message of Bad Message without their body being read.
+YETI_MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# Maximum number of seconds the Discovery and Collection Information
+# responses of the handlers in yeti.cached_handlers are cached. Changes
+# saved in the same process take effect immediately.
+YETI_RESPONSE_CACHE_TTL = 60
+
+# Number of content blocks read from the database at a time when
+# a Poll Response is streamed (see yeti.poll_handlers)
+YETI_POLL_STREAM_BATCH_SIZE = 500
+
+# Number of seconds a multi-part result set created by the indexed poll
+# handlers can be fetched for. Expired result sets are deleted by the
+# sweep_result_sets management command.
+YETI_RESULT_SET_TTL = 7 * 24 * 60 * 60
+
+# The store of state shared by YETI's processes other than the database: the
+# inbox spool, the notices that tell the service registry and response cache
+# to reload, and the notices of new content for long polls (see yeti.store). The YETI_STORE environment variable selects:
+#   file - A SQLite file at YETI_STORE_PATH, shared by the processes on one host
+#   resp - A Redis protocol server at YETI_STORE_URL (redis://[:password@]host[:port][/db]),
+#          shared by the processes on every host
+# Keys are prefixed with YETI_STORE_PREFIX. Each process checks for changes to
+# the configuration made by the others at most every YETI_STORE_CHECK_INTERVAL seconds.
+YETI_STORE = os.environ.get('YETI_STORE', 'file')
+YETI_STORE_PATH = os.environ.get('YETI_STORE_PATH', os.path.join(os.path.dirname(SITE_ROOT), 'yeti_store.db'))
+YETI_STORE_URL = os.environ.get('YETI_STORE_URL', 'redis://localhost:6379/0')
+YETI_STORE_TIMEOUT = 10
+YETI_STORE_PREFIX = 'yeti:'
+YETI_STORE_CHECK_INTERVAL = 1
+
+# yeti.inbox_handlers.SpooledInboxMessageHandler writes Inbox Messages to a spool
+# in the store. The drain_inbox_spool management command saves them.
+# Seconds after which a spooled message claimed by a worker that has not
+# finished it is given to another worker
+YETI_INBOX_SPOOL_CLAIM_TIMEOUT = 300
+
+# Number of times saving a spooled message is tried before it is marked failed
+YETI_INBOX_SPOOL_MAX_ATTEMPTS = 3
+
+# STIX 1.1.1 Targeting Expressions (without wildcards) whose values are
+# extracted from content blocks when they are saved (see yeti.models.ContentField).
+# yeti.query_handlers.IndexedStixXml111QueryHandler answers criteria on these
+# targets from the index, and all others with XPath. After changing this list,
+# run the build_query_index management command.
+YETI_INDEXED_TARGETS = [
+    'STIX_Package/@id',
+    'STIX_Package/STIX_Header/Title',
+    'STIX_Package/STIX_Header/Package_Intent',
+    'STIX_Package/TTPs/TTP/Title',
+    'STIX_Package/Threat_Actors/Threat_Actor/Identity/Specification/PartyName/OrganisationName/SubDivisionName',
+]
+
+# Number of compiled Default Query plans (see yeti.query_handlers.QueryPlanCache)
+# each thread keeps. The least recently used plan is dropped first.
+YETI_QUERY_PLAN_CACHE_SIZE = 256
+
+# Number of worker processes yeti.query_handlers uses to evaluate the XPath of
+# a Default Query over large polls. Each process running YETI starts its own
+# pool when its WSGI application is loaded. 0 evaluates queries in the request's process.
+YETI_QUERY_POOL_SIZE = 0
+
+# Smallest number of content blocks a query is evaluated over in the pool, and
+# the number of content blocks sent to a worker at a time
+YETI_QUERY_POOL_MIN_CONTENT_BLOCKS = 1000
+YETI_QUERY_POOL_CHUNK_SIZE = 100
+
+# Bytes of content whose parsed form each process keeps for Default Queries
+# (see yeti.content_cache). A parsed tree takes several times the size of its content.
+YETI_CONTENT_TREE_CACHE_SIZE = 16 * 1024 * 1024
+
+# Content-addressed storage of content block payloads (see yeti.content_store).
+# None keeps content in the ContentBlock table. 'database' or 'file' stores each
+# distinct payload once, by its SHA-256 digest, in the database or in files
+# under YETI_CONTENT_STORE_PATH, compressed with YETI_CONTENT_COMPRESSION
+# ('zlib', 'zstd' with the zstandard package installed, or None). Stored content
+# is only read by YETI's handlers, not the built-in ones. Run the
+# build_content_store management command after turning it on.
+YETI_CONTENT_STORE = None
+YETI_CONTENT_STORE_PATH = os.path.join(os.path.dirname(SITE_ROOT), 'content_store')
+YETI_CONTENT_COMPRESSION = 'zlib'
+
+# With the 'file' content store, also keep each payload serialized as the XML
+# of a TAXII Content element (uncompressed, so it takes more disk space). Poll
+# Responses splice it in from memory-mapped files instead of parsing and
+# serializing the content again. Run build_content_store after turning it on.
+YETI_CONTENT_STORE_SERIALIZED = False
+
+# Retention of Data Collection content, by Data Collection name: the number
+# of calendar months (UTC) of content to keep, counting the current month.
+# The prune_collections management command removes the content whose
+# timestamp label is in an older month, one month at a time. Data
+# Collections that are not listed keep their content forever.
+YETI_COLLECTION_RETENTION_MONTHS = {}
+
+# Push delivery of Subscriptions (see yeti.push and the deliver_subscriptions
+# management command). New content is pushed in Inbox Messages of at most
+# YETI_PUSH_BATCH_SIZE content blocks, sent by YETI_PUSH_WORKERS threads over
+# persistent connections, with at most YETI_PUSH_MAX_CONNECTIONS_PER_DESTINATION
+# of them open to one Inbox Service. YETI_PUSH_TIMEOUT is the socket timeout.
+YETI_PUSH_BATCH_SIZE = 100
+YETI_PUSH_WORKERS = 8
+YETI_PUSH_MAX_CONNECTIONS_PER_DESTINATION = 2
+YETI_PUSH_TIMEOUT = 30
+
+# Seconds after which a delivery claimed by a process that has not
+# finished it is sent by another process
+YETI_PUSH_CLAIM_TIMEOUT = 300
+
+# A delivery that fails is tried again after YETI_PUSH_RETRY_DELAY seconds,
+# doubled after each failed attempt up to YETI_PUSH_MAX_RETRY_DELAY, and is
+# marked failed after YETI_PUSH_MAX_ATTEMPTS attempts
+YETI_PUSH_RETRY_DELAY = 30
+YETI_PUSH_MAX_RETRY_DELAY = 60 * 60
+YETI_PUSH_MAX_ATTEMPTS = 10
+
+# Long polls (see yeti.poll_handlers.WaitingPollRequest11Handler) that find
+# no new content wait up to YETI_LONG_POLL_TIMEOUT seconds for YETI's Inbox
+# handlers to add some. Content added by another process that shares the
+# store (see yeti.notify) is noticed within YETI_LONG_POLL_CHECK_INTERVAL seconds.
+YETI_LONG_POLL_TIMEOUT = 30
+YETI_LONG_POLL_CHECK_INTERVAL = 0.5
+
+# The gevent front end (see yeti.green and the run_green_server management
+# command) serves up to YETI_GREEN_MAX_CONNECTIONS connections per process,
+# and runs Django in YETI_GREEN_THREADS threads. Streaming responses are
+# produced YETI_GREEN_CHUNK_SIZE bytes at a time. Requires the gevent package.
+YETI_GREEN_THREADS = 10
+YETI_GREEN_MAX_CONNECTIONS = 1000
+YETI_GREEN_CHUNK_SIZE = 64 * 1024
+
+# Per-request metrics of TAXII traffic (see yeti.metrics), served at /metrics
+# in the Prometheus text exposition format. Metrics are kept per process, so
+# scrape each process. With YETI_METRICS_DB_QUERIES, the database queries of
+# each request are counted and timed (their SQL is not kept).
+YETI_METRICS = True
+YETI_METRICS_DB_QUERIES = False
 
 # Test to see if secret key has been defined. If not, raise a useful error message
 
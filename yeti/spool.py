@@ -0,0 +1,213 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# A durable queue of raw Inbox Messages, kept in the store (see yeti.store)
+# so that spooling a message is one short append that never waits on YETI's
+# main database. Workers (see the drain_inbox_spool management command) on
+# any host that shares the store claim spooled messages and save them with
+# the bulk inbox handlers.
+
+from django.conf import settings
+
+from taxii_services.exceptions import StatusMessageException
+from taxii_services.models import InboxService
+
+from yeti.parsing import parse_message
+from yeti.store import get_key, get_store
+
+from libtaxii.constants import VID_TAXII_XML_10, VID_TAXII_XML_11
+
+import json
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+#: The lists of spooled message ids in the store
+QUEUED = 'queued'
+CLAIMED = 'claimed'
+FAILED = 'failed'
+
+#: The X-TAXII-Content-Type of a spooled message, by the libtaxii module it was parsed with in the request
+XML_CONTENT_TYPES = {'libtaxii.messages_11': VID_TAXII_XML_11,
+                     'libtaxii.messages_10': VID_TAXII_XML_10}
+
+
+class SpooledRequest(object):
+    """
+    Stands in for the Django request of a spooled Inbox Message
+    when it is handed to an Inbox Message Handler
+    """
+    def __init__(self, remote_addr, body):
+        self.META = {'REMOTE_ADDR': remote_addr}
+        self.body = body
+
+    def is_secure(self):
+        return False
+
+
+class InboxSpool(object):
+    """
+    A queue of raw Inbox Messages in the store. Each message is a record
+    (a JSON object) and the raw message under keys named by its id, which
+    moves between the QUEUED, CLAIMED and FAILED lists.
+
+    Messages are saved at least once: a message whose worker is assumed to
+    have died is claimed again, and the bulk inbox handlers skip content
+    they have already saved.
+    """
+
+    def __init__(self, store=None):
+        self._store = store
+
+    @property
+    def store(self):
+        return self._store or get_store()  # The store of the current settings, unless one was given
+
+    def _get_record(self, spool_id):
+        record = self.store.get(get_key('spool', spool_id))
+        return json.loads(record) if record is not None else None
+
+    def put(self, inbox_path, taxii_version, message, remote_addr=None):
+        """
+        Durably appends a raw Inbox Message to the spool and returns its id
+
+        Arguments:
+            inbox_path (str) - The path of the InboxService that received the message
+            taxii_version (str) - The libtaxii module the message was parsed with (see XML_CONTENT_TYPES)
+            message (str) - The raw message
+            remote_addr (str) - The address of the sender
+        """
+        spool_id = self.store.incr(get_key('spool', 'next-id'))
+        record = json.dumps({'inbox_path': inbox_path,
+                             'taxii_version': taxii_version,
+                             'remote_addr': remote_addr,
+                             'received': time.time(),
+                             'attempts': 0,
+                             'error': None})
+        self.store.set_and_push({get_key('spool', spool_id): record, get_key('spool', spool_id, 'message'): message},
+                                get_key('spool', QUEUED), str(spool_id))
+        return spool_id
+
+    def requeue_abandoned(self):
+        """
+        Queues again every message claimed more than YETI_INBOX_SPOOL_CLAIM_TIMEOUT
+        seconds ago (its worker is assumed to have died). This counts as a failed
+        attempt, so a message that kills its workers is marked failed after
+        YETI_INBOX_SPOOL_MAX_ATTEMPTS claims.
+        """
+        cutoff = time.time() - settings.YETI_INBOX_SPOOL_CLAIM_TIMEOUT
+        for spool_id in self.store.items(get_key('spool', CLAIMED)):
+            claimed_at = self.store.get(get_key('spool', 'claimed-at', spool_id))
+            if claimed_at is None or float(claimed_at) >= cutoff:  # Completed or failed since items() was read
+                continue
+            self.fail(spool_id, "Not saved within %s seconds" % settings.YETI_INBOX_SPOOL_CLAIM_TIMEOUT)
+
+    def claim(self, limit):
+        """
+        Claims up to `limit` of the oldest queued messages,
+        after queuing abandoned claims again (see requeue_abandoned).
+
+        Returns a list of (id, inbox_path, taxii_version, remote_addr, message) tuples
+        """
+        self.requeue_abandoned()
+        claimed = []
+        while len(claimed) < limit:
+            # The claim time is set with the move, so every claimed message has one
+            spool_id = self.store.move_and_set(get_key('spool', QUEUED), get_key('spool', CLAIMED),
+                                               get_key('spool', 'claimed-at', ''), repr(time.time()))
+            if spool_id is None:
+                break
+            record = self._get_record(spool_id)
+            message = self.store.get(get_key('spool', spool_id, 'message'))
+            if record is None or message is None:  # Completed by a worker whose claim had timed out
+                self.store.remove(get_key('spool', CLAIMED), spool_id)
+                continue
+            claimed.append((int(spool_id), record['inbox_path'], record['taxii_version'], record['remote_addr'],
+                            message))
+        return claimed
+
+    def complete(self, spool_id):
+        """
+        Removes a message that has been saved
+        """
+        self.store.remove(get_key('spool', CLAIMED), str(spool_id))
+        self.store.delete(get_key('spool', spool_id), get_key('spool', spool_id, 'message'),
+                          get_key('spool', 'claimed-at', spool_id))
+
+    def fail(self, spool_id, error, retry=True):
+        """
+        Records that a message could not be saved. It is queued again
+        until it has failed YETI_INBOX_SPOOL_MAX_ATTEMPTS times (or if
+        retry is False), and then kept in the failed list for inspection.
+        """
+        if not self.store.remove(get_key('spool', CLAIMED), str(spool_id)):  # Only one worker fails it
+            return
+        self.store.delete(get_key('spool', 'claimed-at', spool_id))
+        record = self._get_record(spool_id)
+        if record is None:  # Completed by a worker whose claim had timed out
+            return
+        record['attempts'] += 1
+        record['error'] = error
+        queue = QUEUED if retry and record['attempts'] < settings.YETI_INBOX_SPOOL_MAX_ATTEMPTS else FAILED
+        self.store.set_and_push({get_key('spool', spool_id): json.dumps(record)},
+                                get_key('spool', queue), str(spool_id))
+
+    def stats(self):
+        """
+        Returns a dict of spool metrics:
+
+        * depth - The number of messages waiting to be saved (queued or claimed)
+        * lag - The age in seconds of the oldest message waiting to be saved (0 if none are)
+        * failed - The number of messages that could not be saved
+        """
+        claimed = self.store.items(get_key('spool', CLAIMED))
+        oldest_queued = self.store.head(get_key('spool', QUEUED))
+        received = []
+        for spool_id in claimed + ([oldest_queued] if oldest_queued is not None else []):
+            record = self._get_record(spool_id)
+            if record is not None:
+                received.append(record['received'])
+
+        return {'depth': self.store.length(get_key('spool', QUEUED)) + len(claimed),
+                'lag': time.time() - min(received) if received else 0,
+                'failed': self.store.length(get_key('spool', FAILED))}
+
+
+#: The spool of this process, in the store of the current settings
+inbox_spool = InboxSpool()
+
+
+def save_spooled_message(inbox_path, taxii_version, remote_addr, message):
+    """
+    Parses a spooled Inbox Message and saves it with
+    yeti.inbox_handlers.BulkInboxMessageHandler
+    """
+    from yeti.inbox_handlers import BulkInboxMessageHandler
+
+    inbox_service = InboxService.objects.get(path=inbox_path, enabled=True)
+    inbox_message = parse_message(message, XML_CONTENT_TYPES[taxii_version], validate=False)  # Validated when spooled
+    BulkInboxMessageHandler.handle_message(inbox_service, inbox_message, SpooledRequest(remote_addr, message))
+
+
+def drain(batch_size):
+    """
+    Claims up to batch_size spooled messages and saves them.
+    This is run in the worker processes of the drain_inbox_spool command.
+
+    Returns the number of messages claimed
+    """
+    claimed = inbox_spool.claim(batch_size)
+    for spool_id, inbox_path, taxii_version, remote_addr, message in claimed:
+        try:
+            save_spooled_message(inbox_path, taxii_version, remote_addr, message)
+        except (StatusMessageException, InboxService.DoesNotExist, KeyError) as e:
+            # Saving this message again won't help
+            log.error("Spooled message %s could not be saved: %r", spool_id, e)
+            inbox_spool.fail(spool_id, repr(e), retry=False)
+        except Exception as e:
+            log.exception("Error saving spooled message %s", spool_id)
+            inbox_spool.fail(spool_id, repr(e))
+        else:
+            inbox_spool.complete(spool_id)
+    return len(claimed)
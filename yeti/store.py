@@ -0,0 +1,517 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# Shared state for YETI's server and worker processes, other than what is in
+# the database. The inbox spool (yeti.spool) keeps its queue here, and the
+# per-process configuration caches (yeti.registry, yeti.cached_handlers) use
+# it to tell each other when to reload. YETI_STORE selects the implementation:
+#
+# * 'file' - FileStore, a SQLite database in WAL mode at YETI_STORE_PATH. It is
+#   shared by every process on one host.
+# * 'resp' - RespStore, a Redis (or other RESP protocol) server at
+#   YETI_STORE_URL. It is shared by every process on every host.
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+import logging
+import select
+import socket
+import sqlite3
+import threading
+import time
+import urlparse
+
+log = logging.getLogger(__name__)
+
+#: Values of YETI_STORE
+STORE_FILE = 'file'
+STORE_RESP = 'resp'
+
+
+class StoreError(Exception):
+    """
+    Raised when the store cannot be reached or rejects a command
+    """
+    pass
+
+
+class BaseStore(object):
+    """
+    The operations YETI needs from a store: string values, counters, and lists
+    used as FIFO queues. Keys and values are byte strings. Every operation
+    is atomic, and can be called from any thread.
+    """
+
+    def get(self, key):
+        """
+        Returns the value of key, or None if it is not set
+        """
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        """
+        Sets the value of key
+        """
+        raise NotImplementedError()
+
+    def delete(self, *keys):
+        """
+        Deletes keys, of either values or lists
+        """
+        raise NotImplementedError()
+
+    def incr(self, key):
+        """
+        Adds one to the integer value of key (0 if it is not set) and returns it
+        """
+        raise NotImplementedError()
+
+    def push(self, key, value):
+        """
+        Appends value to the tail of the list at key
+        """
+        raise NotImplementedError()
+
+    def move(self, source, destination):
+        """
+        Removes the value at the head of the list at source, appends it to
+        the list at destination, and returns it. Returns None if source is empty.
+        """
+        raise NotImplementedError()
+
+    def move_and_set(self, source, destination, key_prefix, value):
+        """
+        Like move(), but also sets the key key_prefix + the moved value to value,
+        in the same transaction. Returns the moved value, or None if source is empty.
+        """
+        raise NotImplementedError()
+
+    def set_and_push(self, values, key, value):
+        """
+        Sets each key of the dict values to its value and appends value to the
+        tail of the list at key, in one transaction
+        """
+        raise NotImplementedError()
+
+    def remove(self, key, value):
+        """
+        Removes every copy of value from the list at key, and returns how many there were
+        """
+        raise NotImplementedError()
+
+    def head(self, key):
+        """
+        Returns the value at the head of the list at key, or None if it is empty
+        """
+        raise NotImplementedError()
+
+    def length(self, key):
+        """
+        Returns the length of the list at key
+        """
+        raise NotImplementedError()
+
+    def items(self, key):
+        """
+        Returns the values of the list at key, from head to tail
+        """
+        raise NotImplementedError()
+
+
+FILE_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS store_value (
+    key BLOB PRIMARY KEY,
+    value BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS store_list (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key BLOB NOT NULL,
+    value BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS store_list_key ON store_list (key, id);
+"""
+
+
+class FileStore(BaseStore):
+    """
+    A store in a SQLite database in WAL mode. Every operation opens its own
+    connection, so a FileStore can be shared by threads and survives being
+    forked into worker processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._created = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.text_factory = str
+        if not self._created:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(FILE_STORE_SCHEMA)
+            self._created = True
+        return conn
+
+    def _execute(self, operation, write=False):
+        """
+        Calls operation with a connection, in an immediate transaction if write is True
+        """
+        try:
+            conn = self._connect()
+        except sqlite3.Error as e:
+            raise StoreError("Cannot open the store at %s: %s" % (self.path, e))
+        try:
+            if not write:
+                return operation(conn)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = operation(conn)
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return result
+        except sqlite3.Error as e:
+            raise StoreError(str(e))
+        finally:
+            conn.close()
+
+    def get(self, key):
+        def get(conn):
+            row = conn.execute('SELECT value FROM store_value WHERE key = ?', (sqlite3.Binary(key),)).fetchone()
+            return str(row[0]) if row else None
+        return self._execute(get)
+
+    def set(self, key, value):
+        self._execute(lambda conn: conn.execute('INSERT OR REPLACE INTO store_value (key, value) VALUES (?, ?)',
+                                                (sqlite3.Binary(key), sqlite3.Binary(value))))
+
+    def delete(self, *keys):
+        def delete(conn):
+            for key in keys:
+                conn.execute('DELETE FROM store_value WHERE key = ?', (sqlite3.Binary(key),))
+                conn.execute('DELETE FROM store_list WHERE key = ?', (sqlite3.Binary(key),))
+        self._execute(delete, write=True)
+
+    def incr(self, key):
+        def incr(conn):
+            row = conn.execute('SELECT value FROM store_value WHERE key = ?', (sqlite3.Binary(key),)).fetchone()
+            value = int(str(row[0])) + 1 if row else 1
+            conn.execute('INSERT OR REPLACE INTO store_value (key, value) VALUES (?, ?)',
+                         (sqlite3.Binary(key), sqlite3.Binary(str(value))))
+            return value
+        return self._execute(incr, write=True)
+
+    def push(self, key, value):
+        self._execute(lambda conn: conn.execute('INSERT INTO store_list (key, value) VALUES (?, ?)',
+                                                (sqlite3.Binary(key), sqlite3.Binary(value))))
+
+    def _move(self, source, destination):
+        """
+        Returns the operation of move(source, destination), for _execute()
+        """
+        def move(conn):
+            row = conn.execute('SELECT id, value FROM store_list WHERE key = ? ORDER BY id LIMIT 1',
+                               (sqlite3.Binary(source),)).fetchone()
+            if row is None:
+                return None
+            conn.execute('DELETE FROM store_list WHERE id = ?', (row[0],))
+            conn.execute('INSERT INTO store_list (key, value) VALUES (?, ?)',
+                         (sqlite3.Binary(destination), sqlite3.Binary(row[1])))
+            return str(row[1])
+        return move
+
+    def move(self, source, destination):
+        return self._execute(self._move(source, destination), write=True)
+
+    def move_and_set(self, source, destination, key_prefix, value):
+        move = self._move(source, destination)
+
+        def move_and_set(conn):
+            moved = move(conn)
+            if moved is not None:
+                conn.execute('INSERT OR REPLACE INTO store_value (key, value) VALUES (?, ?)',
+                             (sqlite3.Binary(key_prefix + moved), sqlite3.Binary(value)))
+            return moved
+        return self._execute(move_and_set, write=True)
+
+    def set_and_push(self, values, key, value):
+        def set_and_push(conn):
+            conn.executemany('INSERT OR REPLACE INTO store_value (key, value) VALUES (?, ?)',
+                             [(sqlite3.Binary(k), sqlite3.Binary(v)) for k, v in values.items()])
+            conn.execute('INSERT INTO store_list (key, value) VALUES (?, ?)',
+                         (sqlite3.Binary(key), sqlite3.Binary(value)))
+        self._execute(set_and_push, write=True)
+
+    def remove(self, key, value):
+        return self._execute(lambda conn: conn.execute('DELETE FROM store_list WHERE key = ? AND value = ?',
+                                                       (sqlite3.Binary(key), sqlite3.Binary(value))).rowcount)
+
+    def head(self, key):
+        def head(conn):
+            row = conn.execute('SELECT value FROM store_list WHERE key = ? ORDER BY id LIMIT 1',
+                               (sqlite3.Binary(key),)).fetchone()
+            return str(row[0]) if row else None
+        return self._execute(head)
+
+    def length(self, key):
+        return self._execute(lambda conn: conn.execute('SELECT COUNT(*) FROM store_list WHERE key = ?',
+                                                       (sqlite3.Binary(key),)).fetchone()[0])
+
+    def items(self, key):
+        return self._execute(lambda conn: [str(row[0]) for row in conn.execute(
+            'SELECT value FROM store_list WHERE key = ? ORDER BY id', (sqlite3.Binary(key),))])
+
+
+class RespStore(BaseStore):
+    """
+    A store on a server that speaks the Redis protocol (RESP), at a URL of the
+    form redis://[:password@]host[:port][/db]. Each thread has its own
+    connection, which is reopened if the server has closed it. A command is
+    only sent again if it could not be sent; once it has been sent, a lost
+    reply raises StoreError, since commands like INCR must not run twice.
+
+    Lists are kept newest first (LPUSH), so RPOPLPUSH moves the oldest value
+    of one list to another, as servers older than Redis 6.2 have no LMOVE.
+    Operations of several commands are run as Lua scripts (Redis 2.6 or later),
+    which the server runs atomically.
+    """
+
+    MOVE_AND_SET_SCRIPT = """
+local value = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+if value then
+    redis.call('SET', ARGV[1] .. value, ARGV[2])
+end
+return value
+"""
+
+    SET_AND_PUSH_SCRIPT = """
+for i = 2, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[i])
+end
+return redis.call('LPUSH', KEYS[1], ARGV[1])
+"""
+
+    def __init__(self, url, timeout=None):
+        url = urlparse.urlsplit(url)
+        if url.scheme != 'redis' or not url.hostname:
+            raise ImproperlyConfigured("YETI_STORE_URL must be a redis:// URL")
+        self.address = (url.hostname, url.port or 6379)
+        self.password = url.password
+        self.db = url.path.strip('/') or None
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection(self.address, self.timeout)
+        except socket.error as e:
+            raise StoreError("Cannot connect to the store at %s:%s: %s" % (self.address + (e,)))
+        self._local.sock = sock
+        self._local.reader = sock.makefile('rb')
+        try:
+            if self.password:
+                self._call('AUTH', self.password)
+            if self.db:
+                self._call('SELECT', self.db)
+        except (socket.error, EOFError, StoreError) as e:
+            self._close()
+            raise StoreError("Cannot connect to the store at %s:%s: %r" % (self.address + (e,)))
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            self._local.reader.close()
+            sock.close()
+        self._local.sock = None
+
+    def _is_dropped(self):
+        """
+        Returns True if the server has closed this thread's idle connection
+        (or sent something unasked for)
+        """
+        try:
+            readable, writable, errors = select.select([self._local.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def execute(self, *args):
+        """
+        Sends a command and returns its reply
+        """
+        reused = getattr(self._local, 'sock', None) is not None
+        if reused and self._is_dropped():
+            self._close()
+            reused = False
+        if not reused:
+            self._connect()
+        try:
+            self._send(*args)
+        except socket.error as e:
+            self._close()
+            if not reused:
+                raise StoreError("Lost the connection to the store at %s:%s: %r" % (self.address + (e,)))
+            self._connect()  # The command was not sent; try once on a new connection
+            try:
+                self._send(*args)
+            except socket.error as e:
+                self._close()
+                raise StoreError("Lost the connection to the store at %s:%s: %r" % (self.address + (e,)))
+        try:
+            return self._read_reply()
+        except (socket.error, EOFError) as e:  # The command may have run, so it is not sent again
+            self._close()
+            raise StoreError("Lost the connection to the store at %s:%s: %r" % (self.address + (e,)))
+
+    def _call(self, *args):
+        self._send(*args)
+        return self._read_reply()
+
+    def _send(self, *args):
+        command = ['*%d\r\n' % len(args)]
+        for arg in args:
+            arg = str(arg)
+            command.append('$%d\r\n%s\r\n' % (len(arg), arg))
+        self._local.sock.sendall(''.join(command))
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line.endswith('\r\n'):
+            raise EOFError()
+        kind, rest = line[0], line[1:-2]
+        if kind == '+':
+            return rest
+        elif kind == '-':
+            raise StoreError(rest)
+        elif kind == ':':
+            return int(rest)
+        elif kind == '$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._local.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise EOFError()
+            return data[:-2]
+        elif kind == '*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for i in xrange(length)]
+        self._close()
+        raise StoreError("Unexpected reply from the store: %r" % line)
+
+    def get(self, key):
+        return self.execute('GET', key)
+
+    def set(self, key, value):
+        self.execute('SET', key, value)
+
+    def delete(self, *keys):
+        self.execute('DEL', *keys)
+
+    def incr(self, key):
+        return self.execute('INCR', key)
+
+    def push(self, key, value):
+        self.execute('LPUSH', key, value)
+
+    def move(self, source, destination):
+        return self.execute('RPOPLPUSH', source, destination)
+
+    def move_and_set(self, source, destination, key_prefix, value):
+        return self.execute('EVAL', self.MOVE_AND_SET_SCRIPT, 2, source, destination, key_prefix, value)
+
+    def set_and_push(self, values, key, value):
+        items = sorted(values.items())
+        args = [key] + [k for k, v in items] + [value] + [v for k, v in items]
+        self.execute('EVAL', self.SET_AND_PUSH_SCRIPT, len(items) + 1, *args)
+
+    def remove(self, key, value):
+        return self.execute('LREM', key, 0, value)
+
+    def head(self, key):
+        return self.execute('LINDEX', key, -1)
+
+    def length(self, key):
+        return self.execute('LLEN', key)
+
+    def items(self, key):
+        return list(reversed(self.execute('LRANGE', key, 0, -1)))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Returns the store selected by YETI_STORE. Stores are created once per
+    process for each configuration.
+    """
+    if settings.YETI_STORE == STORE_FILE:
+        key = (STORE_FILE, settings.YETI_STORE_PATH)
+    elif settings.YETI_STORE == STORE_RESP:
+        key = (STORE_RESP, settings.YETI_STORE_URL)
+    else:
+        raise ImproperlyConfigured("Unsupported YETI_STORE: %s" % settings.YETI_STORE)
+
+    store = _stores.get(key)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(key)
+            if store is None:
+                if key[0] == STORE_FILE:
+                    store = FileStore(settings.YETI_STORE_PATH)
+                else:
+                    store = RespStore(settings.YETI_STORE_URL, settings.YETI_STORE_TIMEOUT)
+                _stores[key] = store
+    return store
+
+
+def get_key(*parts):
+    """
+    Returns the store key made of parts, under YETI_STORE_PREFIX
+    """
+    return settings.YETI_STORE_PREFIX + ':'.join(str(part) for part in parts)
+
+
+class SharedGeneration(object):
+    """
+    A counter in the store that a process increments when it changes something
+    other processes have cached. Each process checks whether it has changed
+    at most every YETI_STORE_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._seen = None
+        self._checked_at = 0
+
+    def bump(self):
+        """
+        Tells the other processes to drop what they have cached
+        """
+        try:
+            self._seen = str(get_store().incr(get_key('generation', self.name)))
+        except StoreError:
+            log.exception("Cannot tell other processes that %s has changed", self.name)
+
+    def changed(self):
+        """
+        Returns True if another process has bumped the counter since the last check
+        """
+        now = time.time()
+        if now - self._checked_at < settings.YETI_STORE_CHECK_INTERVAL:
+            return False
+        first_check = self._checked_at == 0
+        self._checked_at = now
+        try:
+            generation = get_store().get(get_key('generation', self.name))
+        except StoreError:
+            log.exception("Cannot check whether %s has changed", self.name)
+            return False
+        changed = generation != self._seen and not first_check
+        self._seen = generation
+        return changed
@@ -0,0 +1,142 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from taxii_services.exceptions import StatusMessageException
+from taxii_services.message_handlers.base_handlers import BaseMessageHandler
+from taxii_services.message_handlers.subscription_request_handlers import (SubscriptionRequest10Handler,
+                                                                            SubscriptionRequest11Handler)
+from taxii_services.models import Subscription, SUBS_PUSH
+
+from yeti.matching import QUERY_HANDLER
+from yeti.models import PushSubscription
+from yeti.push import PROTOCOL_SCHEMES, SERVICES_VERSIONS
+
+import libtaxii.messages_11 as tm11
+import libtaxii.messages_10 as tm10
+from libtaxii.constants import *
+
+from django.db import transaction
+import urlparse
+
+
+def validate_push_parameters(push_parameters, in_response_to):
+    """
+    Raises a StatusMessageException unless yeti.push can deliver to push_parameters
+    """
+    if push_parameters.inbox_protocol not in PROTOCOL_SCHEMES:
+        raise StatusMessageException(in_response_to,
+                                     ST_UNSUPPORTED_PROTOCOL,
+                                     status_detail={SD_SUPPORTED_PROTOCOL: PROTOCOL_SCHEMES.keys()})
+    if push_parameters.delivery_message_binding not in SERVICES_VERSIONS:
+        raise StatusMessageException(in_response_to,
+                                     ST_UNSUPPORTED_MESSAGE_BINDING,
+                                     status_detail={SD_SUPPORTED_BINDING: SERVICES_VERSIONS.keys()})
+    url = urlparse.urlsplit(push_parameters.inbox_address)
+    if url.scheme != PROTOCOL_SCHEMES[push_parameters.inbox_protocol] or not url.hostname:
+        raise StatusMessageException(in_response_to,
+                                     ST_BAD_MESSAGE,
+                                     message='The Inbox Address is not a URL for the Inbox Protocol.')
+
+
+def validate_query(query, in_response_to):
+    """
+    Raises a StatusMessageException unless yeti.matching can evaluate query
+    """
+    supported_tevs = QUERY_HANDLER.get_supported_tevs()
+    if query.format_id != FID_TAXII_DEFAULT_QUERY_10 or query.targeting_expression_id not in supported_tevs:
+        raise StatusMessageException(in_response_to,
+                                     ST_UNSUPPORTED_QUERY,
+                                     status_detail={SD_SUPPORTED_QUERY: [FID_TAXII_DEFAULT_QUERY_10]})
+    try:
+        QUERY_HANDLER.get_plan(query.criteria)
+    except ValueError as e:
+        raise StatusMessageException(in_response_to,
+                                     ST_BAD_MESSAGE,
+                                     message='The query cannot be evaluated: %s' % e)
+
+
+class PushSubscriptionRequest11Handler(SubscriptionRequest11Handler):
+    """
+    TAXII 1.1 Manage Collection Subscription Request Handler that accepts
+    Push Parameters and a STIX 1.1.1 Default Query. Content added to the Data
+    Collection after a push subscription is created is matched against it as it
+    arrives (see yeti.matching), and delivered to its Inbox Service by the
+    deliver_subscriptions management command (see yeti.push).
+    """
+
+    @staticmethod
+    def subscribe(subscription_management_request, data_collection):
+        """
+        Subscriptions without Push Parameters are created by the built-in handler.
+        Each subscription with Push Parameters is a new Subscription, which is sent
+        the content added to the Data Collection from now on that matches its
+        content bindings and Default Query.
+        """
+        smr = subscription_management_request
+        if smr.push_parameters is None:
+            return SubscriptionRequest11Handler.subscribe(smr, data_collection)
+
+        validate_push_parameters(smr.push_parameters, smr.message_id)
+        query = smr.subscription_parameters.query
+        if query is not None:
+            validate_query(query, smr.message_id)
+
+        content_bindings = smr.subscription_parameters.content_bindings
+        with transaction.atomic():
+            subscription = Subscription(data_collection=data_collection,
+                                        response_type=smr.subscription_parameters.response_type,
+                                        accept_all_content=len(content_bindings) == 0,
+                                        delivery=SUBS_PUSH[0])
+            subscription.save()
+            if content_bindings:
+                subscription.supported_content = data_collection.get_binding_intersection_11(content_bindings,
+                                                                                              smr.message_id)
+            PushSubscription.objects.create(subscription=subscription,
+                                            inbox_protocol=smr.push_parameters.inbox_protocol,
+                                            inbox_address=smr.push_parameters.inbox_address,
+                                            delivery_message_binding=smr.push_parameters.delivery_message_binding,
+                                            query=query.to_xml() if query is not None else '')
+        return subscription.to_subscription_instance_11()
+
+    @classmethod
+    def handle_message(cls, collection_management_service, manage_collection_subscription_request, django_request):
+        """
+        Same as the built-in handler, but Subscription Instances of
+        push subscriptions include their Push Parameters and query
+        """
+        response = super(PushSubscriptionRequest11Handler, cls).handle_message(collection_management_service,
+                                                                              manage_collection_subscription_request,
+                                                                              django_request)
+        instances = dict((si.subscription_id, si) for si in response.subscription_instances)
+        for push_subscription in PushSubscription.objects.filter(subscription__subscription_id__in=instances.keys()
+                                                                 ).select_related('subscription'):
+            instance = instances[push_subscription.subscription.subscription_id]
+            instance.push_parameters = push_subscription.to_push_parameters_11()
+            instance.subscription_parameters.query = push_subscription.get_query()
+        return response
+
+
+class PushSubscriptionRequestHandler(BaseMessageHandler):
+    """
+    TAXII 1.1 and TAXII 1.0 Manage Collection/Feed Subscription Request Handler
+    that accepts TAXII 1.1 Push Parameters
+    """
+
+    supported_request_messages = [tm11.ManageCollectionSubscriptionRequest, tm10.ManageFeedSubscriptionRequest]
+    version = "1"
+
+    @staticmethod
+    def handle_message(collection_management_service, manage_collection_subscription_request, django_request):
+        """
+        Passes the request to either SubscriptionRequest10Handler or PushSubscriptionRequest11Handler
+        """
+        cms = collection_management_service
+        mcsr = manage_collection_subscription_request
+        if isinstance(mcsr, tm10.ManageFeedSubscriptionRequest):
+            return SubscriptionRequest10Handler.handle_message(cms, mcsr, django_request)
+        elif isinstance(mcsr, tm11.ManageCollectionSubscriptionRequest):
+            return PushSubscriptionRequest11Handler.handle_message(cms, mcsr, django_request)
+        else:
+            raise StatusMessageException(mcsr.message_id,
+                                         ST_FAILURE,
+                                         "TAXII Message not supported by Message Handler.")
@@ -0,0 +1,30 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+from yeti.store import STORE_FILE
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+import os
+import shutil
+import tempfile
+
+
+class YetiTestRunner(DiscoverRunner):
+    """
+    Runs the tests with the store (see yeti.store) in a temporary directory,
+    instead of the YETI_STORE_PATH that a local server uses
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super(YetiTestRunner, self).setup_test_environment(**kwargs)
+        self.store_dir = tempfile.mkdtemp()
+        self.store_settings = override_settings(YETI_STORE=STORE_FILE,
+                                                YETI_STORE_PATH=os.path.join(self.store_dir, 'store.db'))
+        self.store_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        # The store settings stay overridden, since yeti.notify's thread keeps reading the
+        # store until the process exits, and would create a store at YETI_STORE_PATH
+        shutil.rmtree(self.store_dir)
+        super(YetiTestRunner, self).teardown_test_environment(**kwargs)
@@ -7,18 +7,57 @@ import libtaxii.messages_11 as tm11
 import libtaxii.taxii_default_query as tdq
 import libtaxii.clients as tc
 from libtaxii.constants import *
-from libtaxii.common import generate_message_id
+from libtaxii.common import generate_message_id, parse
 
 #from taxii_services.handlers import (TAXII_11_HTTPS_Headers, TAXII_11_HTTP_Headers, TAXII_10_HTTPS_Headers, TAXII_10_HTTP_Headers, get_headers)
 
 from datetime import datetime, timedelta
 from dateutil.tz import tzutc
 from taxii_services import models
+from taxii_services.management import register_message_handler, register_query_handler
+from taxii_services.query_handlers import StixXml111QueryHandler
+from taxii_services.util import PollRequestProperties
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models.signals import pre_delete
+from django.http import Http404
+from lxml import etree
+from lxml.etree import XMLSyntaxError
+from yeti.notify import content_notifier
+from yeti.matching import SubscriptionMatcher, get_subscription_matcher
+from yeti.models import (CollectionCount, CollectionMembership, ContentBlob, ContentDigest, ContentField,
+                         IndexedContentBlock, PushDelivery, PushSubscription, QueuedContent, ResultSetCursor,
+                         StoredContent, add_months, count_collection_content, delete_unreferenced_blobs,
+                         get_contents, get_retention_cutoff, prune_collection_month)
+from yeti import content_store, green, inbox_handlers, metrics, push, spool
+from yeti.content_cache import content_tree_cache
+from yeti.db import configure_sqlite
+from yeti.dispatch import ServiceDispatcher
+from yeti.parsing import parse_message
+from yeti.push import PushDeliverer
+from yeti.query_handlers import (CriteriaPlan, IndexedStixXml111QueryHandler, close_query_pool, get_query_pool,
+                                 normalize_criteria, query_plan_cache, start_query_pool)
+from yeti.registry import registry
+from yeti.spool import InboxSpool
+from yeti.store import FileStore, RespStore, SharedGeneration, StoreError, get_key, get_store
 
 from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
 from copy import deepcopy
+from django.db.models.query import QuerySet
 import urllib2
+from StringIO import StringIO
+import BaseHTTPServer
+import httplib
+import SocketServer
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
 
 # Global params for TestCases to use
 DEBUG = True
@@ -119,7 +158,10 @@ def get_message_from_client_response(resp, in_response_to):
     """ helper func"""
     
     taxii_content_type = resp.get('X-TAXII-Content-Type', None)
-    response_message = resp.content
+    if resp.streaming:
+        response_message = ''.join(resp.streaming_content)
+    else:
+        response_message = resp.content
 
     if taxii_content_type is None:
         m = str(resp) + '\r\n' + response_message
@@ -152,7 +194,7 @@ def make_request(path='/', post_data=None, header_dict=None, response_msg_type=N
         resp = c.get(path, **header_dict)
     
     if resp.status_code != expected_code:
-        msg = resp.content
+        msg = resp.content if not resp.streaming else ''.join(resp.streaming_content)
         raise ValueError("Response code was not %s. Was: %s.\r\n%s" % \
                          (str(expected_code), str(resp.status_code), msg) )
     
@@ -780,7 +822,37 @@ class SubscriptionTests11(TestCase):
     fixtures = ['test_data.json']
     
     # Make sure to test query in here
-    pass
+
+    def setUp(self):
+        use_subscription_handler('yeti.subscription_handlers.PushSubscriptionRequestHandler')
+
+    def test_01(self):
+        """
+        Subscribing with Push Parameters creates a push subscription, whose Subscription Instance includes them
+        """
+        response = subscribe('http://127.0.0.1:9/services/inbox/')
+        subscription_id = response.subscription_instances[0].subscription_id
+        push_subscription = PushSubscription.objects.get(subscription__subscription_id=subscription_id)
+        self.assertEqual(push_subscription.subscription.delivery, models.SUBS_PUSH[0])
+
+        request = tm11.ManageCollectionSubscriptionRequest(message_id=generate_message_id(), collection_name='default',
+                                                           action=ACT_STATUS, subscription_id=subscription_id)
+        response = make_request(COLLECTION_MGMT_11_PATH, request.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                                MSG_MANAGE_COLLECTION_SUBSCRIPTION_RESPONSE)
+        push_parameters = response.subscription_instances[0].push_parameters
+        self.assertEqual(push_parameters.inbox_address, 'http://127.0.0.1:9/services/inbox/')
+        self.assertEqual(push_parameters.delivery_message_binding, VID_TAXII_XML_11)
+
+    def test_02(self):
+        """
+        Push Parameters YETI cannot deliver to are refused
+        """
+        subscribe('http://127.0.0.1:9/services/inbox/', protocol='urn:example:smtp',
+                  response_msg_type=MSG_STATUS_MESSAGE, st=ST_UNSUPPORTED_PROTOCOL)
+        subscribe('http://127.0.0.1:9/services/inbox/', binding='urn:example:json',
+                  response_msg_type=MSG_STATUS_MESSAGE, st=ST_UNSUPPORTED_MESSAGE_BINDING)
+        subscribe('not a url', response_msg_type=MSG_STATUS_MESSAGE, st=ST_BAD_MESSAGE)
+        self.assertEqual(PushSubscription.objects.count(), 0)
 
 class SubscriptionTests10(TestCase):
     
@@ -837,5 +909,2387 @@ class DiscoveryTests10(TestCase):
                              # (msg.message_type, msg.to_xml(pretty_print=True)) )
 
 
+def add_content_blocks(collection_name, count, content=stix_watchlist_111, binding_id=CB_STIX_XML_111):
+    """
+    Saves `count` content blocks and adds them to the named Data Collection
+    """
+    cbas = models.ContentBindingAndSubtype.objects.get(content_binding__binding_id=binding_id, subtype=None)
+    collection = models.DataCollection.objects.get(name=collection_name)
+    content_blocks = []
+    for i in range(count):
+        cb = models.ContentBlock(content_binding_and_subtype=cbas, content=content)
+        cb.save()
+        collection.content_blocks.add(cb)
+        content_blocks.append(cb)
+    return content_blocks
+
+def create_poll_service(path, poll_request_handler, collection_name='default', **kwargs):
+    """
+    Creates an enabled Poll Service at path that uses the named poll request handler
+    """
+    register_message_handler(poll_request_handler, retry=False)
+    ps = models.PollService(name=path,
+                            path=path,
+                            poll_request_handler=models.MessageHandler.objects.get(handler=poll_request_handler),
+                            **kwargs)
+    ps.save()
+    ps.data_collections.add(models.DataCollection.objects.get(name=collection_name))
+    return ps
+
+def create_inbox_service(path, inbox_message_handler, collection_name='default'):
+    """
+    Creates an Inbox Service at path that accepts all content, uses the named
+    inbox message handler, and can add content to the named Data Collection
+    """
+    register_message_handler(inbox_message_handler, retry=False)
+    inbox_service = models.InboxService(name=path,
+                                        path=path,
+                                        inbox_message_handler=models.MessageHandler.objects.get(handler=inbox_message_handler),
+                                        destination_collection_status=models.OPTIONAL[0],
+                                        accept_all_content=True)
+    inbox_service.save()
+    inbox_service.destination_collections.add(models.DataCollection.objects.get(name=collection_name))
+    return inbox_service
+
+def use_subscription_handler(subscription_management_handler):
+    """
+    Makes the default Collection Management Service use the named subscription management handler
+    """
+    register_message_handler(subscription_management_handler, retry=False)
+    cms = models.CollectionManagementService.objects.get(path=COLLECTION_MGMT_11_PATH)
+    cms.subscription_management_handler = models.MessageHandler.objects.get(handler=subscription_management_handler)
+    cms.save()
+
+def subscribe(inbox_address, binding=VID_TAXII_XML_11, protocol=VID_TAXII_HTTP_10, content_bindings=None, query=None,
+              response_msg_type=MSG_MANAGE_COLLECTION_SUBSCRIPTION_RESPONSE, st=None):
+    """
+    Subscribes to the default Data Collection with Push Parameters
+    """
+    request = tm11.ManageCollectionSubscriptionRequest(message_id=generate_message_id(), collection_name='default',
+                                                       action=ACT_SUBSCRIBE,
+                                                       subscription_parameters=tm11.SubscriptionParameters(
+                                                           content_bindings=content_bindings, query=query),
+                                                       push_parameters=tm11.PushParameters(protocol, inbox_address, binding))
+    return make_request(COLLECTION_MGMT_11_PATH, request.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                        response_msg_type, st)
+
+class StreamingPollTests(TestCase):
+    """
+    Tests yeti.poll_handlers.StreamingPollRequestHandler
+    """
+
+    path = '/services/test_streaming_poll/'
+
+    def setUp(self):
+        self.poll_service = create_poll_service(self.path, 'yeti.poll_handlers.StreamingPollRequestHandler')
+        add_content_blocks('default', 7)
+
+    def test_01(self):
+        """
+        A TAXII 1.1 Poll Request gets a streamed Poll Response with every content block
+        """
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        resp = Client().post(self.path, data=pr.to_xml(), content_type='application/xml',
+                             **get_headers(VID_TAXII_SERVICES_11, False))
+        self.assertTrue(resp.streaming)
+        msg = get_message_from_client_response(resp, pr.message_id)
+        self.assertEqual(msg.message_type, MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 7)
+        self.assertEqual(msg.record_count.record_count, 7)
+        self.assertEqual(msg.in_response_to, pr.message_id)
+
+    def test_02(self):
+        """
+        Content blocks are streamed in timestamp label order across several batches
+        """
+        with self.settings(YETI_POLL_STREAM_BATCH_SIZE=2):
+            pr = tm11.PollRequest(message_id=generate_message_id(),
+                                  collection_name='default',
+                                  poll_parameters=tm11.PollParameters())
+            msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+        labels = [cb.timestamp_label for cb in msg.content_blocks]
+        self.assertEqual(len(labels), 7)
+        self.assertEqual(labels, sorted(labels))
+
+    def test_03(self):
+        """
+        A Count Only Poll Request gets a Poll Response with just the record count
+        """
+        pp = tm11.PollParameters(response_type=RT_COUNT_ONLY)
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=pp)
+        msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 0)
+        self.assertEqual(msg.record_count.record_count, 7)
+
+    def test_04(self):
+        """
+        A TAXII 1.0 Poll Request gets a streamed Poll Response
+        """
+        pr = tm10.PollRequest(message_id=generate_message_id(), feed_name='default')
+        msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_10, False), MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 7)
+
+
+class IndexedPollTests(TestCase):
+    """
+    Tests yeti.poll_handlers.IndexedPollRequestHandler
+    and the yeti.models.CollectionMembership index
+    """
+
+    path = '/services/test_indexed_poll/'
+
+    def setUp(self):
+        self.poll_service = create_poll_service(self.path, 'yeti.poll_handlers.IndexedPollRequestHandler')
+        self.content_blocks = add_content_blocks('default', 6)
+
+    def test_01(self):
+        """
+        Adding content blocks to a Data Collection indexes them
+        """
+        collection = models.DataCollection.objects.get(name='default')
+        self.assertEqual(CollectionMembership.objects.filter(collection=collection).count(), 6)
+        collection.content_blocks.remove(self.content_blocks[0])
+        self.assertEqual(CollectionMembership.objects.filter(collection=collection).count(), 5)
+        self.content_blocks[1].datacollection_set.clear()
+        self.assertEqual(CollectionMembership.objects.filter(collection=collection).count(), 4)
+
+    def test_02(self):
+        """
+        A poll with an exclusive begin timestamp label only gets later content
+        """
+        begin_ts = self.content_blocks[2].timestamp_label
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              exclusive_begin_timestamp_label=begin_ts,
+                              poll_parameters=tm11.PollParameters())
+        msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 3)
+        for cb in msg.content_blocks:
+            self.assertTrue(cb.timestamp_label > begin_ts)
+
+    def test_03(self):
+        """
+        A poll with a content binding only gets content with that binding
+        """
+        add_content_blocks('default', 2, content=stix_watchlist_10, binding_id=CB_STIX_XML_10)
+        pp = tm11.PollParameters(content_bindings=[tm11.ContentBinding(CB_STIX_XML_10)])
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=pp)
+        msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 2)
+        for cb in msg.content_blocks:
+            self.assertEqual(cb.content_binding.binding_id, CB_STIX_XML_10)
+
+    def test_04(self):
+        """
+        The build_poll_index command backfills the index
+        """
+        CollectionMembership.objects.all().delete()
+        call_command('build_poll_index', stdout=StringIO())
+        self.assertEqual(CollectionMembership.objects.count(), 6)
+        call_command('build_poll_index', stdout=StringIO())
+        self.assertEqual(CollectionMembership.objects.count(), 6)
+
+    def test_05(self):
+        """
+        Content blocks that are in more than one Data Collection are only returned once
+        """
+        collection = models.DataCollection(name='second', type=CT_DATA_FEED)
+        collection.save()
+        for cb in self.content_blocks:
+            collection.content_blocks.add(cb)
+
+        with self.settings(YETI_POLL_STREAM_BATCH_SIZE=2):
+            pr = tm11.PollRequest(message_id=generate_message_id(),
+                                  collection_name='default',
+                                  poll_parameters=tm11.PollParameters())
+            msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 6)
+
+
+class ResultSetCursorTests(TestCase):
+    """
+    Tests multi-part result sets created by yeti.poll_handlers.IndexedPollRequestHandler
+    and served by yeti.poll_handlers.IndexedPollFulfillmentRequest11Handler
+    """
+
+    path = '/services/test_result_set_poll/'
+
+    def setUp(self):
+        handler = 'yeti.poll_handlers.IndexedPollFulfillmentRequest11Handler'
+        register_message_handler(handler, retry=False)
+        self.poll_service = create_poll_service(self.path, 'yeti.poll_handlers.IndexedPollRequestHandler',
+                                                max_result_size=3,
+                                                poll_fulfillment_handler=models.MessageHandler.objects.get(handler=handler))
+        add_content_blocks('default', 7)
+
+    def poll(self):
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        return make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+
+    def fulfill(self, result_id, part_number, response_msg_type=MSG_POLL_RESPONSE, st=None):
+        pfr = tm11.PollFulfillmentRequest(message_id=generate_message_id(),
+                                          collection_name='default',
+                                          result_id=result_id,
+                                          result_part_number=part_number)
+        return make_request(self.path, pfr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), response_msg_type, st)
+
+    def test_01(self):
+        """
+        Each part of a multi-part result set can be fetched,
+        and together the parts hold every content block in order
+        """
+        msg = self.poll()
+        self.assertEqual(msg.record_count.record_count, 7)
+        self.assertTrue(msg.more)
+        parts = [msg] + [self.fulfill(msg.result_id, n) for n in (2, 3)]
+        self.assertEqual([len(part.content_blocks) for part in parts], [3, 3, 1])
+        self.assertEqual([part.more for part in parts], [True, True, False])
+        labels = [cb.timestamp_label for part in parts for cb in part.content_blocks]
+        self.assertEqual(labels, sorted(labels))
+        self.assertEqual(ResultSetCursor.objects.count(), 3)
+
+    def test_02(self):
+        """
+        Content added after a result set was created is not added to its parts
+        """
+        msg = self.poll()
+        add_content_blocks('default', 4)
+        self.assertEqual(len(self.fulfill(msg.result_id, 3).content_blocks), 1)
+
+    def test_03(self):
+        """
+        Expired result sets are not served, and are deleted by sweep_result_sets
+        """
+        msg = self.poll()
+        models.ResultSet.objects.update(expires=datetime.now(tzutc()) - timedelta(seconds=1))
+        self.fulfill(msg.result_id, 2, MSG_STATUS_MESSAGE, ST_NOT_FOUND)
+        call_command('sweep_result_sets', stdout=StringIO())
+        self.assertEqual(models.ResultSet.objects.count(), 0)
+        self.assertEqual(ResultSetCursor.objects.count(), 0)
+        self.fulfill(msg.result_id, 2, MSG_STATUS_MESSAGE, ST_NOT_FOUND)
+
+
+class BulkInboxTests(TestCase):
+    """
+    Tests yeti.inbox_handlers.BulkInboxMessageHandler
+    """
+
+    path = '/services/test_bulk_inbox/'
+
+    def setUp(self):
+        self.inbox_service = create_inbox_service(self.path, 'yeti.inbox_handlers.BulkInboxMessageHandler')
+        self.collection = models.DataCollection.objects.get(name='default')
+
+    def send(self, contents, destination_collection_names=None):
+        im = tm11.InboxMessage(message_id=generate_message_id(),
+                               destination_collection_names=destination_collection_names or [])
+        for content in contents:
+            im.content_blocks.append(tm11.ContentBlock(tm11.ContentBinding(CB_STIX_XML_111), content))
+        return make_request(self.path, im.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                            MSG_STATUS_MESSAGE, ST_SUCCESS)
+
+    def test_01(self):
+        """
+        Every content block of an Inbox Message is saved, digested, and added to the collection index
+        """
+        contents = [stix_watchlist_111.replace('malicious1', 'malicious%s' % i) for i in range(25)]
+        self.send(contents, ['default'])
+        self.assertEqual(models.ContentBlock.objects.count(), 25)
+        self.assertEqual(ContentDigest.objects.count(), 25)
+        self.assertEqual(self.collection.content_blocks.count(), 25)
+        self.assertEqual(CollectionMembership.objects.filter(collection=self.collection).count(), 25)
+        self.assertEqual(models.InboxMessage.objects.get().content_blocks_saved, 25)
+
+    def test_02(self):
+        """
+        Duplicate content, in the same message or a later one, is only saved again for collections it is not in
+        """
+        self.send([stix_watchlist_111, stix_watchlist_111])
+        self.assertEqual(models.ContentBlock.objects.count(), 1)
+        self.assertEqual(self.collection.content_blocks.count(), 0)
+
+        self.send([stix_watchlist_111], ['default'])
+        self.assertEqual(models.ContentBlock.objects.count(), 2)
+        self.assertEqual(self.collection.content_blocks.count(), 1)
+        self.assertEqual(CollectionMembership.objects.filter(collection=self.collection).count(), 1)
+        self.assertEqual(ContentDigest.objects.get().content_block, self.collection.content_blocks.get())
+
+        self.send([stix_watchlist_111], ['default'])
+        self.assertEqual(models.ContentBlock.objects.count(), 2)
+        self.assertEqual(self.collection.content_blocks.count(), 1)
+
+    def test_03(self):
+        """
+        A TAXII 1.0 Inbox Message is saved
+        """
+        im = tm10.InboxMessage(message_id=generate_message_id())
+        im.content_blocks.append(tm10.ContentBlock(CB_STIX_XML_10, stix_watchlist_10))
+        make_request(self.path, im.to_xml(), get_headers(VID_TAXII_SERVICES_10, False), MSG_STATUS_MESSAGE, ST_SUCCESS)
+        self.assertEqual(models.ContentBlock.objects.count(), 1)
+
+    def test_04(self):
+        """
+        The build_content_digests command backfills digests, so older content counts as a duplicate
+        """
+        self.send([stix_watchlist_111])
+        ContentDigest.objects.all().delete()
+        call_command('build_content_digests', stdout=StringIO())
+        self.assertEqual(ContentDigest.objects.count(), 1)
+        self.send([stix_watchlist_111])
+        self.assertEqual(models.ContentBlock.objects.count(), 1)
+
+    def test_05(self):
+        """
+        Each saved content block gets the digest of its own content, and a digest cannot be saved twice
+        """
+        contents = [stix_watchlist_111.replace('malicious1', 'malicious%s' % i) for i in range(10)]
+        self.send(contents)
+        for cb in models.ContentBlock.objects.all():
+            self.assertEqual(cb.contentdigest.digest,
+                             ContentDigest.get_digest(cb.content_binding_and_subtype_id, cb.content))
+
+        copy = models.ContentBlock.objects.create(content_binding_and_subtype=cb.content_binding_and_subtype,
+                                                  content=cb.content)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ContentDigest.objects.create(content_block=copy, digest=cb.contentdigest.digest)
+
+    def test_06(self):
+        """
+        An Inbox Message whose content is saved by another transaction first is saved again
+        """
+        original = inbox_handlers.bulk_save_content_blocks
+        attempts = []
+
+        def bulk_save_content_blocks(inbox_message_db, content_blocks):
+            attempts.append(inbox_message_db)
+            saved = original(inbox_message_db, content_blocks)
+            if len(attempts) == 1:
+                raise IntegrityError('column digest is not unique')
+            return saved
+
+        inbox_handlers.bulk_save_content_blocks = bulk_save_content_blocks
+        try:
+            self.send([stix_watchlist_111], ['default'])
+        finally:
+            inbox_handlers.bulk_save_content_blocks = original
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(models.InboxMessage.objects.get().content_blocks_saved, 1)
+        self.assertEqual(models.ContentBlock.objects.count(), 1)
+        self.assertEqual(self.collection.content_blocks.count(), 1)
+
+    def test_07(self):
+        """
+        Content already received, but new to a collection, is polled by clients that last polled before it arrived
+        """
+        self.send([stix_watchlist_111])
+        begin = models.ContentBlock.objects.get().timestamp_label
+        self.send([stix_watchlist_111], ['default'])
+
+        for i, handler in enumerate(('taxii_services.message_handlers.PollRequest11Handler',
+                                     'yeti.poll_handlers.IndexedPollRequestHandler')):
+            path = '/services/test_bulk_inbox_poll_%s/' % i
+            create_poll_service(path, handler)
+            pr = tm11.PollRequest(message_id=generate_message_id(),
+                                  collection_name='default',
+                                  exclusive_begin_timestamp_label=begin,
+                                  poll_parameters=tm11.PollParameters())
+            msg = make_request(path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+            self.assertEqual(len(msg.content_blocks), 1)
+
+    def test_08(self):
+        """
+        Content blocks saved by other handlers get digests, which follow edits to their content
+        """
+        cb, = add_content_blocks('default', 1, content=stix_watchlist_10)
+        self.assertEqual(ContentDigest.objects.get(content_block=cb).digest,
+                         ContentDigest.get_digest(cb.content_binding_and_subtype_id, stix_watchlist_10))
+
+        self.send([stix_watchlist_111], ['default'])
+        received = self.collection.content_blocks.exclude(pk=cb.pk).get()
+        original = received.content
+        received.content = original.replace('malicious1', 'edited')
+        received.save()
+        self.assertEqual(ContentDigest.objects.get(content_block=received).digest,
+                         ContentDigest.get_digest(received.content_binding_and_subtype_id, received.content))
+
+        self.send([stix_watchlist_111], ['default'])  # Not a duplicate of the edited content block
+        self.assertEqual(self.collection.content_blocks.filter(content=original).count(), 1)
+
+        received.content = original  # Now a duplicate of the content block just received
+        received.save()
+        self.assertFalse(ContentDigest.objects.filter(content_block=received).exists())
+        self.assertEqual(ContentDigest.objects.count(), 2)
+
+
+class SpooledInboxTests(TestCase):
+    """
+    Tests yeti.inbox_handlers.SpooledInboxMessageHandler and yeti.spool
+    """
+
+    path = '/services/test_spooled_inbox/'
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.spool_settings = self.settings(YETI_STORE='file', YETI_STORE_PATH=os.path.join(self.spool_dir, 'store.db'))
+        self.spool_settings.enable()
+        self.spool = InboxSpool()
+        create_inbox_service(self.path, 'yeti.inbox_handlers.SpooledInboxMessageHandler')
+
+    def tearDown(self):
+        self.spool_settings.disable()
+        shutil.rmtree(self.spool_dir)
+
+    def test_01(self):
+        """
+        An Inbox Message is acknowledged before it is saved, and saved when the spool is drained
+        """
+        im = tm11.InboxMessage(message_id=generate_message_id(), destination_collection_names=['default'])
+        im.content_blocks.append(tm11.ContentBlock(tm11.ContentBinding(CB_STIX_XML_111), stix_watchlist_111))
+        make_request(self.path, im.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_STATUS_MESSAGE, ST_SUCCESS)
+        self.assertEqual(models.ContentBlock.objects.count(), 0)
+        self.assertEqual(self.spool.stats()['depth'], 1)
+
+        self.assertEqual(spool.drain(10), 1)
+        self.assertEqual(models.DataCollection.objects.get(name='default').content_blocks.count(), 1)
+        self.assertEqual(self.spool.stats(), {'depth': 0, 'lag': 0, 'failed': 0})
+
+    def test_02(self):
+        """
+        A spooled message that cannot be saved is marked failed
+        """
+        self.spool.put('/services/no_such_inbox/', 'libtaxii.messages_11', 'not xml')
+        self.assertEqual(spool.drain(10), 1)
+        stats = self.spool.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['failed'], 1)
+
+    def test_03(self):
+        """
+        A message claimed by a worker that never finished it is claimed again after the timeout
+        """
+        self.spool.put(self.path, 'libtaxii.messages_11', 'not xml')
+        self.assertEqual(len(self.spool.claim(10)), 1)
+        self.assertEqual(len(self.spool.claim(10)), 0)
+        with self.settings(YETI_INBOX_SPOOL_CLAIM_TIMEOUT=-1):
+            self.assertEqual(len(self.spool.claim(10)), 1)
+
+    def test_04(self):
+        """
+        A claim that times out counts as an attempt, so a message that is never finished is marked failed
+        """
+        spool_id = self.spool.put(self.path, 'libtaxii.messages_11', 'not xml')
+        with self.settings(YETI_INBOX_SPOOL_CLAIM_TIMEOUT=-1, YETI_INBOX_SPOOL_MAX_ATTEMPTS=2):
+            self.assertEqual(len(self.spool.claim(10)), 1)
+            self.assertEqual(len(self.spool.claim(10)), 1)
+            self.assertEqual(len(self.spool.claim(10)), 0)
+        self.assertEqual(self.spool.stats(), {'depth': 0, 'lag': 0, 'failed': 1})
+        record = self.spool._get_record(spool_id)
+        self.assertEqual(record['attempts'], 2)
+        self.assertIn('Not saved within', record['error'])
+
+
+class DatabaseProfileTests(TestCase):
+    """
+    Tests yeti.db
+    """
+
+    def test_01(self):
+        """
+        YETI_SQLITE_PRAGMAS are run on new SQLite connections
+        """
+        with self.settings(YETI_SQLITE_PRAGMAS=['cache_size=-1234']):
+            configure_sqlite(None, connection)
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA cache_size')
+        self.assertEqual(cursor.fetchone()[0], -1234)
+
+
+class ServiceRegistryTests(TestCase):
+    """
+    Tests yeti.registry
+    """
+
+    path = '/services/test_registry_poll/'
+
+    def setUp(self):
+        registry.invalidate()
+        self.poll_service = create_poll_service(self.path, 'yeti.poll_handlers.StreamingPollRequestHandler')
+
+    def test_01(self):
+        """
+        Once loaded, finding a service and its handler class costs no queries
+        """
+        pr = tm11.PollRequest(message_id=generate_message_id(), collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        registry.get_service(self.path)
+        with self.assertNumQueries(0):
+            service = registry.get_service(self.path)
+            handler = service.get_message_handler(pr)
+            handler_class = registry.get_handler_class(handler.handler)
+        self.assertEqual(handler_class.__name__, 'StreamingPollRequestHandler')
+
+    def test_02(self):
+        """
+        Saving a service invalidates the registry
+        """
+        registry.get_service(self.path)
+        self.poll_service.enabled = False
+        self.poll_service.save()
+        self.assertRaises(Http404, registry.get_service, self.path)
+
+
+class CachedResponseTests(TestCase):
+    """
+    Tests yeti.cached_handlers
+    """
+
+    discovery_path = '/services/test_cached_discovery/'
+    collection_management_path = '/services/test_cached_collection_management/'
+
+    def setUp(self):
+        handler = 'yeti.cached_handlers.CachedDiscoveryRequestHandler'
+        register_message_handler(handler, retry=False)
+        self.discovery_service = models.DiscoveryService(name=self.discovery_path,
+                                                         path=self.discovery_path,
+                                                         discovery_handler=models.MessageHandler.objects.get(handler=handler))
+        self.discovery_service.save()
+
+        handler = 'yeti.cached_handlers.CachedCollectionInformationRequestHandler'
+        register_message_handler(handler, retry=False)
+        handler = models.MessageHandler.objects.get(handler=handler)
+        self.cms = models.CollectionManagementService(name=self.collection_management_path,
+                                                      path=self.collection_management_path,
+                                                      collection_information_handler=handler)
+        self.cms.save()
+        self.cms.advertised_collections.add(models.DataCollection.objects.get(name='default'))
+
+    def discover(self, **headers):
+        dr = tm11.DiscoveryRequest(message_id=generate_message_id())
+        resp = Client().post(self.discovery_path, data=dr.to_xml(), content_type='application/xml',
+                             **dict(get_headers(VID_TAXII_SERVICES_11, False), **headers))
+        msg = get_message_from_client_response(resp, dr.message_id)
+        self.assertEqual(msg.message_type, MSG_DISCOVERY_RESPONSE)
+        self.assertEqual(msg.in_response_to, dr.message_id)
+        return resp, msg
+
+    def test_01(self):
+        """
+        Cached responses get their own message_id and in_response_to, and the same ETag
+        """
+        resp1, msg1 = self.discover()
+        resp2, msg2 = self.discover()
+        self.assertNotEqual(msg1.message_id, msg2.message_id)
+        self.assertEqual(resp1['ETag'], resp2['ETag'])
+
+    def test_02(self):
+        """
+        A request whose If-None-Match matches the ETag still gets the whole response, since it is a POST
+        """
+        resp1, msg1 = self.discover()
+        resp2, msg2 = self.discover(HTTP_IF_NONE_MATCH=resp1['ETag'])
+        self.assertEqual(resp2.status_code, 200)
+        self.assertEqual(resp2['ETag'], resp1['ETag'])
+        self.assertEqual(msg2.to_dict()['service_instances'], msg1.to_dict()['service_instances'])
+
+    def test_03(self):
+        """
+        Changing the advertised services changes the response
+        """
+        self.cms.supported_protocol_bindings.add(models.ProtocolBinding.objects.get(binding_id=VID_TAXII_HTTP_10))
+        resp1, msg1 = self.discover()
+        self.assertEqual(len(msg1.service_instances), 0)
+        self.discovery_service.advertised_collection_management_services.add(self.cms)
+        resp2, msg2 = self.discover(HTTP_IF_NONE_MATCH=resp1['ETag'])
+        self.assertNotEqual(resp1['ETag'], resp2['ETag'])
+        self.assertTrue(len(msg2.service_instances) > 0)
+
+    def test_04(self):
+        """
+        A TAXII 1.1 Collection Information Request gets a cached response
+        """
+        cir = tm11.CollectionInformationRequest(message_id=generate_message_id())
+        msg = make_request(self.collection_management_path, cir.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                           MSG_COLLECTION_INFORMATION_RESPONSE)
+        self.assertEqual(msg.in_response_to, cir.message_id)
+        self.assertEqual([ci.collection_name for ci in msg.collection_informations], ['default'])
+
+
+class ServiceDispatcherTests(TestCase):
+    """
+    Tests yeti.dispatch
+    """
+
+    def call(self, path, **environ):
+        """
+        Sends a GET request to a new ServiceDispatcher and
+        returns (the dispatcher, the status line, the headers)
+        """
+        dispatcher = ServiceDispatcher()
+        environ.update({'REQUEST_METHOD': 'GET',
+                        'PATH_INFO': path,
+                        'SERVER_NAME': 'testserver',
+                        'SERVER_PORT': '80',
+                        'wsgi.url_scheme': 'http',
+                        'wsgi.input': StringIO('')})
+        started = []
+        dispatcher(environ, lambda status, headers: started.append((status, dict(headers))))
+        status, headers = started[0]
+        return dispatcher, status, headers
+
+    def test_01(self):
+        """
+        TAXII Service requests only run YETI_SERVICE_MIDDLEWARE_CLASSES
+        """
+        dispatcher, status, headers = self.call(DISCOVERY_11_PATH)
+        self.assertEqual(dispatcher.service_handler._request_middleware, [])
+        self.assertEqual(len(dispatcher.service_handler._exception_middleware), 1)
+        self.assertIsNone(dispatcher.handler._request_middleware)  # Never loaded
+
+    def test_02(self):
+        """
+        StatusMessageExceptions still become TAXII Status Messages
+        """
+        dispatcher, status, headers = self.call(DISCOVERY_11_PATH, HTTP_X_TAXII_CONTENT_TYPE=VID_TAXII_XML_11)
+        self.assertTrue(status.startswith('200'))
+        self.assertEqual(headers['x-taxii-content-type'], VID_TAXII_XML_11)
+
+    def test_03(self):
+        """
+        Other requests run the full middleware stack
+        """
+        dispatcher, status, headers = self.call('/admin/')
+        self.assertTrue(status.startswith('302'))  # To the login page, which needs the auth middleware
+        self.assertIsNone(dispatcher.service_handler._request_middleware)  # Never loaded
+
+
+class ParsingTests(TestCase):
+    """
+    Tests yeti.parsing
+    """
+
+    def inbox_message(self, count):
+        content_blocks = [tm11.ContentBlock(CB_STIX_XML_111, stix_watchlist_111) for i in range(count)]
+        return tm11.InboxMessage(message_id=generate_message_id(),
+                                 destination_collection_names=['default'],
+                                 content_blocks=content_blocks)
+
+    def test_01(self):
+        """
+        Messages are parsed the same as libtaxii parses them
+        """
+        xml = self.inbox_message(20).to_xml()  # Larger than FEED_SIZE
+        self.assertEqual(parse_message(xml, VID_TAXII_XML_11).to_xml(),
+                         tm11.get_message_from_xml(xml).to_xml())
+
+        xml = tm10.InboxMessage(message_id=generate_message_id(),
+                                content_blocks=[tm10.ContentBlock(CB_STIX_XML_10, stix_watchlist_111)]).to_xml()
+        self.assertEqual(parse_message(xml, VID_TAXII_XML_10).to_xml(),
+                         tm10.get_message_from_xml(xml).to_xml())
+
+    def test_02(self):
+        """
+        Invalid messages are rejected, and the parser can still be used afterwards
+        """
+        xml = self.inbox_message(2).to_xml()
+        self.assertRaises(XMLSyntaxError, parse_message, xml.replace('Content_Binding', 'Content_Bindingx'), VID_TAXII_XML_11)
+        self.assertRaises(XMLSyntaxError, parse_message, xml[:len(xml) / 2], VID_TAXII_XML_11)
+        self.assertRaises(XMLSyntaxError, parse_message, xml.replace('watchlist', 'a & b'), VID_TAXII_XML_11)
+        self.assertEqual(len(parse_message(xml, VID_TAXII_XML_11).content_blocks), 2)
+
+    def test_03(self):
+        """
+        The message type is checked before the rest of the message is parsed
+        """
+        xml = '<Unknown_Message xmlns="%s"><<<' % ns_map['taxii_11']
+        self.assertRaises(ValueError, parse_message, xml, VID_TAXII_XML_11, False)
+        self.assertRaises(ValueError, parse_message, '<Inbox_Message xmlns="urn:other"/>', VID_TAXII_XML_11, False)
+
+    def test_04(self):
+        """
+        Requests larger than YETI_MAX_MESSAGE_SIZE get a Status Message of Bad Message
+        """
+        dr = tm11.DiscoveryRequest(message_id=generate_message_id())
+        with self.settings(YETI_MAX_MESSAGE_SIZE=10):
+            resp = Client().post(DISCOVERY_11_PATH, data=dr.to_xml(), content_type='application/xml',
+                                 **get_headers(VID_TAXII_SERVICES_11, False))
+        msg = tm11.get_message_from_xml(resp.content)
+        self.assertEqual(msg.message_type, MSG_STATUS_MESSAGE)
+        self.assertEqual(msg.status_type, ST_BAD_MESSAGE)
+
+    def test_05(self):
+        """
+        Poll Responses are parsed with their content blocks, the same as libtaxii parses them
+        """
+        xml = tm11.PollResponse(message_id=generate_message_id(),
+                                in_response_to=generate_message_id(),
+                                collection_name='default',
+                                content_blocks=self.inbox_message(2).content_blocks).to_xml()
+        message = parse_message(xml, VID_TAXII_XML_11)
+        self.assertEqual(len(message.content_blocks), 2)
+        self.assertEqual(message.to_xml(), tm11.get_message_from_xml(xml).to_xml())
+
+        xml = tm10.PollResponse(message_id=generate_message_id(),
+                                in_response_to=generate_message_id(),
+                                feed_name='default',
+                                inclusive_end_timestamp_label=datetime.now(tzutc()),
+                                content_blocks=[tm10.ContentBlock(CB_STIX_XML_10, stix_watchlist_111)]).to_xml()
+        message = parse_message(xml, VID_TAXII_XML_10)
+        self.assertEqual(len(message.content_blocks), 1)
+        self.assertEqual(message.to_xml(), tm10.get_message_from_xml(xml).to_xml())
+
+
+stix_threat_actor_111 = '''<stix:STIX_Package
+    xmlns:stix="http://stix.mitre.org/stix-1"
+    xmlns:threat-actor="http://stix.mitre.org/ThreatActor-1"
+    xmlns:stix-ciq="http://stix.mitre.org/extensions/Identity#CIQIdentity3.0-1"
+    xmlns:xpil="urn:oasis:names:tc:ciq:xpil:3"
+    xmlns:xnl="urn:oasis:names:tc:ciq:xnl:3"
+    id="example:Package-%s" version="1.1.1">
+    <stix:STIX_Header>
+        <stix:Title>%s</stix:Title>
+    </stix:STIX_Header>
+    <stix:Threat_Actors>
+        <stix:Threat_Actor>
+            <threat-actor:Identity>
+                <stix-ciq:Specification>
+                    <xpil:PartyName>
+                        <xnl:OrganisationName>
+                            <xnl:SubDivisionName>%s</xnl:SubDivisionName>
+                        </xnl:OrganisationName>
+                    </xpil:PartyName>
+                </stix-ciq:Specification>
+            </threat-actor:Identity>
+        </stix:Threat_Actor>
+    </stix:Threat_Actors>
+</stix:STIX_Package>'''
+
+
+class IndexedQueryTests(TestCase):
+    """
+    Tests yeti.query_handlers.IndexedStixXml111QueryHandler
+    and the yeti.models.ContentField index
+    """
+
+    path = '/services/test_indexed_query/'
+    title = 'STIX_Package/STIX_Header/Title'
+    subdivision = ('STIX_Package/Threat_Actors/Threat_Actor/Identity/Specification/'
+                   'PartyName/OrganisationName/SubDivisionName')
+    name = 'STIX_Package/STIX_Header/Information_Source/Identity/Name'  # Not indexed
+    threat_actors = [('1', 'APT1', 'Unit 61398'),
+                     ('2', '42', 'unit 61398'),
+                     ('3', '7.5', 'Unit 61486'),
+                     ('4', 'Other', 'Unit 61398')]
+
+    def setUp(self):
+        self.content_blocks = []
+        for values in self.threat_actors:
+            self.content_blocks.extend(add_content_blocks('default', 1, content=stix_threat_actor_111 % values))
+
+    @staticmethod
+    def criterion(target, relationship, value, negate=False, **parameters):
+        parameters[P_VALUE] = value
+        test = tdq.Test(capability_id=tdq.CM_CORE, relationship=relationship, parameters=parameters)
+        return tdq.Criterion(target=target, test=test, negate=negate)
+
+    def filter_content(self, handler, criteria):
+        """
+        Returns the package ids of the content blocks handler.filter_content() returns for criteria
+        """
+        prp = PollRequestProperties()
+        prp.message_id = generate_message_id()
+        prp.query = tdq.DefaultQuery(CB_STIX_XML_111, criteria)
+        content_blocks = models.ContentBlock.objects.filter(pk__in=[cb.pk for cb in self.content_blocks])
+        return sorted(ContentField.objects.filter(content_block__in=handler.filter_content(prp, content_blocks),
+                                                  target='STIX_Package/@id').values_list('value', flat=True))
+
+    @classmethod
+    def queries(cls):
+        """
+        Returns a list of Criteria to compare the indexed and XPath query handlers with
+        """
+        cs = {P_MATCH_TYPE: 'case_sensitive_string'}
+        ci = {P_MATCH_TYPE: 'case_insensitive_string'}
+        return [
+            tdq.Criteria(OP_AND, criterion=[cls.criterion(cls.subdivision, R_EQUALS, 'Unit 61398', **cs)]),
+            tdq.Criteria(OP_AND, criterion=[cls.criterion(cls.subdivision, R_EQUALS, 'UNIT 61398', **ci)]),
+            tdq.Criteria(OP_AND, criterion=[cls.criterion(cls.subdivision, R_NOT_EQUALS, 'Unit 61398', **cs)]),
+            tdq.Criteria(OP_AND, criterion=[cls.criterion(cls.title, R_GREATER_THAN, 7.5)]),
+            tdq.Criteria(OP_AND, criterion=[cls.criterion(cls.title, R_LESS_THAN_OR_EQUAL, 7.5)]),
+            tdq.Criteria(OP_AND, criterion=[cls.criterion(cls.title, R_EQUALS, '42', **{P_MATCH_TYPE: 'number'})]),
+            tdq.Criteria(OP_OR, criterion=[cls.criterion(cls.title, R_EQUALS, 'APT1', **cs),
+                                           cls.criterion(cls.subdivision, R_EQUALS, 'Unit 61486', **cs)]),
+            tdq.Criteria(OP_AND, criterion=[cls.criterion(cls.subdivision, R_EQUALS, 'Unit 61398', **cs),
+                                            cls.criterion(cls.title, R_EQUALS, 'Other', negate=True, **cs)]),
+            # Criteria on targets that are not indexed are evaluated with XPath, alone and alongside indexed ones
+            tdq.Criteria(OP_AND, criterion=[cls.criterion(cls.name, R_EQUALS, 'x', negate=True, **cs)]),
+            tdq.Criteria(OP_AND, criterion=[cls.criterion(cls.subdivision, R_EQUALS, 'unit 61398', **ci),
+                                            cls.criterion(cls.name, R_EQUALS, 'x', **cs)]),
+            tdq.Criteria(OP_AND,
+                         criterion=[cls.criterion(cls.subdivision, R_EQUALS, 'unit 61398', **ci)],
+                         criteria=[tdq.Criteria(OP_OR, criterion=[cls.criterion(cls.title, R_EQUALS, 'APT1', **cs),
+                                                                  cls.criterion(cls.name, R_EQUALS, 'x', **cs)])]),
+        ]
+
+    def test_01(self):
+        """
+        Saving a content block extracts the values of YETI_INDEXED_TARGETS
+        """
+        cb = self.content_blocks[0]
+        self.assertEqual(IndexedContentBlock.objects.filter(content_block=cb).count(), 1)
+        fields = dict(ContentField.objects.filter(content_block=cb).values_list('target', 'value'))
+        self.assertEqual(fields[self.title], 'APT1')
+        self.assertEqual(fields[self.subdivision], 'Unit 61398')
+        self.assertEqual(fields['STIX_Package/@id'], 'example:Package-1')
+
+        cb.content = stix_threat_actor_111 % ('1', 'APT2', 'Unit 61398')
+        cb.save()
+        self.assertEqual(ContentField.objects.get(content_block=cb, target=self.title).value, 'APT2')
+
+    def test_02(self):
+        """
+        The indexed query handler returns the same content blocks as the XPath query handler
+        """
+        for criteria in self.queries():
+            self.assertEqual(self.filter_content(IndexedStixXml111QueryHandler, criteria),
+                             self.filter_content(StixXml111QueryHandler, criteria))
+
+    def test_03(self):
+        """
+        A query the index answers is returned as a QuerySet, unless some content blocks are not indexed
+        """
+        prp = PollRequestProperties()
+        prp.message_id = generate_message_id()
+        prp.query = tdq.DefaultQuery(CB_STIX_XML_111, self.queries()[0])
+        content_blocks = models.ContentBlock.objects.filter(pk__in=[cb.pk for cb in self.content_blocks])
+
+        result = IndexedStixXml111QueryHandler.filter_content(prp, content_blocks)
+        self.assertTrue(isinstance(result, QuerySet))
+        self.assertEqual(len(result), 2)
+
+        IndexedContentBlock.objects.filter(content_block=self.content_blocks[3]).delete()
+        result = IndexedStixXml111QueryHandler.filter_content(prp, content_blocks)
+        self.assertTrue(isinstance(result, list))
+        self.assertEqual(len(result), 2)
+
+    def test_04(self):
+        """
+        Content blocks indexed for other YETI_INDEXED_TARGETS are queried with XPath
+        until the build_query_index command indexes them again
+        """
+        with self.settings(YETI_INDEXED_TARGETS=['STIX_Package/@id', self.title]):
+            for criteria in self.queries():
+                self.assertEqual(self.filter_content(IndexedStixXml111QueryHandler, criteria),
+                                 self.filter_content(StixXml111QueryHandler, criteria))
+
+            call_command('build_query_index', stdout=StringIO())
+            self.assertEqual(IndexedContentBlock.objects.count(), models.ContentBlock.objects.count())
+            self.assertFalse(ContentField.objects.filter(target=self.subdivision).exists())
+            for criteria in self.queries():
+                self.assertEqual(self.filter_content(IndexedStixXml111QueryHandler, criteria),
+                                 self.filter_content(StixXml111QueryHandler, criteria))
+
+    def test_05(self):
+        """
+        A Poll Request with a query gets the matching content
+        """
+        for value in (CB_STIX_XML_111, tdq.CM_CORE):
+            tag_model = models.TargetingExpressionId if value == CB_STIX_XML_111 else models.CapabilityModule
+            tag_model.objects.get_or_create(value=value, defaults={'tag': value})
+        handler = 'yeti.query_handlers.IndexedStixXml111QueryHandler'
+        register_query_handler(handler, retry=False)
+        supported_query = models.SupportedQuery(name='Indexed STIX 1.1.1',
+                                                query_handler=models.QueryHandler.objects.get(handler=handler))
+        supported_query.save()
+        poll_service = create_poll_service(self.path, 'yeti.poll_handlers.IndexedPollRequestHandler')
+        poll_service.supported_queries.add(supported_query)
+
+        query = tdq.DefaultQuery(CB_STIX_XML_111, self.queries()[0])
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters(query=query))
+        msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 2)
+        for cb in msg.content_blocks:
+            self.assertTrue('Unit 61398' in cb.content)
+
+    def test_06(self):
+        """
+        Values are indexed as the numbers lxml's number() reads, and compared the same way by both query handlers
+        """
+        values = [u'1', u' \t\r\n-2.5 \n', u'-', u' - ', u'-e1', u'--1', u'+1', u'- 1', u'.', u'-.', u'.5', u'5.',
+                  u'1e3', u'1E-3', u'1e+', u'1e', u'.e1', u'e1', u'1e1.5', u'1 2', u'\xa01', u'\u0661', u'', u'  ',
+                  u'0e400', u'1e400', u'-1e400', u'0.' + u'0' * 400 + u'1', u'1' * 400, u'3.14159265358979323846264',
+                  u'123456789012345678901234567890', u'0x10', u'inf', u'NaN']
+        number = etree.XPath('number($value)')
+        element = etree.Element('Value')
+        for value in values:
+            expected = number(element, value=value)
+            actual = ContentField.get_number(value)
+            if expected != expected:
+                self.assertEqual(actual, None, repr(value))
+            else:
+                self.assertEqual(repr(actual), repr(expected), repr(value))
+
+        for i, value in enumerate([u'-', u'1e3', u'1e', u' .5 ']):
+            self.content_blocks.extend(add_content_blocks(
+                'default', 1, content=stix_threat_actor_111 % (str(i + 5), value, 'Unit 61398')))
+        for relationship in (R_GREATER_THAN, R_LESS_THAN_OR_EQUAL):
+            for value in (-1.0, -0.0, 0.5, 1.0, 100.0):
+                criteria = tdq.Criteria(OP_AND, criterion=[self.criterion(self.title, relationship, value)])
+                self.assertEqual(self.filter_content(IndexedStixXml111QueryHandler, criteria),
+                                 self.filter_content(StixXml111QueryHandler, criteria))
+
+
+class QueryPlanTests(TestCase):
+    """
+    Tests the compiled Default Query plans of yeti.query_handlers
+    """
+
+    title = 'STIX_Package/STIX_Header/Title'
+    any_title = '**/Title'
+
+    def setUp(self):
+        query_plan_cache.clear()
+
+    def criterion(self, target, value, negate=False):
+        test = tdq.Test(capability_id=tdq.CM_CORE, relationship=R_EQUALS,
+                        parameters={P_VALUE: value, P_MATCH_TYPE: 'case_sensitive_string'})
+        return tdq.Criterion(target=target, test=test, negate=negate)
+
+    def test_01(self):
+        """
+        Criteria that differ only in the order of their children share a plan
+        """
+        a = tdq.Criteria(OP_OR, criterion=[self.criterion(self.title, 'A'), self.criterion(self.title, 'B')])
+        b = tdq.Criteria(OP_OR, criterion=[self.criterion(self.title, 'B'), self.criterion(self.title, 'A')])
+        c = tdq.Criteria(OP_OR, criterion=[self.criterion(self.title, 'B'), self.criterion(self.title, 'A', True)])
+        self.assertEqual(normalize_criteria(a), normalize_criteria(b))
+        self.assertNotEqual(normalize_criteria(a), normalize_criteria(c))
+        self.assertTrue(IndexedStixXml111QueryHandler.get_plan(a) is IndexedStixXml111QueryHandler.get_plan(b))
+
+    def test_02(self):
+        """
+        The cache keeps at most YETI_QUERY_PLAN_CACHE_SIZE plans, dropping the least recently used first
+        """
+        queries = [tdq.Criteria(OP_AND, criterion=[self.criterion(self.title, value)]) for value in 'ABC']
+        with self.settings(YETI_QUERY_PLAN_CACHE_SIZE=2):
+            plans = [IndexedStixXml111QueryHandler.get_plan(query) for query in queries[:2]]
+            IndexedStixXml111QueryHandler.get_plan(queries[0])
+            IndexedStixXml111QueryHandler.get_plan(queries[2])
+            self.assertTrue(IndexedStixXml111QueryHandler.get_plan(queries[0]) is plans[0])
+            self.assertFalse(IndexedStixXml111QueryHandler.get_plan(queries[1]) is plans[1])
+
+    def test_03(self):
+        """
+        The cheapest criteria are evaluated first, and only until the result is known
+        """
+        criteria = tdq.Criteria(OP_AND, criterion=[self.criterion(self.any_title, 'APT1'),
+                                                   self.criterion(self.title, 'APT1')])
+        plan = IndexedStixXml111QueryHandler.get_plan(criteria)
+        self.assertTrue('//' not in plan.children[0].xpath.path)
+        self.assertTrue('//' in plan.children[1].xpath.path)
+
+        class Failing(object):
+            cost = 1000
+
+            def evaluate(self, content_etree):
+                raise AssertionError('Evaluated after the result was known')
+
+        content_etree = parse(stix_threat_actor_111 % ('1', 'Other', 'Unit 61398'))
+        is_apt1 = plan.children[0]
+        is_not_apt1 = IndexedStixXml111QueryHandler.get_plan(
+            tdq.Criteria(OP_AND, criterion=[self.criterion(self.title, 'APT1', True)])).children[0]
+        self.assertFalse(CriteriaPlan(OP_AND, [Failing(), is_apt1]).evaluate(content_etree))
+        self.assertTrue(CriteriaPlan(OP_OR, [Failing(), is_not_apt1]).evaluate(content_etree))
+
+class QueryPoolTests(TestCase):
+    """
+    Tests evaluating Default Queries in the yeti.query_handlers process pool
+    """
+
+    def setUp(self):
+        self.content_blocks = []
+        for values in IndexedQueryTests.threat_actors * 3:
+            self.content_blocks.extend(add_content_blocks('default', 1, content=stix_threat_actor_111 % values))
+
+    def tearDown(self):
+        close_query_pool()
+
+    def test_01(self):
+        """
+        The pool returns the same content blocks, in the same order, as evaluating queries in-process
+        """
+        content_blocks = models.ContentBlock.objects.filter(pk__in=[cb.pk for cb in self.content_blocks])
+        for criteria in IndexedQueryTests.queries():
+            expected = list(IndexedStixXml111QueryHandler.evaluate_content(criteria, content_blocks))
+            with self.settings(YETI_QUERY_POOL_SIZE=2, YETI_QUERY_POOL_MIN_CONTENT_BLOCKS=1,
+                               YETI_QUERY_POOL_CHUNK_SIZE=2):
+                self.assertTrue(start_query_pool() is get_query_pool() is not None)
+                self.assertEqual(list(IndexedStixXml111QueryHandler.evaluate_content(criteria, content_blocks)),
+                                 expected)
+
+    def test_02(self):
+        """
+        Smaller polls, and YETI_QUERY_POOL_SIZE = 0, do not use the pool
+        """
+        self.assertTrue(get_query_pool() is None)
+        criteria = IndexedQueryTests.queries()[0]
+        with self.settings(YETI_QUERY_POOL_SIZE=2, YETI_QUERY_POOL_MIN_CONTENT_BLOCKS=len(self.content_blocks) + 1):
+            pool = start_query_pool()
+            pool.terminate()  # Using it would fail
+            matches = list(IndexedStixXml111QueryHandler.evaluate_content(criteria, self.content_blocks))
+        self.assertEqual(len(matches), 6)
+
+    def test_03(self):
+        """
+        Request threads never fork the pool: queries are evaluated in-process until it is started
+        """
+        criteria = IndexedQueryTests.queries()[0]
+        with self.settings(YETI_QUERY_POOL_SIZE=2, YETI_QUERY_POOL_MIN_CONTENT_BLOCKS=1):
+            matches = list(IndexedStixXml111QueryHandler.evaluate_content(criteria, self.content_blocks))
+            self.assertTrue(get_query_pool() is None)
+        self.assertEqual(len(matches), 6)
+
+
+class ContentTreeCacheTests(TestCase):
+    """
+    Tests yeti.content_cache.ContentTreeCache
+    """
+
+    def setUp(self):
+        content_tree_cache.clear()
+        self.content_blocks = add_content_blocks('default', 3)
+
+    def tearDown(self):
+        content_tree_cache.clear()
+
+    def test_01(self):
+        """
+        Saved content is cached, and parsed again only if it changes
+        """
+        cb = self.content_blocks[0]
+        self.assertTrue(cb.pk in content_tree_cache)
+        tree = content_tree_cache.get(cb.pk, cb.content)
+        self.assertTrue(content_tree_cache.get(cb.pk, models.ContentBlock.objects.get(pk=cb.pk).content) is tree)
+
+        changed = cb.content.replace('Example watchlist', 'Changed watchlist')
+        self.assertFalse(content_tree_cache.get(cb.pk, changed) is tree)
+        self.assertTrue(content_tree_cache.get(cb.pk, changed) is content_tree_cache.get(cb.pk, changed))
+
+    def test_02(self):
+        """
+        Editing or deleting a content block drops its tree
+        """
+        first, second = self.content_blocks[:2]
+        tree = content_tree_cache.get(first.pk, first.content)
+        first.save()
+        self.assertFalse(content_tree_cache.get(first.pk, first.content) is tree)
+        second.delete()
+        self.assertFalse(second.pk in content_tree_cache)
+
+    def test_03(self):
+        """
+        The cache holds at most YETI_CONTENT_TREE_CACHE_SIZE bytes of content, dropping the least recently used first
+        """
+        content_tree_cache.clear()
+        a, b, c = self.content_blocks
+        with self.settings(YETI_CONTENT_TREE_CACHE_SIZE=len(a.content) * 2):
+            content_tree_cache.get(a.pk, a.content)
+            content_tree_cache.get(b.pk, b.content)
+            content_tree_cache.get(a.pk, a.content)
+            content_tree_cache.get(c.pk, c.content)
+        self.assertEqual(sorted([a.pk, c.pk]), sorted(pk for pk in (a.pk, b.pk, c.pk) if pk in content_tree_cache))
+        self.assertEqual(len(content_tree_cache), 2)
+
+    def test_04(self):
+        """
+        A tree is only returned to the thread that parsed it, and editing its content block drops it in every thread
+        """
+        cb = self.content_blocks[0]
+        tree = content_tree_cache.get(cb.pk, cb.content)
+        cached = len(content_tree_cache)
+        trees = []
+        thread = threading.Thread(target=lambda: trees.extend([content_tree_cache.get(cb.pk, cb.content),
+                                                               content_tree_cache.get(cb.pk, cb.content)]))
+        thread.start()
+        thread.join()
+        self.assertFalse(trees[0] is tree)
+        self.assertTrue(trees[1] is trees[0])
+        self.assertEqual(len(content_tree_cache), cached + 1)
+
+        content_tree_cache.invalidate(cb.pk)
+        self.assertEqual(len(content_tree_cache), cached - 1)
+
+
+class StandInInboxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    A TAXII Inbox Service that records the Inbox Messages pushed to a StandInInbox
+    """
+
+    protocol_version = 'HTTP/1.1'  # Keeps connections open
+
+    def do_POST(self):
+        inbox = self.server
+        with inbox.lock:
+            inbox.active += 1
+            inbox.max_active = max(inbox.max_active, inbox.active)
+            status_type = inbox.status_types.pop(0) if inbox.status_types else ST_SUCCESS
+            unanswered, inbox.unanswered = inbox.unanswered > 0, max(inbox.unanswered - 1, 0)
+        time.sleep(inbox.delay)
+
+        taxii_content_type = self.headers['X-TAXII-Content-Type']
+        message = parse_message(self.rfile.read(int(self.headers['Content-Length'])), taxii_content_type)
+        with inbox.lock:
+            inbox.active -= 1
+            inbox.messages.append(message)
+            inbox.connections.add(self.client_address)
+        if unanswered:  # Closes the connection without responding
+            self.close_connection = 1
+            return
+
+        taxii_module = tm10 if taxii_content_type == VID_TAXII_XML_10 else tm11
+        body = taxii_module.StatusMessage(generate_message_id(), message.message_id, status_type=status_type).to_xml()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-TAXII-Content-Type', taxii_content_type)
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = int(inbox.close_connections)  # Without telling the client
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInInbox(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local TAXII Inbox Service for push delivery tests. Responds to the
+    Inbox Messages it receives with the Status Types in status_types, then
+    with Success. The next unanswered messages are received but not responded to.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInInboxHandler)
+        self.address = 'http://127.0.0.1:%s/services/inbox/' % self.server_address[1]
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.status_types = []
+        self.unanswered = 0
+        self.close_connections = False  # Close each connection after responding
+        self.messages = []
+        self.connections = set()  # Client (host, port)s
+        self.active = 0
+        self.max_active = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class PushDeliveryTests(TestCase):
+    """
+    Tests yeti.push against a StandInInbox
+    """
+
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.inbox = StandInInbox()
+        self.deliverer = PushDeliverer(workers=4)
+        use_subscription_handler('yeti.subscription_handlers.PushSubscriptionRequestHandler')
+
+    def tearDown(self):
+        self.deliverer.close()
+        self.inbox.stop()
+
+    def test_01(self):
+        """
+        Content added after subscribing is pushed in batches, over one kept-alive connection
+        """
+        add_content_blocks('default', 2)
+        subscription_id = subscribe(self.inbox.address).subscription_instances[0].subscription_id
+        content_blocks = add_content_blocks('default', 5)
+
+        with self.settings(YETI_PUSH_BATCH_SIZE=2, YETI_PUSH_MAX_CONNECTIONS_PER_DESTINATION=1):
+            self.assertEqual(push.fan_out(), 3)
+            self.assertEqual(push.fan_out(), 0)
+            self.assertEqual(self.deliverer.deliver(), 3)
+
+        self.assertEqual(len(self.inbox.messages), 3)
+        self.assertEqual(len(self.inbox.connections), 1)
+        messages = sorted(self.inbox.messages, key=lambda m: m.subscription_information.inclusive_end_timestamp_label)
+        self.assertEqual([len(m.content_blocks) for m in messages], [2, 2, 1])
+        self.assertEqual(messages[0].subscription_information.subscription_id, subscription_id)
+        self.assertEqual(messages[1].subscription_information.exclusive_begin_timestamp_label,
+                         messages[0].subscription_information.inclusive_end_timestamp_label)
+        self.assertEqual(messages[2].subscription_information.inclusive_end_timestamp_label,
+                         content_blocks[-1].timestamp_label)
+        self.assertEqual(push.get_stats(), {'depth': 0, 'lag': 0, 'failed': 0})
+
+    def test_02(self):
+        """
+        Failed deliveries stay queued and are retried with backoff, then marked failed
+        """
+        subscribe(self.inbox.address, binding=VID_TAXII_XML_10)
+        add_content_blocks('default', 1)
+        push.fan_out()
+        self.inbox.status_types = [ST_FAILURE, ST_FAILURE]
+
+        with self.settings(YETI_PUSH_RETRY_DELAY=60, YETI_PUSH_MAX_ATTEMPTS=3):
+            self.assertEqual(self.deliverer.deliver(), 1)
+            delivery = PushDelivery.objects.get()
+            self.assertEqual(delivery.attempts, 1)
+            self.assertTrue(delivery.next_attempt > datetime.now(tzutc()) + timedelta(seconds=50))
+            self.assertEqual(self.deliverer.deliver(), 0)
+
+            PushDelivery.objects.update(next_attempt=datetime.now(tzutc()))
+            self.deliverer.deliver()
+            delivery = PushDelivery.objects.get()
+            self.assertEqual(delivery.attempts, 2)
+            self.assertTrue(delivery.next_attempt > datetime.now(tzutc()) + timedelta(seconds=110))
+
+            PushDelivery.objects.update(next_attempt=datetime.now(tzutc()))
+            self.deliverer.deliver()
+        self.assertEqual(PushDelivery.objects.count(), 0)
+        self.assertEqual(len(self.inbox.messages), 3)
+        self.assertTrue(isinstance(self.inbox.messages[-1], tm10.InboxMessage))
+
+        self.inbox.stop()  # Nothing is listening any more
+        self.deliverer.connections.close()
+        add_content_blocks('default', 1)
+        push.fan_out()
+        with self.settings(YETI_PUSH_MAX_ATTEMPTS=1):
+            self.deliverer.deliver()
+        self.assertEqual(push.get_stats()['failed'], 1)
+        self.assertTrue('Could not reach' in PushDelivery.objects.get().error)
+        self.inbox = StandInInbox()
+
+    def test_03(self):
+        """
+        No more than YETI_PUSH_MAX_CONNECTIONS_PER_DESTINATION messages are sent to one Inbox Service at once
+        """
+        self.inbox.delay = 0.05
+        subscribe(self.inbox.address)
+        add_content_blocks('default', 8)
+        with self.settings(YETI_PUSH_BATCH_SIZE=1, YETI_PUSH_MAX_CONNECTIONS_PER_DESTINATION=2):
+            deliverer = PushDeliverer(workers=8)
+            try:
+                push.fan_out()
+                self.assertEqual(deliverer.deliver(), 8)
+            finally:
+                deliverer.close()
+        self.assertEqual(len(self.inbox.messages), 8)
+        self.assertEqual(self.inbox.max_active, 2)
+        self.assertEqual(len(self.inbox.connections), 2)
+
+    def test_04(self):
+        """
+        Paused subscriptions are not pushed to until they are resumed, and unsubscribing drops queued deliveries
+        """
+        subscription_id = subscribe(self.inbox.address).subscription_instances[0].subscription_id
+        add_content_blocks('default', 1)
+        models.Subscription.objects.filter(subscription_id=subscription_id).update(status=SS_PAUSED)
+        self.assertEqual(push.fan_out(), 0)
+
+        models.Subscription.objects.filter(subscription_id=subscription_id).update(status=SS_ACTIVE)
+        self.assertEqual(push.fan_out(), 1)
+        models.Subscription.objects.filter(subscription_id=subscription_id).update(status=SS_PAUSED)
+        self.assertEqual(self.deliverer.deliver(), 0)
+
+        models.Subscription.objects.filter(subscription_id=subscription_id).update(status=SS_UNSUBSCRIBED)
+        push.fan_out()
+        self.assertEqual(PushDelivery.objects.count(), 0)
+        self.assertEqual(self.inbox.messages, [])
+
+    def test_05(self):
+        """
+        An idle connection the Inbox Service closed is replaced, but a message whose response is lost is not sent again
+        """
+        pool = push.ConnectionPool()
+        body = tm11.InboxMessage(generate_message_id()).to_xml()
+        headers = {'Content-Type': 'application/xml', 'X-TAXII-Content-Type': VID_TAXII_XML_11}
+        try:
+            self.inbox.close_connections = True
+            self.assertEqual(pool.post(VID_TAXII_HTTP_10, self.inbox.address, body, headers)[0], 200)
+            time.sleep(0.1)  # For the connection to be closed
+            self.inbox.close_connections = False
+            self.assertEqual(pool.post(VID_TAXII_HTTP_10, self.inbox.address, body, headers)[0], 200)
+            self.assertEqual(len(self.inbox.connections), 2)
+
+            self.inbox.unanswered = 1
+            self.assertRaises((httplib.HTTPException, socket.error),
+                              pool.post, VID_TAXII_HTTP_10, self.inbox.address, body, headers)
+            self.assertEqual(len(self.inbox.messages), 3)
+        finally:
+            pool.close()
+
+
+class SubscriptionMatchingTests(TestCase):
+    """
+    Tests yeti.matching
+    """
+
+    fixtures = ['test_data.json']
+    inbox_address = 'http://127.0.0.1:9/services/inbox/'
+    path = '/services/test_matching_inbox/'
+
+    def setUp(self):
+        use_subscription_handler('yeti.subscription_handlers.PushSubscriptionRequestHandler')
+        create_inbox_service(self.path, 'yeti.inbox_handlers.BulkInboxMessageHandler')
+
+    def subscribe(self, content_bindings=None, criteria=None):
+        """
+        Returns the PushSubscription of a new subscription
+        """
+        query = tdq.DefaultQuery(CB_STIX_XML_111, criteria) if criteria is not None else None
+        response = subscribe(self.inbox_address, content_bindings=content_bindings, query=query)
+        return PushSubscription.objects.get(subscription__subscription_id=response.subscription_instances[0].subscription_id)
+
+    def queued(self, push_subscription):
+        return sorted(QueuedContent.objects.filter(push_subscription=push_subscription)
+                                           .values_list('content_block', flat=True))
+
+    def test_01(self):
+        """
+        Content added through the bulk inbox handler, or to the Data Collection, is queued for the subscriptions it matches
+        """
+        unit_61398 = tdq.Criteria(OP_AND, criterion=[IndexedQueryTests.criterion(
+            IndexedQueryTests.subdivision, R_EQUALS, 'Unit 61398', **{P_MATCH_TYPE: 'case_sensitive_string'})])
+        everything = self.subscribe()
+        stix_111 = self.subscribe(content_bindings=[tm11.ContentBinding(CB_STIX_XML_111)])
+        stix_11 = self.subscribe(content_bindings=[tm11.ContentBinding(CB_STIX_XML_11)])
+        queried = self.subscribe(criteria=unit_61398)
+
+        im = tm11.InboxMessage(message_id=generate_message_id(), destination_collection_names=['default'])
+        for values in IndexedQueryTests.threat_actors:
+            im.content_blocks.append(tm11.ContentBlock(tm11.ContentBinding(CB_STIX_XML_111),
+                                                       stix_threat_actor_111 % values))
+        make_request(self.path, im.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_STATUS_MESSAGE, ST_SUCCESS)
+        received = sorted(models.ContentBlock.objects.values_list('pk', flat=True))
+        added = [cb.pk for cb in add_content_blocks('default', 1, content=stix_threat_actor_111 % ('5', 'x', 'Unit 61398'))]
+
+        self.assertEqual(self.queued(everything), received + added)
+        self.assertEqual(self.queued(stix_111), received + added)
+        self.assertEqual(self.queued(stix_11), [])
+        self.assertEqual(self.queued(queried), [received[0], received[3]] + added)
+
+    def test_02(self):
+        """
+        Each content block is tested once against a query shared by several subscriptions
+        """
+        criteria = IndexedQueryTests.queries()[0]
+        first, second = self.subscribe(criteria=criteria), self.subscribe(criteria=criteria)
+        content_blocks = add_content_blocks('default', 3, content=stix_threat_actor_111 % ('1', 'APT1', 'Unit 61398'))
+        memberships = list(CollectionMembership.objects.filter(content_block__in=content_blocks))
+
+        evaluated = []
+        class CountingMatcher(SubscriptionMatcher):
+            def evaluate_query(self, query_key, content_block_id, content):
+                evaluated.append(content_block_id)
+                return SubscriptionMatcher.evaluate_query(self, query_key, content_block_id, content)
+
+        matcher = CountingMatcher(PushSubscription.objects.all())
+        queued = matcher.match(memberships)
+        self.assertEqual(sorted(evaluated), sorted(cb.pk for cb in content_blocks))
+        self.assertEqual(sorted((q.push_subscription_id, q.content_block_id) for q in queued),
+                         sorted((ps.pk, cb.pk) for ps in (first, second) for cb in content_blocks))
+
+    def test_03(self):
+        """
+        The matcher is built again only when push subscriptions change
+        """
+        self.assertFalse(get_subscription_matcher())
+        push_subscription = self.subscribe()
+        matcher = get_subscription_matcher()
+        self.assertTrue(matcher)
+        with self.assertNumQueries(1):
+            self.assertTrue(get_subscription_matcher() is matcher)
+
+        push_subscription.subscription.status = SS_UNSUBSCRIBED
+        push_subscription.subscription.save()
+        self.assertFalse(get_subscription_matcher())
+        add_content_blocks('default', 1)
+        self.assertEqual(QueuedContent.objects.count(), 0)
+
+    def test_04(self):
+        """
+        Queries YETI cannot evaluate are refused, and accepted queries are returned in Subscription Instances
+        """
+        criteria = IndexedQueryTests.queries()[0]
+        subscribe(self.inbox_address, query=tdq.DefaultQuery(CB_STIX_XML_11, criteria),
+                  response_msg_type=MSG_STATUS_MESSAGE, st=ST_UNSUPPORTED_QUERY)
+        push_subscription = self.subscribe(criteria=criteria)
+
+        request = tm11.ManageCollectionSubscriptionRequest(message_id=generate_message_id(), collection_name='default',
+                                                           action=ACT_STATUS,
+                                                           subscription_id=push_subscription.subscription.subscription_id)
+        response = make_request(COLLECTION_MGMT_11_PATH, request.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                                MSG_MANAGE_COLLECTION_SUBSCRIPTION_RESPONSE)
+        query = response.subscription_instances[0].subscription_parameters.query
+        self.assertEqual(normalize_criteria(query.criteria), normalize_criteria(criteria))
+
+
+class ContentStoreTests(TestCase):
+    """
+    Tests yeti.content_store and the content store functions of yeti.models
+    """
+
+    fixtures = ['test_data.json']
+    path = '/services/test_content_store_poll/'
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store_settings = self.settings(YETI_CONTENT_STORE=content_store.STORE_DATABASE,
+                                            YETI_CONTENT_STORE_PATH=self.store_dir)
+        self.store_settings.enable()
+
+    def tearDown(self):
+        self.store_settings.disable()
+        shutil.rmtree(self.store_dir)
+
+    def test_01(self):
+        """
+        Identical content is stored once, compressed, and polled in full
+        """
+        create_poll_service(self.path, 'yeti.poll_handlers.IndexedPollRequestHandler')
+        content_blocks = add_content_blocks('default', 3)
+
+        blob = ContentBlob.objects.get()
+        self.assertEqual(blob.reference_count, 3)
+        self.assertEqual(blob.compression, content_store.COMPRESSION_ZLIB)
+        self.assertTrue(blob.stored_size < blob.size)
+        self.assertEqual(set(models.ContentBlock.objects.values_list('content', flat=True)), set(['']))
+        self.assertEqual(get_contents([cb.pk for cb in content_blocks]),
+                         dict((cb.pk, stix_watchlist_111) for cb in content_blocks))
+
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 3)
+        for cb in msg.content_blocks:
+            self.assertTrue('malicious1' in cb.content)
+
+    def test_02(self):
+        """
+        The file store keeps one file per payload, deleted once no content block references it
+        """
+        with self.settings(YETI_CONTENT_STORE=content_store.STORE_FILE):
+            first, second = add_content_blocks('default', 2)
+        blob = ContentBlob.objects.get()
+        self.assertTrue(blob.in_file_store)
+        self.assertEqual(bytes(blob.data), '')
+        path = content_store.get_file_store().get_path(blob.digest)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(get_contents([first.pk])[first.pk], stix_watchlist_111)
+
+        first.delete()
+        self.assertEqual(ContentBlob.objects.get().reference_count, 1)
+        self.assertEqual(delete_unreferenced_blobs(), 0)
+        second.delete()
+        self.assertEqual(delete_unreferenced_blobs(), 1)
+        self.assertFalse(ContentBlob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_03(self):
+        """
+        Saving a content block again keeps its content and query index, and changed content moves to a new blob
+        """
+        content_block, = add_content_blocks('default', 1, content=stix_threat_actor_111 % IndexedQueryTests.threat_actors[0])
+        fields = ContentField.objects.filter(content_block=content_block).count()
+        self.assertTrue(fields > 0)
+
+        content_block = models.ContentBlock.objects.get(pk=content_block.pk)
+        self.assertEqual(content_block.content, '')
+        content_block.message = 'Edited'
+        content_block.save()
+        self.assertEqual(ContentField.objects.filter(content_block=content_block).count(), fields)
+        self.assertEqual(ContentBlob.objects.get().reference_count, 1)
+
+        content_block.content = stix_threat_actor_111 % IndexedQueryTests.threat_actors[1]
+        content_block.save()
+        self.assertEqual(sorted(ContentBlob.objects.values_list('reference_count', flat=True)), [0, 1])
+        self.assertEqual(get_contents([content_block.pk])[content_block.pk],
+                         stix_threat_actor_111 % IndexedQueryTests.threat_actors[1])
+
+    def test_04(self):
+        """
+        The build_content_store command moves existing content into the store, and stored
+        content added to a Data Collection is matched against push subscription queries
+        """
+        with self.settings(YETI_CONTENT_STORE=None):
+            for values in IndexedQueryTests.threat_actors:
+                add_content_blocks('default', 1, content=stix_threat_actor_111 % values)
+        call_command('build_content_store', stdout=StringIO())
+        self.assertEqual(StoredContent.objects.count(), 4)
+        self.assertFalse(models.ContentBlock.objects.exclude(content='').exists())
+
+        use_subscription_handler('yeti.subscription_handlers.PushSubscriptionRequestHandler')
+        criteria = tdq.Criteria(OP_AND, criterion=[IndexedQueryTests.criterion(
+            IndexedQueryTests.subdivision, R_EQUALS, 'Unit 61398', **{P_MATCH_TYPE: 'case_sensitive_string'})])
+        subscribe('http://127.0.0.1:9/services/inbox/', query=tdq.DefaultQuery(CB_STIX_XML_111, criteria))
+        collection = models.DataCollection.objects.get(name='default')
+        collection.content_blocks.clear()
+        collection.content_blocks.add(*models.ContentBlock.objects.all())
+        content_blocks = list(models.ContentBlock.objects.order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(sorted(QueuedContent.objects.values_list('content_block', flat=True)),
+                         [content_blocks[0], content_blocks[3]])
+
+    def test_05(self):
+        """
+        Content serialized in the file store is spliced into Poll Responses as it is
+        """
+        create_poll_service(self.path, 'yeti.poll_handlers.IndexedPollRequestHandler')
+        text = u'Not XML: 1 < 2 & caf\xe9'
+        with self.settings(YETI_CONTENT_STORE=content_store.STORE_FILE, YETI_CONTENT_STORE_SERIALIZED=True):
+            add_content_blocks('default', 2)
+            add_content_blocks('default', 1, content=text)
+        self.assertEqual(ContentBlob.objects.filter(serialized=True).count(), 2)
+
+        def poll():
+            pr = tm11.PollRequest(message_id=generate_message_id(),
+                                  collection_name='default',
+                                  poll_parameters=tm11.PollParameters())
+            msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+            return [cb.content for cb in msg.content_blocks]
+
+        spliced = poll()
+        self.assertEqual(spliced[2], text)
+        ContentBlob.objects.update(serialized=False)
+        self.assertEqual(spliced, poll())
+
+        ContentBlob.objects.update(serialized=True)
+        digest = content_store.get_digest(text.encode('utf-8'))
+        with open(content_store.get_file_store().get_serialized_path(digest), 'wb') as f:
+            f.write('Spliced')
+        self.assertEqual(poll()[2], 'Spliced')
+
+        os.remove(content_store.get_file_store().get_serialized_path(digest))
+        self.assertEqual(poll(), spliced)
+
+    def test_06(self):
+        """
+        A blob referenced again before it is collected is kept, and one referenced after is created again
+        """
+        with self.settings(YETI_CONTENT_STORE=content_store.STORE_FILE):
+            first, = add_content_blocks('default', 1)
+            digest = ContentBlob.objects.get().digest
+            path = content_store.get_file_store().get_path(digest)
+            first.delete()
+            second, = add_content_blocks('default', 1)
+            self.assertEqual(ContentBlob.objects.get().reference_count, 1)
+            self.assertEqual(delete_unreferenced_blobs(), 0)
+            self.assertTrue(os.path.exists(path))
+
+            second.delete()
+            self.assertEqual(delete_unreferenced_blobs(), 1)
+            third, = add_content_blocks('default', 1)
+        self.assertEqual(ContentBlob.objects.get(digest=digest).reference_count, 1)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(get_contents([third.pk])[third.pk], stix_watchlist_111)
+
+
+class MetricsTests(TestCase):
+    """
+    Tests yeti.metrics and the /metrics endpoint
+    """
+
+    path = '/services/test_metrics_poll/'
+
+    def setUp(self):
+        metrics.registry.clear()
+        self.poll_service = create_poll_service(self.path, 'yeti.poll_handlers.StreamingPollRequestHandler')
+        add_content_blocks('default', 3)
+
+    def test_01(self):
+        """
+        Histograms are rendered with cumulative buckets, a sum and a count
+        """
+        histogram = metrics.Histogram('test_seconds', 'Test', ('path',), (1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(('/a"b/',), value)
+        registry = metrics.MetricsRegistry()
+        registry.add(histogram)
+        self.assertEqual(registry.render().splitlines()[2:],
+                         ['test_seconds_bucket{path="/a\\"b/",le="1"} 2',
+                          'test_seconds_bucket{path="/a\\"b/",le="5"} 3',
+                          'test_seconds_bucket{path="/a\\"b/",le="+Inf"} 4',
+                          'test_seconds_sum{path="/a\\"b/"} 14.5',
+                          'test_seconds_count{path="/a\\"b/"} 4'])
+
+    def test_02(self):
+        """
+        A streamed Poll Response is recorded by service path and message type once it has been written
+        """
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              poll_parameters=tm11.PollParameters())
+        with self.settings(YETI_METRICS_DB_QUERIES=True):
+            resp = Client().post(self.path, data=pr.to_xml(), content_type='application/xml',
+                                 **get_headers(VID_TAXII_SERVICES_11, False))
+        labels = (self.path, MSG_POLL_REQUEST)
+        self.assertEqual(metrics.requests_total.get(labels + (metrics.SUCCESS,)), 0)
+        body = ''.join(resp.streaming_content)
+
+        self.assertEqual(metrics.requests_total.get(labels + (metrics.SUCCESS,)), 1)
+        for histogram in (metrics.parse_seconds, metrics.handler_seconds, metrics.serialize_seconds,
+                          metrics.db_queries, metrics.response_bytes, metrics.content_blocks):
+            self.assertEqual(histogram.get_count(labels), 1)
+        self.assertEqual(metrics.response_bytes.get_sum(labels), len(body))
+        self.assertEqual(metrics.content_blocks.get_sum(labels), 3)
+        self.assertGreater(metrics.db_queries.get_sum(labels), 0)
+
+        resp = Client().get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('yeti_taxii_requests_total{path="%s",message_type="%s",outcome="success"} 1' % labels,
+                      resp.content)
+        self.assertIn('yeti_push_deliveries{stat="depth"} 0', resp.content)
+
+    def test_03(self):
+        """
+        Requests answered with a Status Message are counted by their outcome
+        """
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='no_such_collection',
+                              poll_parameters=tm11.PollParameters())
+        make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_STATUS_MESSAGE,
+                     st=ST_NOT_FOUND)
+        labels = (self.path, MSG_POLL_REQUEST)
+        self.assertEqual(metrics.requests_total.get(labels + (metrics.STATUS_MESSAGE,)), 1)
+        self.assertEqual(metrics.handler_seconds.get_count(labels), 1)
+        self.assertEqual(metrics.response_bytes.get_count(labels), 0)
+
+    def test_04(self):
+        """
+        With YETI_METRICS off, nothing is recorded and /metrics is not found
+        """
+        with self.settings(YETI_METRICS=False):
+            pr = tm11.PollRequest(message_id=generate_message_id(),
+                                  collection_name='default',
+                                  poll_parameters=tm11.PollParameters())
+            make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+            self.assertEqual(Client().get('/metrics').status_code, 404)
+        self.assertEqual(metrics.requests_total.get((self.path, MSG_POLL_REQUEST, metrics.SUCCESS)), 0)
+
+    def test_05(self):
+        """
+        Database queries are counted per request without keeping their SQL, and only if YETI_METRICS_DB_QUERIES is set
+        """
+        db_connection = connections['default']
+        queries = len(db_connection.queries)
+        labels = (self.path, MSG_POLL_REQUEST)
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='no_such_collection',
+                              poll_parameters=tm11.PollParameters())
+        make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_STATUS_MESSAGE,
+                     st=ST_NOT_FOUND)
+        self.assertEqual(metrics.db_queries.get_count(labels), 0)
+
+        with self.settings(YETI_METRICS_DB_QUERIES=True):
+            make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_STATUS_MESSAGE,
+                         st=ST_NOT_FOUND)
+            counted = metrics.db_queries.get_sum(labels)
+            self.assertGreater(counted, 0)
+            self.assertEqual(metrics.db_seconds.get_count(labels), 1)
+            models.DataCollection.objects.count()  # Not made by a request
+        self.assertEqual(metrics.db_queries.get_sum(labels), counted)
+        self.assertFalse(db_connection.use_debug_cursor)
+        self.assertEqual(len(db_connection.queries), queries)
+
+
+class CollectionCountTests(TestCase):
+    """
+    Tests yeti.models.CollectionCount and the count-only fast path of
+    yeti.poll_handlers.IndexedPollRequestHandler
+    """
+
+    path = '/services/test_counted_poll/'
+
+    def setUp(self):
+        self.collection = models.DataCollection.objects.get(name='default')
+        self.content_blocks = add_content_blocks('default', 8)
+        self.start = datetime(2015, 3, 1, 10, 30, tzinfo=tzutc())
+        for i, cb in enumerate(self.content_blocks):  # Spread over four hourly buckets
+            cb.timestamp_label = self.start + timedelta(minutes=25 * i)
+            cb.save()
+
+    def assertCountsMatchIndex(self):
+        counts = CollectionCount.objects.filter(collection=self.collection)
+        self.assertEqual(sum(counts.values_list('count', flat=True)),
+                         CollectionMembership.objects.filter(collection=self.collection).count())
+
+    def test_01(self):
+        """
+        Counts follow content being added, relabelled, removed and deleted, and can be rebuilt
+        """
+        self.assertEqual(sorted(CollectionCount.objects.filter(count__gt=0).values_list('bucket_start', 'count')),
+                         [(self.start.replace(minute=0) + timedelta(hours=h), 2) for h in range(4)])
+        self.collection.content_blocks.remove(self.content_blocks[0])
+        self.content_blocks[1].datacollection_set.clear()
+        self.content_blocks[2].delete()
+        self.assertCountsMatchIndex()
+        self.assertEqual(count_collection_content(self.collection), 5)
+
+        CollectionCount.objects.all().delete()
+        call_command('build_poll_index', stdout=StringIO())
+        self.assertCountsMatchIndex()
+        self.collection.content_blocks.clear()
+        self.assertFalse(CollectionCount.objects.exists())
+
+    def test_02(self):
+        """
+        Timestamp ranges are counted from whole buckets and the index rows at either end
+        """
+        labels = [cb.timestamp_label for cb in self.content_blocks]
+        bounds = [None, self.start - timedelta(hours=1), self.start.replace(minute=0)] + labels
+        for begin in bounds:
+            for end in bounds:
+                expected = CollectionMembership.objects.filter(collection=self.collection)
+                if begin is not None:
+                    expected = expected.filter(timestamp_label__gt=begin)
+                if end is not None:
+                    expected = expected.filter(timestamp_label__lte=end)
+                self.assertEqual(count_collection_content(self.collection, None, begin, end), expected.count())
+        with self.assertNumQueries(3):
+            count_collection_content(self.collection, None, labels[0], labels[-1])
+
+    def test_03(self):
+        """
+        Count Only Poll Requests and max_result_size checks use the counts
+        """
+        create_poll_service(self.path, 'yeti.poll_handlers.IndexedPollRequestHandler', max_result_size=3)
+        pr = tm11.PollRequest(message_id=generate_message_id(),
+                              collection_name='default',
+                              exclusive_begin_timestamp_label=self.content_blocks[1].timestamp_label,
+                              poll_parameters=tm11.PollParameters(response_type=RT_COUNT_ONLY))
+        msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+        self.assertEqual(msg.record_count.record_count, 6)
+        self.assertEqual(len(msg.content_blocks), 0)
+
+        pr.message_id = generate_message_id()
+        pr.poll_parameters.response_type = RT_FULL
+        msg = make_request(self.path, pr.to_xml(), get_headers(VID_TAXII_SERVICES_11, False), MSG_POLL_RESPONSE)
+        self.assertEqual(msg.record_count.record_count, 6)
+        self.assertEqual(len(msg.content_blocks), 3)
+        self.assertTrue(msg.more)
+
+
+class RetentionTests(TestCase):
+    """
+    Tests dropping months of Data Collection content with the prune_collections command
+    """
+
+    def test_01(self):
+        """
+        Retention cutoffs are month starts, counting the current month
+        """
+        now = datetime(2015, 1, 20, 3, 4, 5, tzinfo=tzutc())
+        self.assertEqual(get_retention_cutoff(1, now), datetime(2015, 1, 1, tzinfo=tzutc()))
+        self.assertEqual(get_retention_cutoff(13, now), datetime(2014, 1, 1, tzinfo=tzutc()))
+        self.assertEqual(add_months(datetime(2014, 11, 1, tzinfo=tzutc()), 2), datetime(2015, 1, 1, tzinfo=tzutc()))
+        self.assertRaises(ImproperlyConfigured, get_retention_cutoff, 0, now)
+
+    def test_02(self):
+        """
+        Months older than the retention are dropped; content still in another Data Collection is kept
+        """
+        collection = models.DataCollection.objects.get(name='default')
+        other = models.DataCollection.objects.create(name='other', type=CT_DATA_FEED)
+        content_blocks = add_content_blocks('default', 6)
+        cutoff = get_retention_cutoff(2)
+        for i, cb in enumerate(content_blocks):  # Two in each of the two months before the cutoff
+            cb.timestamp_label = add_months(cutoff, i // 2 - 2) + timedelta(days=i % 2)
+            cb.save()
+        other.content_blocks.add(content_blocks[0])
+
+        with self.settings(YETI_COLLECTION_RETENTION_MONTHS={'default': 2}):
+            out = StringIO()
+            call_command('prune_collections', batch_size=1, stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'default: dropped 2 months, 4 content blocks')
+        self.assertEqual(sorted(collection.content_blocks.values_list('pk', flat=True)),
+                         [cb.pk for cb in content_blocks[4:]])
+        self.assertEqual(CollectionMembership.objects.filter(collection=collection).count(), 2)
+        self.assertEqual(count_collection_content(collection), 2)
+        self.assertEqual(sorted(models.ContentBlock.objects.values_list('pk', flat=True)),
+                         [content_blocks[0].pk] + [cb.pk for cb in content_blocks[4:]])
+        self.assertEqual(count_collection_content(other), 1)
+
+    def test_03(self):
+        """
+        The counts match the content left after every batch, even if pruning stops part way through a month
+        """
+        collection = models.DataCollection.objects.get(name='default')
+        content_blocks = add_content_blocks('default', 3)
+        month_start = add_months(get_retention_cutoff(1), -1)
+        for cb in content_blocks:
+            cb.timestamp_label = month_start + timedelta(days=1)
+            cb.save()
+
+        batches = []
+
+        def interrupt(sender, **kwargs):
+            batches.append(kwargs['instance'].pk)
+            if len(batches) > 1:
+                raise RuntimeError('Interrupted')
+
+        pre_delete.connect(interrupt, sender=CollectionMembership)
+        try:
+            self.assertRaises(RuntimeError, prune_collection_month, collection, month_start, 1)
+        finally:
+            pre_delete.disconnect(interrupt, sender=CollectionMembership)
+        self.assertEqual(collection.content_blocks.count(), 2)
+        self.assertEqual(count_collection_content(collection), 2)
+
+        self.assertEqual(prune_collection_month(collection, month_start, 1), 2)
+        self.assertEqual(count_collection_content(collection), 0)
+        self.assertFalse(CollectionCount.objects.filter(collection=collection, bucket_start__gte=month_start,
+                                                        bucket_start__lt=add_months(month_start, 1)).exists())
+
+
+class StandInRespHandler(SocketServer.StreamRequestHandler):
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for i in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write_reply(self, reply):
+        if reply is None:
+            self.wfile.write('$-1\r\n')
+        elif isinstance(reply, bool):
+            self.wfile.write('+OK\r\n')
+        elif isinstance(reply, int):
+            self.wfile.write(':%d\r\n' % reply)
+        elif isinstance(reply, list):
+            self.wfile.write('*%d\r\n' % len(reply))
+            for item in reply:
+                self.write_reply(item)
+        else:
+            self.wfile.write('$%d\r\n%s\r\n' % (len(reply), reply))
+
+    def handle(self):
+        self.server.connections.add(self.connection)
+        while True:
+            try:
+                args = self.read_command()
+            except socket.error:
+                args = None
+            if args is None:
+                return
+            with self.server.lock:
+                self.server.commands.append(args[0].upper())
+                reply = getattr(self.server, 'do_' + args[0].upper())(*args[1:])
+                unanswered, self.server.unanswered = self.server.unanswered > 0, max(self.server.unanswered - 1, 0)
+            if unanswered:  # Closes the connection without replying
+                return
+            self.write_reply(reply)
+
+
+class StandInResp(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    A local Redis protocol server for store tests, with the
+    commands yeti.store.RespStore uses.
+    The next unanswered commands are run but not replied to.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), StandInRespHandler)
+        self.url = 'redis://127.0.0.1:%s/1' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.data = {}
+        self.commands = []
+        self.unanswered = 0
+        self.connections = set()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def do_SELECT(self, db):
+        return True
+
+    def do_GET(self, key):
+        return self.data.get(key)
+
+    def do_SET(self, key, value, *options):
+        self.data[key] = value
+        return True
+
+    def do_DEL(self, *keys):
+        return len([self.data.pop(key) for key in keys if key in self.data])
+
+    def do_INCR(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    def do_LPUSH(self, key, value):
+        self.data.setdefault(key, []).insert(0, value)
+        return len(self.data[key])
+
+    def do_RPOPLPUSH(self, source, destination):
+        if not self.data.get(source):
+            return None
+        value = self.data[source].pop()
+        self.data.setdefault(destination, []).insert(0, value)
+        return value
+
+    def do_LREM(self, key, count, value):
+        values = self.data.get(key, [])
+        self.data[key] = [v for v in values if v != value]
+        return len(values) - len(self.data[key])
+
+    def do_LINDEX(self, key, index):
+        values = self.data.get(key, [])
+        return values[int(index)] if values else None
+
+    def do_LLEN(self, key):
+        return len(self.data.get(key, []))
+
+    def do_LRANGE(self, key, start, stop):
+        return list(self.data.get(key, []))
+
+    def do_EVAL(self, script, numkeys, *args):
+        """
+        Runs the Lua scripts of RespStore, in Python
+        """
+        keys, argv = args[:int(numkeys)], args[int(numkeys):]
+        if script == RespStore.MOVE_AND_SET_SCRIPT:
+            value = self.do_RPOPLPUSH(keys[0], keys[1])
+            if value is not None:
+                self.do_SET(argv[0] + value, argv[1])
+            return value
+        elif script == RespStore.SET_AND_PUSH_SCRIPT:
+            for key, value in zip(keys[1:], argv[1:]):
+                self.do_SET(key, value)
+            return self.do_LPUSH(keys[0], argv[0])
+        raise ValueError("Unknown script")
+
+
+class StoreTests(TestCase):
+    """
+    Tests the yeti.store implementations, the inbox spool on a
+    Redis protocol store, and configuration changes seen across processes
+    """
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.resp = StandInResp()
+        self.stores = [FileStore(os.path.join(self.store_dir, 'store.db')), RespStore(self.resp.url)]
+
+    def tearDown(self):
+        self.resp.stop()
+        shutil.rmtree(self.store_dir)
+
+    def test_01(self):
+        """
+        Both stores keep values, counters and FIFO lists the same way
+        """
+        for store in self.stores:
+            self.assertIsNone(store.get('missing'))
+            store.set('key', 'value\r\n\x00')
+            self.assertEqual(store.get('key'), 'value\r\n\x00')
+            self.assertEqual([store.incr('counter'), store.incr('counter')], [1, 2])
+            for value in ('a', 'b', 'c'):
+                store.push('queue', value)
+            self.assertEqual(store.head('queue'), 'a')
+            self.assertEqual(store.move('queue', 'claimed'), 'a')
+            self.assertEqual(store.move('queue', 'claimed'), 'b')
+            self.assertEqual(store.items('claimed'), ['a', 'b'])
+            self.assertEqual(store.remove('claimed', 'a'), 1)
+            self.assertEqual(store.remove('claimed', 'a'), 0)
+            self.assertEqual((store.length('queue'), store.length('claimed')), (1, 1))
+            self.assertIsNone(store.move('empty', 'claimed'))
+            store.delete('key', 'queue')
+            self.assertIsNone(store.get('key'))
+            self.assertEqual(store.length('queue'), 0)
+
+    def test_02(self):
+        """
+        The inbox spool works the same way on a Redis protocol store
+        """
+        create_inbox_service('/services/test_store_inbox/', 'yeti.inbox_handlers.SpooledInboxMessageHandler')
+        with self.settings(YETI_STORE='resp', YETI_STORE_URL=self.resp.url):
+            im = tm11.InboxMessage(message_id=generate_message_id(), destination_collection_names=['default'])
+            im.content_blocks.append(tm11.ContentBlock(tm11.ContentBinding(CB_STIX_XML_111), stix_watchlist_111))
+            make_request('/services/test_store_inbox/', im.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                         MSG_STATUS_MESSAGE, ST_SUCCESS)
+            self.assertEqual(InboxSpool().stats()['depth'], 1)
+            self.assertEqual(spool.drain(10), 1)
+            self.assertEqual(InboxSpool().stats(), {'depth': 0, 'lag': 0, 'failed': 0})
+        self.assertEqual(models.DataCollection.objects.get(name='default').content_blocks.count(), 1)
+        self.assertIn('EVAL', self.resp.commands)
+
+    def test_03(self):
+        """
+        A configuration change saved by one process is seen by the others within YETI_STORE_CHECK_INTERVAL
+        """
+        with self.settings(YETI_STORE='resp', YETI_STORE_URL=self.resp.url, YETI_STORE_CHECK_INTERVAL=0):
+            here, there = SharedGeneration('test'), SharedGeneration('test')
+            self.assertFalse(there.changed())
+            here.bump()
+            self.assertTrue(there.changed())
+            self.assertFalse(there.changed())
+            self.assertFalse(here.changed())
+
+    def test_04(self):
+        """
+        A store that cannot be reached raises StoreError, and does not break configuration caches
+        """
+        self.resp.stop()
+        store = RespStore(self.resp.url, timeout=1)
+        self.assertRaises(StoreError, store.get, 'key')
+        with self.settings(YETI_STORE='resp', YETI_STORE_URL=self.resp.url, YETI_STORE_CHECK_INTERVAL=0):
+            generation = SharedGeneration('test')
+            generation.bump()
+            self.assertFalse(generation.changed())
+        self.resp = StandInResp()  # For tearDown
+
+    def test_05(self):
+        """
+        Both stores move a value and set a key named by it, or set keys and push a value, in one operation
+        """
+        for store in self.stores:
+            store.set_and_push({'record:1': 'record', 'message:1': 'message'}, 'queue', '1')
+            self.assertEqual((store.get('record:1'), store.get('message:1')), ('record', 'message'))
+            self.assertEqual(store.items('queue'), ['1'])
+            self.assertEqual(store.move_and_set('queue', 'claimed', 'claimed-at:', '123.5'), '1')
+            self.assertEqual(store.get('claimed-at:1'), '123.5')
+            self.assertEqual(store.items('claimed'), ['1'])
+            self.assertIsNone(store.move_and_set('queue', 'claimed', 'claimed-at:', '124.5'))
+
+    def test_06(self):
+        """
+        A command is sent again on a new connection if the server closed the idle one, but not once it was sent
+        """
+        store = RespStore(self.resp.url, timeout=1)
+        self.assertEqual(store.incr('counter'), 1)
+        for connection in self.resp.connections:
+            connection.shutdown(socket.SHUT_RDWR)
+        time.sleep(0.1)  # For the connection to be closed
+        self.assertEqual(store.incr('counter'), 2)
+
+        self.resp.unanswered = 1
+        self.assertRaises(StoreError, store.incr, 'counter')
+        self.assertEqual(self.resp.data['counter'], '3')
+        self.assertEqual(store.incr('counter'), 4)
+
+
+class GreenServer(object):
+    """
+    Runs a yeti.green server for application in a thread with its own gevent hub
+    """
+
+    def __init__(self, application=None):
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(application,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.started.wait(10)
+
+    def run(self, application):
+        self.server = green.get_server(('127.0.0.1', 0), application, threads=2)
+        self.stopper = green.gevent.get_hub().loop.async_()
+        self.stopper.start(self.server.stop)
+        self.server.start()
+        self.port = self.server.server_port
+        self.started.set()
+        self.server.serve_forever()
+        self.server.application.pool.kill()
+
+    def request(self, method, path, body=None, headers={}):
+        """
+        Returns the status, headers and body of the response to a request.
+        headers are named as in get_headers().
+        """
+        headers = dict(((name[5:] if name.startswith('HTTP_') else name).replace('_', '-'), value)
+                       for name, value in headers.items())
+        http = httplib.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            http.request(method, path, body, headers)
+            response = http.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            http.close()
+
+    def stop(self):
+        self.stopper.send()
+        self.thread.join(10)
+
+
+@unittest.skipIf(green.gevent is None, "gevent is not installed")
+class GreenTests(TestCase):
+    """
+    Tests yeti.green's gevent front end
+    """
+
+    def test_01(self):
+        """
+        The request body is read, and the response written, in the server's thread. The
+        application runs, and streaming responses are produced, in pool threads.
+        """
+        threads = []
+
+        def application(environ, start_response):
+            threads.append(threading.current_thread())
+            body = environ['wsgi.input'].read()
+
+            class Response(object):
+                streaming = True
+
+                def __iter__(self):
+                    for chunk in (body, 'a' * 40000, 'b' * 40000, 'c'):
+                        threads.append(threading.current_thread())
+                        yield chunk
+
+                def close(self):
+                    threads.append('closed')
+
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return Response()
+
+        with self.settings(YETI_GREEN_CHUNK_SIZE=65536):
+            server = GreenServer(application)
+            try:
+                status, headers, body = server.request('POST', '/', 'request body')
+            finally:
+                server.stop()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, 'request body' + 'a' * 40000 + 'b' * 40000 + 'c')
+        self.assertEqual(threads[-1], 'closed')
+        self.assertEqual(len(threads), 6)
+        self.assertNotIn(server.thread, threads)
+
+    def test_02(self):
+        """
+        Bodies larger than YETI_MAX_MESSAGE_SIZE are not read, and are refused by the service router
+        """
+        server = GreenServer()
+        try:
+            with self.settings(YETI_MAX_MESSAGE_SIZE=100):
+                status, headers, body = server.request('POST', '/services/discovery/', 'x' * 1000,
+                                                       get_headers(VID_TAXII_SERVICES_11, False))
+            status_message = tm11.get_message_from_xml(body)
+            self.assertEqual(status_message.status_type, ST_BAD_MESSAGE)
+            self.assertIn('larger than 100 bytes', status_message.message)
+
+            status, headers, body = server.request('GET', '/services/discovery/')
+            status_message = tm11.get_message_from_xml(body)
+            self.assertEqual(status_message.status_type, ST_BAD_MESSAGE)
+            self.assertIn('not POST', status_message.message)
+        finally:
+            server.stop()
+
+    def test_03(self):
+        """
+        Without gevent, the front end cannot be started
+        """
+        gevent = green.gevent
+        green.gevent = None
+        try:
+            self.assertRaises(ImproperlyConfigured, green.get_server, ('127.0.0.1', 0), lambda e, s: [])
+        finally:
+            green.gevent = gevent
+
+
+def share_connection(function, *args):
+    """
+    Returns a thread that calls function with this thread's (in-memory)
+    test database connection, so it sees the test's data
+    """
+    shared = connections['default']
+    shared.allow_thread_sharing = True
+
+    def run():
+        connections['default'] = shared
+        function(*args)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    return thread
+
+
+class LongPollTests(TestCase):
+    """
+    Tests yeti.poll_handlers.WaitingPollRequestHandler and yeti.notify
+    """
+
+    path = '/services/test_long_poll/'
+    inbox_path = '/services/test_long_poll_inbox/'
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store_settings = self.settings(YETI_STORE='file', YETI_STORE_PATH=os.path.join(self.store_dir, 'store.db'),
+                                            YETI_LONG_POLL_CHECK_INTERVAL=0.05)
+        self.store_settings.enable()
+        content_notifier.clear()
+        create_poll_service(self.path, 'yeti.poll_handlers.WaitingPollRequestHandler')
+        create_inbox_service(self.inbox_path, 'yeti.inbox_handlers.BulkInboxMessageHandler')
+        self.begin = add_content_blocks('default', 2)[-1].timestamp_label
+
+    def tearDown(self):
+        connection.allow_thread_sharing = False
+        self.store_settings.disable()
+        content_notifier.clear()
+        shutil.rmtree(self.store_dir)
+
+    def get_poll_request(self, begin=None):
+        return tm11.PollRequest(message_id=generate_message_id(),
+                                collection_name='default',
+                                exclusive_begin_timestamp_label=begin or self.begin,
+                                poll_parameters=tm11.PollParameters())
+
+    def send_inbox_message(self):
+        im = tm11.InboxMessage(message_id=generate_message_id(), destination_collection_names=['default'])
+        im.content_blocks.append(tm11.ContentBlock(tm11.ContentBinding(CB_STIX_XML_111), stix_watchlist_111))
+        make_request(self.inbox_path, im.to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                     MSG_STATUS_MESSAGE, ST_SUCCESS)
+
+    def test_01(self):
+        """
+        A poll that finds no content waits for YETI_LONG_POLL_TIMEOUT. Waiting, and
+        polling again while the Data Collection is unchanged, costs no queries.
+        """
+        headers = get_headers(VID_TAXII_SERVICES_11, False)
+        with self.settings(YETI_LONG_POLL_TIMEOUT=0):
+            make_request(self.path, self.get_poll_request().to_xml(), headers, MSG_POLL_RESPONSE)  # Loads the registry
+            with CaptureQueriesContext(connection) as one_poll:
+                msg = make_request(self.path, self.get_poll_request().to_xml(), headers, MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 0)
+
+        with self.settings(YETI_LONG_POLL_TIMEOUT=0.3):
+            for i in range(2):
+                start = time.time()
+                with CaptureQueriesContext(connection) as long_poll:
+                    msg = make_request(self.path, self.get_poll_request().to_xml(), headers, MSG_POLL_RESPONSE)
+                self.assertGreaterEqual(time.time() - start, 0.3)
+                self.assertEqual(len(msg.content_blocks), 0)
+                self.assertEqual(len(long_poll), len(one_poll))
+
+            # Polls for content that exists, or within an end label, are answered right away
+            start = time.time()
+            msg = make_request(self.path, self.get_poll_request(datetime(2000, 1, 1, tzinfo=tzutc())).to_xml(),
+                               headers, MSG_POLL_RESPONSE)
+            self.assertEqual(len(msg.content_blocks), 2)
+            pr = self.get_poll_request()
+            pr.inclusive_end_timestamp_label = datetime.now(tzutc())
+            msg = make_request(self.path, pr.to_xml(), headers, MSG_POLL_RESPONSE)
+            self.assertEqual(len(msg.content_blocks), 0)
+            self.assertLess(time.time() - start, 0.3)
+
+    def test_02(self):
+        """
+        A waiting poll is answered as soon as an Inbox Message adds content to the Data Collection
+        """
+        inbox = share_connection(self.send_inbox_message)
+        timer = threading.Timer(0.3, inbox.start)
+        with self.settings(YETI_LONG_POLL_TIMEOUT=10):
+            start = time.time()
+            timer.start()
+            msg = make_request(self.path, self.get_poll_request().to_xml(), get_headers(VID_TAXII_SERVICES_11, False),
+                               MSG_POLL_RESPONSE)
+        inbox.join(10)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(msg.content_blocks), 1)
+        self.assertEqual(content_notifier.peek('default'), '1')
+
+    def test_03(self):
+        """
+        Content published by another process wakes the polls of this one within YETI_LONG_POLL_CHECK_INTERVAL
+        """
+        generation = content_notifier.get_generation('default')
+        other_process = threading.Timer(0.2, lambda: get_store().incr(get_key('content', 'default')))
+        other_process.start()
+        self.assertTrue(content_notifier.wait('default', generation, 5))
+        self.assertFalse(content_notifier.wait('default', content_notifier.peek('default'), 0.1))
+
+    @unittest.skipIf(green.gevent is None, "gevent is not installed")
+    def test_04(self):
+        """
+        Under yeti.green, waiting polls do not hold a thread
+        """
+        dispatcher = ServiceDispatcher()
+        shared = connections['default']
+        shared.allow_thread_sharing = True
+
+        def application(environ, start_response):
+            connections['default'] = shared
+            return dispatcher(environ, start_response)
+
+        def add_content():
+            add_content_blocks('default', 1)
+            content_notifier.publish(['default'])
+
+        server = GreenServer(application)  # With 2 threads
+        responses = []
+        try:
+            headers = get_headers(VID_TAXII_SERVICES_11, False)
+            polls = [threading.Thread(target=lambda: responses.append(
+                         server.request('POST', self.path, self.get_poll_request().to_xml(), headers)))
+                     for i in range(3)]
+            with self.settings(YETI_LONG_POLL_TIMEOUT=10):
+                for poll in polls:
+                    poll.start()
+                time.sleep(0.5)
+                self.assertEqual(responses, [])
+
+                status, response_headers, body = server.request('GET', '/services/discovery/')
+                self.assertEqual(tm11.get_message_from_xml(body).status_type, ST_BAD_MESSAGE)
+
+                share_connection(add_content).start()
+                for poll in polls:
+                    poll.join(10)
+        finally:
+            server.stop()
+
+        self.assertEqual(len(responses), 3)
+        for status, response_headers, body in responses:
+            self.assertEqual(len(tm11.get_message_from_xml(body).content_blocks), 1)
+
+    def test_05(self):
+        """
+        A poll that arrives after content was added without a notice is answered with it right away
+        """
+        headers = get_headers(VID_TAXII_SERVICES_11, False)
+        with self.settings(YETI_LONG_POLL_TIMEOUT=0):
+            msg = make_request(self.path, self.get_poll_request().to_xml(), headers, MSG_POLL_RESPONSE)
+        self.assertEqual(len(msg.content_blocks), 0)
+
+        add_content_blocks('default', 1)  # Through DataCollection.content_blocks, like the built-in Inbox handler
+        with self.settings(YETI_LONG_POLL_TIMEOUT=10):
+            start = time.time()
+            msg = make_request(self.path, self.get_poll_request().to_xml(), headers, MSG_POLL_RESPONSE)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(msg.content_blocks), 1)
+
 if __name__ == "__main__":
     unittest.main()
@@ -15,5 +15,8 @@ urlpatterns = patterns('',
     url(r'^admin/', include(admin.site.urls)),
     #TODO: Can this become a relative so that changes to the code don't require
     #      changes to all services
-    url(r'^services/', include('taxii_services.urls')),
+    # YETI's service router serves everything taxii_services.views.service_router
+    # does, plus the streaming responses in yeti.messages
+    url(r'^services/([\w-]+)/$', 'yeti.views.service_router'),
+    url(r'^metrics$', 'yeti.views.metrics_view'),
 )
@@ -0,0 +1,202 @@
+# Copyright (c) 2015, The MITRE Corporation. All rights reserved.
+# For license information, see the LICENSE.txt file
+
+# YETI's TAXII service router. This follows the workflow of
+# taxii_services.views.service_router, but parses requests with
+# yeti.parsing and also knows how to serve the response message
+# types in yeti.messages.
+
+from taxii_services.exceptions import StatusMessageException
+from taxii_services import handlers
+
+from yeti import metrics
+from yeti.messages import CachedMessage, StreamingMessage
+from yeti.notify import WaitForContent
+from yeti.parsing import FORMATS, parse_request
+from yeti.registry import registry
+
+import libtaxii.messages_11 as tm11
+from libtaxii.constants import *
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+import logging
+import traceback
+import sys
+
+log = logging.getLogger(__name__)
+
+#: Maps a libtaxii message module to the X-TAXII-Services version used in the response
+TAXII_MODULE_VERSIONS = {'libtaxii.messages_11': VID_TAXII_SERVICES_11,
+                         'libtaxii.messages_10': VID_TAXII_SERVICES_10}
+
+
+class StreamingHttpResponseTaxii(StreamingHttpResponse):
+    """
+    A Django TAXII HTTP Response whose body is produced by an iterator.
+    Takes the same headers as taxii_services.handlers.HttpResponseTaxii.
+    """
+    def __init__(self, taxii_xml_iterator, taxii_headers, *args, **kwargs):
+        super(StreamingHttpResponseTaxii, self).__init__(taxii_xml_iterator, *args, **kwargs)
+        for h in handlers.REQUIRED_RESPONSE_HEADERS:
+            if h not in taxii_headers:
+                raise ValueError("Required response header not specified: %s" % h)
+
+        for k, v in taxii_headers.iteritems():
+            self[k.lower()] = v
+
+
+class WaitingHttpResponse(HttpResponse):
+    """
+    Tells yeti.green to call the application again for this request once
+    there is new content in a Data Collection. Never sent to a client.
+    """
+    status_code = 503
+
+    def __init__(self, wait_for_content):
+        super(WaitingHttpResponse, self).__init__()
+        self.wait_for_content = wait_for_content
+
+
+def log_stream_errors(xml_iterator, message_id):
+    """
+    Once a streaming response has started, a Status Message can no
+    longer be sent in its place. Log any error instead of losing it
+    to the WSGI server.
+    """
+    try:
+        for chunk in xml_iterator:
+            yield chunk
+    except Exception:
+        log.exception("Error while streaming the response to message %s", message_id)
+        raise
+
+
+@csrf_exempt
+def service_router(request, path, do_validate=True):
+    """
+    Takes in a request, path, and TAXII Message,
+    and routes the taxii_message to the Service Handler.
+    """
+    request_metrics = metrics.RequestMetrics()
+    try:
+        with request_metrics.count_queries():
+            response = route_message(request, request_metrics, do_validate)
+    except StatusMessageException:
+        request_metrics.finish(metrics.STATUS_MESSAGE)
+        raise
+    except WaitForContent as e:  # The request is not finished until it is called again
+        return WaitingHttpResponse(e)
+    except Exception:
+        request_metrics.finish(metrics.ERROR)
+        raise
+
+    if not response.streaming:  # Streaming responses are finished by metrics.measure_stream
+        request_metrics.finish(metrics.SUCCESS, len(response.content))
+    return response
+
+
+def route_message(request, request_metrics, do_validate):
+    """
+    The workflow of service_router, recording metrics in request_metrics
+    """
+
+    if request.method != 'POST':
+        raise StatusMessageException('0', ST_BAD_MESSAGE, 'Request method was not POST!')
+
+    xtct = request.META.get('HTTP_X_TAXII_CONTENT_TYPE', None)
+    if not xtct:
+        raise StatusMessageException('0', ST_BAD_MESSAGE, 'The X-TAXII-Content-Type Header was not present.')
+
+    if xtct not in FORMATS:
+        raise StatusMessageException('0', ST_BAD_MESSAGE, 'The X-TAXII-Content-Type Header is not supported.')
+
+    try:
+        with request_metrics.time(metrics.parse_seconds):
+            taxii_message = parse_request(request, xtct, do_validate)
+    except tm11.UnsupportedQueryException as e:
+        raise StatusMessageException('0',
+                                     ST_UNSUPPORTED_QUERY)
+    request_metrics.set_message(taxii_message)
+
+    service = registry.get_service(request.path)
+    request_metrics.set_path(request.path)
+    handler = service.get_message_handler(taxii_message)
+
+    try:
+        handler_class = registry.get_handler_class(handler.handler)
+    except Exception as e:
+        type, value, tb = sys.exc_info()
+        raise type, ("Error importing handler: %s" % handler.handler, type, value), tb
+
+    handler_class.validate_headers(request, taxii_message.message_id)
+    handler_class.validate_message_is_supported(taxii_message)
+
+    try:
+        with request_metrics.time(metrics.handler_seconds):
+            response_message = handler_class.handle_message(service, taxii_message, request)
+    except (StatusMessageException, WaitForContent):
+        raise  # The handler_class has intentionally raised this
+    except Exception as e:  # Something else happened
+        msg = "There was a failure while executing the message handler"
+        if settings.DEBUG:  # Add the stacktrace
+            msg += "\r\n" + traceback.format_exc()
+
+        raise StatusMessageException(taxii_message.message_id,
+                                     ST_FAILURE,
+                                     msg)
+
+    try:
+        response_message.message_type
+    except AttributeError as e:
+        msg = "The message handler (%s) did not return a TAXII Message!" % handler_class
+        if settings.DEBUG:
+            msg += ("\r\n The returned value was: %s (class=%s)" %
+                    (response_message, response_message.__class__.__name__))
+
+        raise StatusMessageException(taxii_message.message_id,
+                                     ST_FAILURE,
+                                     msg)
+
+    if isinstance(response_message, (StreamingMessage, CachedMessage)):
+        taxii_module = response_message.taxii_module
+    else:
+        taxii_module = response_message.__module__
+
+    vid = TAXII_MODULE_VERSIONS.get(taxii_module)
+    if vid is None:
+        raise ValueError("Unknown response message module")
+
+    response_headers = handlers.get_headers(vid, request.is_secure())
+
+    if isinstance(response_message, StreamingMessage):
+        if request_metrics.enabled:
+            response_message.content_blocks = request_metrics.iter_content_blocks(response_message.content_blocks)
+            xml_iterator = metrics.measure_stream(response_message.iter_xml(), request_metrics)
+        else:
+            xml_iterator = response_message.iter_xml()
+        xml_iterator = log_stream_errors(xml_iterator, taxii_message.message_id)
+        return StreamingHttpResponseTaxii(xml_iterator, response_headers)
+
+    request_metrics.count_content_blocks(response_message)
+
+    if isinstance(response_message, CachedMessage):
+        with request_metrics.time(metrics.serialize_seconds):
+            xml = response_message.to_xml()
+        response = handlers.HttpResponseTaxii(xml, response_headers)
+        response['ETag'] = 'W/"%s"' % response_message.etag  # Weak, since message_id differs every time
+        return response
+
+    with request_metrics.time(metrics.serialize_seconds):
+        xml = response_message.to_xml(pretty_print=True)
+    return handlers.HttpResponseTaxii(xml, response_headers)
+
+
+def metrics_view(request):
+    """
+    Serves this process's metrics in the Prometheus text exposition format
+    """
+    if not settings.YETI_METRICS:
+        raise Http404
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -35,8 +35,10 @@ os.environ["DJANGO_SETTINGS_MODULE"] = "yeti.settings"
 
 # This application object is used by any WSGI server configured to use this
 # file. This includes Django's development server, if the WSGI_APPLICATION
-# setting points here.
-from django.core.wsgi import get_wsgi_application
+# setting points here. Requests for TAXII Services skip the browser
+# middleware (see yeti.dispatch). Any number of processes on any number of
+# hosts can serve it if they share the database and the store (see yeti.store).
+from yeti.dispatch import get_wsgi_application
 application = get_wsgi_application()
 
 # Apply WSGI middleware here.